@@ -11,9 +11,22 @@ This module is designed as a drop-in replacement and extension for the default
 The following extensions are currently implemented:
 
     * ability to set (advisory) thread priority
+    * ability to set the OS scheduling policy (e.g. SCHED_FIFO) for a thread
+    * ability to set the I/O scheduling class and priority of a thread
+    * per-thread and per-group stack sizes, to cheaply run many idle threads
+    * ThreadCache class for reusing OS threads when starting new threads
+    * cpu_local storage and sharded counters with a slot for each CPU
     * ability to set (advisory) CPU affinity at thread and process level
+    * detection of CPU limits imposed by containers (cgroup cpusets and quotas)
+    * detection of online and isolated CPUs, and re-pinning on CPU hotplug
     * thread groups for simultaneous management of multiple threads
     * SHLock class for shared/exclusive (also known as read/write) locks
+    * LockTable class for locking many keys with a fixed pool of locks
+    * SeqLock class for lock-free reads of small, rarely-written state
+    * RCUCell and RCUDict classes for read-copy-update of shared data
+    * Barrier class, and SpinBarrier for teams of threads pinned to CPUs
+    * CountDownLatch and Phaser classes, including trees of Phasers
+    * PILock class for locks that protect against priority inversion
 
 The following API niceties are also included:
 
@@ -26,7 +39,6 @@ sensible default behaviour, but I'm not making any guarantees at this stage.
 
 Additional planned extensions include:
 
-    * make stack_size a kwarg when creating a thread
     * native events, semaphores and timed waits on win32
     * native conditions and timed waits on pthreads platforms
     * native SHLock implementations (SRW on Win Vista+, pthread_rwlock)
@@ -43,12 +55,19 @@ __ver_sub__ = ""
 __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,
                               __ver_patch__,__ver_sub__)
 
+import os
 import sys
+import atexit
 import weakref
+from collections import deque
 
 #  Expose some internal state of the threading module, for use by regr tests
 from threading import _active,_DummyThread
 
+#  Internals of the threading module needed for reusing cached threads
+from threading import _limbo,_active_limbo_lock,_start_new_thread, \
+                      _allocate_lock,_get_ident,_time,_sleep,_sys
+
 #  Grab the best implementation we can use on this platform
 try:
     if sys.platform == "win32":
@@ -64,7 +83,17 @@ __all__ = ["active_count","activeCount","Condition","current_thread",
            "currentThread","enumerate","Event","local","Lock","RLock",
            "Semaphore","BoundedSemaphore","Thread","ThreadGroup","Timer",
            "SHLock","setprofile","settrace","stack_size","group_local",
-           "CPUSet","system_affinity","process_affinity"]
+           "CPUSet","system_affinity","process_affinity",
+           "effective_cpu_capacity","refresh_cpu_info","online_cpus",
+           "isolated_cpus","CPUHotplugWatcher","SCHED_OTHER","SCHED_FIFO",
+           "SCHED_RR","SCHED_BATCH","SCHED_IDLE","SCHED_DEADLINE",
+           "PILock","PIRLock","PICondition","IOPRIO_CLASS_NONE",
+           "IOPRIO_CLASS_RT","IOPRIO_CLASS_BE","IOPRIO_CLASS_IDLE",
+           "ThreadCache","ThreadStats","Rebalancer","current_cpu",
+           "cpu_local","ShardedAccumulator","ShardedCounter",
+           "LockTable","acquire_all","SeqLock","RCUCell","RCUDict",
+           "rcu_quiescent","Barrier","SpinBarrier","BrokenBarrierError",
+           "CountDownLatch","Phaser"]
 
 
 class ThreadGroup(object):
@@ -74,18 +103,51 @@ class ThreadGroup(object):
     them all to the managed as a single unit.  Operations that can be applied
     to a group include:
 
-        * setting priority and affinity
+        * setting priority, affinity, scheduling policy and I/O priority
         * joining and testing for liveness
+        * waiting for threads one at a time as they finish
+        * limiting the number of threads that run at once
+        * measuring the resources used by the threads
+
+    The "stack_size" attribute gives the default stack size for threads in
+    the group that do not specify their own; it applies only to threads
+    started after it is set.
 
+    The "cache" attribute can be set to a ThreadCache, in which case threads
+    in the group will reuse OS-level threads from the cache when started.
+
+    If "max_running" is given, at most that many threads in the group will
+    run at once; starting another thread blocks until one of them finishes.
+    Waiting threads are admitted in the order that start() was called.
     """
 
-    def __init__(self,name=None):
+    def __init__(self,name=None,stack_size=None,cache=None,max_running=None):
         self.name = name
+        self.stack_size = stack_size
+        self.cache = cache
         self.__lock = Lock()
         self.__priority = None
         self.__affinity = None
+        self.__sched_policy = None
+        self.__sched_priority = None
+        self.__sched_deadline = None
+        self.__io_priority = None
+        #  Count of started threads that have not yet finished, and weakrefs
+        #  to finished threads not yet returned by join_any().
+        self.__done = Condition(Lock())
+        self.__running = 0
+        self.__finished = deque()
+        self.__finished_limit = 16
+        #  Admission control: the limit on running threads, a FIFO queue of
+        #  tickets for blocked calls to start(), and some statistics.
+        self.__max_running = None
+        self.__queue = deque()
+        self.__stats = dict(admitted=0,rejected=0,max_queued=0,
+                            total_wait=0.0,max_wait=0.0)
+        self.max_running = max_running
         # Ideally we'd use a WeakSet here, but it's not available
-        # in older versions of python.
+        # in older versions of python.  The values record whether each
+        # thread was started through the group, rather than e.g. upgraded.
         self.__threads = weakref.WeakKeyDictionary()
 
     def __str__(self):
@@ -94,7 +156,118 @@ class ThreadGroup(object):
         return "<ThreadGroup '%s' at %s>" % (self.name,id(self),)
 
     def _add_thread(self,thread):
-        self.__threads[thread] = True
+        self.__threads[thread] = False
+
+    def _thread_started(self,thread,timeout=None):
+        """Admit the given thread to run, possibly waiting for a free slot.
+
+        Returns True if the thread was admitted, False on timeout.
+        """
+        with self.__done:
+            if self.__queue or not self.__has_free_slot():
+                if not self.__wait_for_slot(timeout):
+                    self.__stats["rejected"] += 1
+                    return False
+            self.__stats["admitted"] += 1
+            self.__running += 1
+            self.__threads[thread] = True
+            return True
+
+    def __has_free_slot(self):
+        return self.__max_running is None or \
+               self.__running < self.__max_running
+
+    def __wait_for_slot(self,timeout):
+        ticket = object()
+        self.__queue.append(ticket)
+        stats = self.__stats
+        stats["max_queued"] = max(stats["max_queued"],len(self.__queue))
+        start = _time()
+        try:
+            while self.__queue[0] is not ticket or not self.__has_free_slot():
+                if timeout is None:
+                    self.__done.wait()
+                else:
+                    delay = start + timeout - _time()
+                    if delay <= 0:
+                        return False
+                    self.__done.wait(delay)
+            return True
+        finally:
+            self.__queue.remove(ticket)
+            #  Let the next in line check whether it can go.
+            self.__done.notify_all()
+            wait = _time() - start
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"],wait)
+
+    def _thread_finished(self,thread,ran=True):
+        with self.__done:
+            self.__running -= 1
+            if ran:
+                self.__finished.append(weakref.ref(thread))
+                #  Don't let references to uncollected threads pile up.
+                if len(self.__finished) > self.__finished_limit:
+                    finished = [r for r in self.__finished if r() is not None]
+                    self.__finished = deque(finished)
+                    self.__finished_limit = max(16,2*len(finished))
+            self.__done.notify_all()
+
+    @property
+    def max_running(self):
+        return self.__max_running
+
+    @max_running.setter
+    def max_running(self,max_running):
+        """Set the maximum number of threads in this group that can run.
+
+        Raising the limit immediately admits any waiting threads that now
+        fit; lowering it never stops threads that are already running.
+        """
+        if max_running is not None and max_running < 1:
+            raise ValueError("max_running must be at least 1")
+        with self.__done:
+            self.__max_running = max_running
+            self.__done.notify_all()
+
+    def admission_stats(self):
+        """Get statistics about the admission of threads in this group.
+
+        This returns a dict with the following keys:
+
+            * running:     number of threads currently running
+            * queued:      number of calls to start() currently waiting
+            * max_queued:  largest number of calls that have waited at once
+            * admitted:    total number of threads admitted to run
+            * rejected:    total number of threads that timed out waiting
+            * total_wait:  total seconds spent waiting for admission
+            * max_wait:    longest time spent waiting for admission
+
+        """
+        with self.__done:
+            stats = dict(self.__stats)
+            stats["running"] = self.__running
+            stats["queued"] = len(self.__queue)
+        return stats
+
+    def _set_thread_attr(self,name,value):
+        """Set the named attribute on all threads in this group.
+
+        If setting the attribute fails on any thread, its value on all
+        threads is restored to what it was previously.
+        """
+        old_values = {}
+        try:
+            for thread in self.__threads.keys():
+                old_values[thread] = getattr(thread,name)
+                setattr(thread,name,value)
+        except Exception:
+            for (thread,old_value) in old_values.iteritems():
+                try:
+                    setattr(thread,name,old_value)
+                except Exception:
+                    pass
+            raise
 
     @property
     def priority(self):
@@ -108,20 +281,8 @@ class ThreadGroup(object):
         is restored to its previous value.
         """
         with self.__lock:
-            old_priorities = {}
-            try:
-                for thread in self.__threads:
-                    old_priorities[thread] = thread.priority
-                    thread.priority = priority
-            except Exception:
-                for (thread,old_priority) in old_priorities.iteritems():
-                    try:
-                        thread.priority = old_priority
-                    except Exception:
-                        pass
-                raise
-            else:
-                self.__priority = priority
+            self._set_thread_attr("priority",priority)
+            self.__priority = priority
 
     @property
     def affinity(self):
@@ -135,96 +296,813 @@ class ThreadGroup(object):
         is restored to its previous value.
         """
         with self.__lock:
-            old_affinities = {}
-            try:
-                for thread in self.__threads:
-                    old_affinities[thread] = thread.affinity
-                    thread.affinity = affinity
-            except Exception:
-                for (thread,old_affinity) in old_affinities.iteritems():
-                    try:
-                        thread.affinity = old_affinity
-                    except Exception:
-                        pass
-                raise
-            else:
-                self.__affinity = affinity
+            self._set_thread_attr("affinity",affinity)
+            self.__affinity = affinity
+
+    @property
+    def sched_policy(self):
+        return self.__sched_policy
+
+    @sched_policy.setter
+    def sched_policy(self,policy):
+        """Set the scheduling policy for all threads in this group.
+
+        If setting the policy fails on any thread, the policy of all threads
+        is restored to its previous value.  Set the "sched_priority" or
+        "sched_deadline" attributes first if the policy needs them.
+        """
+        with self.__lock:
+            self._set_thread_attr("sched_policy",policy)
+            self.__sched_policy = policy
+
+    @property
+    def sched_priority(self):
+        return self.__sched_priority
+
+    @sched_priority.setter
+    def sched_priority(self,priority):
+        """Set the realtime scheduling priority for all threads in this group.
+
+        If setting the priority fails on any thread, the priority of all
+        threads is restored to its previous value.
+        """
+        with self.__lock:
+            self._set_thread_attr("sched_priority",priority)
+            self.__sched_priority = priority
+
+    @property
+    def sched_deadline(self):
+        return self.__sched_deadline
+
+    @sched_deadline.setter
+    def sched_deadline(self,deadline):
+        """Set the SCHED_DEADLINE parameters for all threads in this group.
+
+        If setting the parameters fails on any thread, the parameters of all
+        threads are restored to their previous value.
+        """
+        with self.__lock:
+            self._set_thread_attr("sched_deadline",deadline)
+            self.__sched_deadline = deadline
+
+    @property
+    def io_priority(self):
+        return self.__io_priority
+
+    @io_priority.setter
+    def io_priority(self,io_priority):
+        """Set the I/O priority for all threads in this group.
+
+        If setting the I/O priority fails on any thread, the I/O priority of
+        all threads is restored to its previous value.
+        """
+        with self.__lock:
+            self._set_thread_attr("io_priority",io_priority)
+            self.__io_priority = io_priority
+
+    def stats(self):
+        """Get a ThreadStats snapshot of the resources used by this group.
+
+        This is the total over all threads in the group that are currently
+        running; threads that have finished no longer contribute to it.
+        """
+        total = ThreadStats(0.0,0,0,0)
+        for thread in self.__threads.keys():
+            stats = thread.stats()
+            if stats is not None:
+                total = total + stats
+        return total
 
     def is_alive(self):
         """Check whether any thread in this group is alive."""
         return any(thread.is_alive() for thread in self.__threads)
     isAlive = is_alive
 
+    def _live_threads(self):
+        return [thread for thread in self.__threads.keys() if thread.is_alive()]
+
     def join(self,timeout=None):
         """Join all threads in this group.
 
+        This waits until every thread started in the group has finished
+        running and exited.  Calling it from one of those threads would
+        deadlock, so RuntimeError is raised instead.
+
         If the optional "timeout" argument is given, give up after that many
         seconds.  This method returns True is the threads were successfully
         joined, False if a timeout occurred.
         """
-        if timeout is None:
-            for thread in self.__threads:
-                thread.join()
-        else:
+        if self.__threads.get(current_thread()):
+            raise RuntimeError("cannot join a group from one of its threads")
+        if timeout is not None:
             deadline = _time() + timeout
-            for thread in self.__threads:
-                delay = deadline - _time()
-                if delay <= 0:
-                    return False
-                if not thread.join(delay):
+        with self.__done:
+            while self.__running:
+                if timeout is None:
+                    self.__done.wait()
+                else:
+                    delay = deadline - _time()
+                    if delay <= 0:
+                        return False
+                    self.__done.wait(delay)
+        #  Threads are counted as finished at the end of their run() method,
+        #  so they may not quite have exited yet.
+        for (thread,started) in self.__threads.items():
+            if not started or not thread.is_alive():
+                continue
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - _time(),0))
+                if thread.is_alive():
                     return False
         return True
 
+    def join_any(self,timeout=None):
+        """Wait for any thread in this group to finish, and return it.
+
+        Each finished thread is returned only once.  If there are no finished
+        threads left to return and no threads still running, None is returned
+        immediately.  Finished threads that have been garbage-collected are
+        not returned.
+
+        If the optional "timeout" argument is given, give up and return None
+        after that many seconds.
+        """
+        with self.__done:
+            if timeout is not None:
+                deadline = _time() + timeout
+            while True:
+                while self.__finished:
+                    thread = self.__finished.popleft()()
+                    if thread is not None:
+                        return thread
+                if not self.__running:
+                    return None
+                if timeout is None:
+                    self.__done.wait()
+                else:
+                    delay = deadline - _time()
+                    if delay <= 0:
+                        return None
+                    self.__done.wait(delay)
+
+    def as_completed(self,timeout=None):
+        """Iterator over threads in this group as they finish.
+
+        This repeatedly calls join_any(), stopping when there are no threads
+        left to wait for.  If the optional "timeout" argument is given, the
+        iteration stops once that many seconds have passed.
+        """
+        if timeout is not None:
+            deadline = _time() + timeout
+        while True:
+            if timeout is None:
+                thread = self.join_any()
+            else:
+                thread = self.join_any(max(deadline - _time(),0))
+            if thread is None:
+                break
+            yield thread
+
 
 default_group = ThreadGroup()
 
 
+class ThreadCache(object):
+    """Cache of OS-level threads for reuse by Thread.start().
+
+    Creating a new OS thread is relatively expensive.  If a ThreadCache is
+    set as the "cache" attribute of a ThreadGroup, then threads in that group
+    will park their OS thread in the cache when they finish running, and
+    later calls to start() will reuse a parked thread if one is available.
+    To use a cache for all threads, set it on threading2.default_group.
+
+    Each Thread object still gets its own identity, name, group and so on;
+    the priority, affinity, scheduling policy and I/O priority of the OS
+    thread are reset to what they were when it was created before it is
+    parked.  If that isn't possible, e.g. because an unprivileged process
+    can't raise a thread's priority again once lowered, the OS thread exits
+    instead of being parked.  Threads with an explicit stack_size never use
+    the cache.
+
+    Note that data stored in threading.local() objects belongs to the OS
+    thread, and so persists from one Thread object to the next.
+
+    At most "max_idle" threads will be parked in the cache at any time, and
+    threads that have been parked for more than "idle_timeout" seconds are
+    discarded the next time a thread is parked.
+    """
+
+    #  Set once the interpreter starts exiting; see __run_worker().
+    _exiting = False
+
+    def __init__(self,max_idle=16,idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.__lock = _allocate_lock()
+        self.__pid = os.getpid()
+        #  Parked workers as [wakeup lock,next thread,time parked,initial
+        #  OS-level state], with the most recently parked at the end.
+        self.__idle = []
+        #  Workers for threads currently running from the cache, by ident.
+        self.__running = {}
+
+    @property
+    def idle_threads(self):
+        """The number of OS threads currently parked in the cache."""
+        return len(self.__idle)
+
+    def clear(self):
+        """Discard all OS threads currently parked in the cache."""
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = []
+        for worker in idle:
+            worker[0].release()
+
+    def __check_fork(self):
+        #  Parked threads don't survive a fork, so forget about them.
+        pid = os.getpid()
+        if pid != self.__pid:
+            self.__pid = pid
+            self.__idle = []
+            self.__running = {}
+
+    def _start_thread(self,thread):
+        """Start the given thread, reusing a parked OS thread if possible.
+
+        This replicates threading.Thread.start(), but hands the thread over
+        to a parked worker rather than always creating a new OS thread.
+        """
+        if not thread._Thread__initialized:
+            raise RuntimeError("thread.__init__() not called")
+        if thread._Thread__started.is_set():
+            raise RuntimeError("threads can only be started once")
+        with _active_limbo_lock:
+            _limbo[thread] = thread
+        try:
+            with self.__lock:
+                self.__check_fork()
+                if self.__idle:
+                    worker = self.__idle.pop()
+                else:
+                    worker = None
+            if worker is None:
+                _start_new_thread(self.__run_worker,(thread,))
+            else:
+                worker[1] = thread
+                worker[0].release()
+        except Exception:
+            with _active_limbo_lock:
+                del _limbo[thread]
+            raise
+        thread._Thread__started.wait()
+
+    def _park_current_thread(self,thread):
+        """Offer the OS thread running the given Thread to the cache.
+
+        This is called as the last step of the Thread's run() method, so
+        that the OS thread can be reused as soon as possible.  It will pick
+        up its next Thread (if any) once its current one has finished.
+        """
+        me = _get_ident()
+        with self.__lock:
+            self.__check_fork()
+            worker = self.__running.get(me)
+        if worker is None:
+            return
+        if not thread._reset_thread_state(worker[3]):
+            return
+        with self.__lock:
+            self.__check_fork()
+            if self.__running.get(me) is not worker:
+                return
+            now = _time()
+            while self.__idle and now - self.__idle[0][2] > self.idle_timeout:
+                self.__idle.pop(0)[0].release()
+            if len(self.__idle) >= self.max_idle:
+                return
+            worker[2] = now
+            self.__idle.append(worker)
+
+    def __run_worker(self,thread):
+        #  Once a Thread has been joined the program may exit while we're
+        #  still tidying up after it, and module globals are cleared during
+        #  interpreter teardown.  So everything needed after bootstrapping
+        #  is bound to locals here, and we stop as soon as we notice that
+        #  the interpreter is exiting.
+        settrace = _sys.settrace
+        setprofile = _sys.setprofile
+        thread_state = _thread_state
+        worker = [_allocate_lock(),None,None,thread._get_thread_state()]
+        worker[0].acquire()
+        me = _get_ident()
+        while thread is not None:
+            with self.__lock:
+                self.__running[me] = worker
+            thread._Thread__bootstrap()
+            if self._exiting:
+                return
+            with self.__lock:
+                self.__running.pop(me,None)
+                if worker[2] is None:
+                    return
+            thread = None
+            settrace(None)
+            setprofile(None)
+            thread_state.__dict__.clear()
+            worker[0].acquire()
+            if self._exiting:
+                return
+            (thread,worker[1],worker[2]) = (worker[1],None,None)
+
+
+def _stop_thread_caches():
+    ThreadCache._exiting = True
+atexit.register(_stop_thread_caches)
+
+
+#  The group of the current thread, cached in thread-local storage.  The
+#  ThreadCache clears this when an OS thread is reused for a new Thread.
+_thread_state = local()
+
+def _current_group():
+    try:
+        return _thread_state.group
+    except AttributeError:
+        group = _thread_state.group = current_thread().group
+        return group
+
+
 class group_local(object):
     """Group-local storage object.
 
     Instances of group_local behave simlarly to threading.local() instance,
     except that the values of their attributes are common to all threads in 
     a single group.
+
+    Reading an attribute takes no locks.  The attributes for each group are
+    stored in a dict that is never modified once published; setting or
+    deleting an attribute builds a new dict and swaps it in.  This makes
+    group_local well suited to configuration that is read much more often
+    than it is written.
     """
 
     def __init__(self):
-        self.__lock = Lock()
-        self.__group_locks = {}
-        self.__attrs = {}
+        object.__setattr__(self,"_group_local__lock",Lock())
+        object.__setattr__(self,"_group_local__snapshots",{})
 
-    def __getattr__(self,name):
-        group = current_thread().group
+    #  Check the group's attributes before the normal lookup, since failing
+    #  the normal lookup first would make every read much slower.
+    def __getattribute__(self,name):
+        snapshots = object.__getattribute__(self,"_group_local__snapshots")
+        try:
+            group = _thread_state.group
+        except AttributeError:
+            group = _current_group()
         try:
-            return self.__attrs[group][name]
+            return snapshots[group][name]
         except KeyError:
-            raise AttributeError(name)
+            return object.__getattribute__(self,name)
 
     def __setattr__(self,name,value):
-        group = current_thread().group
-        try:
-            lock = self._group_locks[group]
-        except KeyError:
-            with self.__lock:
-                lock = self._group_locks.setdefault(group,Lock())
-        with lock:
-            try:
-                self.__attrs[group][name] = value
-            except KeyError:
-                self.__attrs[group] = {}
-                self.__attrs[group][name] = value
+        group = _current_group()
+        with self.__lock:
+            attrs = dict(self.__snapshots.get(group,()))
+            attrs[name] = value
+            self.__snapshots[group] = attrs
 
     def __delattr__(self,name):
-        group = current_thread().group
-        try:
-            lock = self._group_locks[group]
-        except KeyError:
-            with self.__lock:
-                lock = self._group_locks.setdefault(group,Lock())
-        with lock:
+        group = _current_group()
+        with self.__lock:
+            attrs = dict(self.__snapshots.get(group,()))
             try:
-                del self.__attrs[group][name]
+                del attrs[name]
             except KeyError:
                 raise AttributeError(name)
+            self.__snapshots[group] = attrs
+
+
+#  Each thread that calls rcu_quiescent() gets a counter, incremented each
+#  time it passes a quiescent point.  The owning thread finds it through
+#  thread-local storage; writers find it through this mapping.
+_rcu_counters = weakref.WeakKeyDictionary()
+
+def rcu_quiescent():
+    """Announce that the current thread is at a quiescent point.
+
+    Threads reading from RCUCell or RCUDict objects must call this regularly
+    at points where they hold no references to values read from them, e.g.
+    between requests.  Old versions of the data can only be reclaimed once
+    every thread in the reader group has done so, or has finished.
+    """
+    try:
+        counter = _thread_state.rcu_counter
+    except AttributeError:
+        counter = _thread_state.rcu_counter = [0]
+        _rcu_counters[current_thread()] = counter
+    counter[0] += 1
+
+
+def _rcu_count(thread):
+    counter = _rcu_counters.get(thread)
+    if counter is None:
+        return 0
+    return counter[0]
+
+
+class _RCUBase(object):
+    """Base class implementing grace periods for RCU containers."""
+
+    def __init__(self,group,value,reclaim=None):
+        self.group = group
+        self.reclaim = reclaim
+        self._value = value
+        self._lock = Lock()
+        #  Old versions waiting to be reclaimed, each with a sequence number
+        #  and the readers' quiescent counts at the time it was replaced.
+        self._retired = deque()
+        self._retire_count = 0
+
+    def _grace_period_start(self):
+        me = current_thread()
+        return [(thread,_rcu_count(thread))
+                for thread in self.group._live_threads() if thread is not me]
+
+    @staticmethod
+    def _grace_period_elapsed(readers):
+        for (thread,count) in readers:
+            if thread.is_alive() and _rcu_count(thread) == count:
+                return False
+        return True
+
+    def _publish(self,value):
+        #  Must be called holding self._lock.
+        old = self._value
+        self._value = value
+        if self.reclaim is not None:
+            self._retire_count += 1
+            self._retired.append((self._retire_count,
+                                  self._grace_period_start(),old))
+
+    def _reclaim(self,upto=None):
+        #  Reclaim old versions whose grace period has elapsed, or all those
+        #  retired up to the given sequence number.
+        expired = []
+        with self._lock:
+            while self._retired:
+                (seq,readers,old) = self._retired[0]
+                if upto is not None:
+                    if seq > upto:
+                        break
+                elif not self._grace_period_elapsed(readers):
+                    break
+                self._retired.popleft()
+                expired.append(old)
+        for old in expired:
+            self.reclaim(old)
+
+    @property
+    def pending(self):
+        """Number of old versions waiting to be reclaimed."""
+        return len(self._retired)
+
+    def synchronize(self,timeout=None):
+        """Wait for a grace period to elapse.
+
+        This waits until every other live thread in the reader group has
+        passed a quiescent point, at which time no reader can hold a value
+        that was replaced before the call.  Those old values are passed to
+        the reclaim callback, if there is one.  If the calling thread is in
+        the reader group, it must not itself hold any such values.
+
+        Returns True if the grace period elapsed, or False if the timeout
+        expired first.
+        """
+        upto = self._retire_count
+        readers = self._grace_period_start()
+        #  Poll using progressively longer sleeps, as for Lock.acquire().
+        if timeout is not None:
+            endtime = _time() + timeout
+        delay = 0.0005
+        while not self._grace_period_elapsed(readers):
+            if timeout is None:
+                delay = min(delay*2,0.05)
+            else:
+                remaining = endtime - _time()
+                if remaining <= 0:
+                    return False
+                delay = min(delay*2,remaining,0.05)
+            _sleep(delay)
+        if self.reclaim is not None:
+            self._reclaim(upto)
+        return True
+
+
+class RCUCell(_RCUBase):
+    """Container for a value that is read often and replaced rarely.
+
+    This uses the Read-Copy-Update technique to make reads cheap.  Readers
+    call get() and receive the current value without taking any locks.
+    Writers publish a new value using set() or modify(), serialized by a
+    lock.  The value should be treated as immutable, since readers may be
+    using it at any time; to change it, build a modified copy and publish
+    that instead.
+
+    The threads in the ThreadGroup "group" are the readers.  Each must call
+    rcu_quiescent() regularly at a point where it holds no values obtained
+    from the cell.  If "reclaim" is given, it is called with each replaced
+    value once a grace period has elapsed, i.e. once every reader thread
+    has passed a quiescent point or finished.  This happens during later
+    writes, or when synchronize() is called.  Without a callback, replaced
+    values are simply left to the garbage collector.
+    """
+
+    def __init__(self,group,value=None,reclaim=None):
+        super(RCUCell,self).__init__(group,value,reclaim)
+
+    def get(self):
+        """Get the current value."""
+        return self._value
+
+    def set(self,value):
+        """Publish a new value, replacing the current one."""
+        with self._lock:
+            self._publish(value)
+        if self._retired:
+            self._reclaim()
+
+    def modify(self,func):
+        """Publish func(value) as the new value, and return it.
+
+        The function is called while holding the writer lock, so concurrent
+        calls to modify() cannot lose each other's updates.
+        """
+        with self._lock:
+            value = func(self._value)
+            self._publish(value)
+        if self._retired:
+            self._reclaim()
+        return value
+
+
+class RCUDict(_RCUBase):
+    """Dictionary that is read often and written rarely.
+
+    This is like RCUCell holding a dict, with the usual dict methods.  Reads
+    look up the current version of the dict without taking any locks.  Each
+    write copies the current version, modifies the copy and publishes it,
+    so writes take time proportional to the size of the dict.
+
+    To read several items consistently, call snapshot() to get the current
+    version of the dict; it must not be modified.  See RCUCell for details
+    of the "group" and "reclaim" arguments, which apply to the replaced
+    versions of the dict.
+    """
+
+    def __init__(self,group,items=(),reclaim=None,**kwds):
+        super(RCUDict,self).__init__(group,dict(items,**kwds),reclaim)
+
+    def snapshot(self):
+        """Get the current version of the dict, which must not be modified."""
+        return self._value
+
+    def __getitem__(self,key):
+        return self._value[key]
+
+    def get(self,key,default=None):
+        return self._value.get(key,default)
+
+    def __contains__(self,key):
+        return key in self._value
+
+    def __len__(self):
+        return len(self._value)
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def _modify(self,func,*args):
+        with self._lock:
+            value = dict(self._value)
+            result = func(value,*args)
+            self._publish(value)
+        if self._retired:
+            self._reclaim()
+        return result
+
+    def __setitem__(self,key,value):
+        self._modify(dict.__setitem__,key,value)
+
+    def __delitem__(self,key):
+        self._modify(dict.__delitem__,key)
+
+    def pop(self,key,*default):
+        return self._modify(dict.pop,key,*default)
+
+    def update(self,*args,**kwds):
+        self._modify(lambda value: value.update(*args,**kwds))
+
+    def clear(self):
+        with self._lock:
+            self._publish({})
+        if self._retired:
+            self._reclaim()
+
+
+class CPUHotplugWatcher(Thread):
+    """Thread for watching CPUs go online and offline.
+
+    Thread affinities only take effect for those CPUs that are online at the
+    time they are set.  This thread polls the set of online CPUs every
+    "interval" seconds, and when it changes it refreshes the cached CPU
+    information and re-applies the affinity of every thread that has one.
+    Threads pinned to a CPU (e.g. latency-critical threads pinned to an
+    isolated CPU) thus return to it once it comes back online.
+
+    If the optional "callback" argument is given, it is called with the old
+    and new sets of online CPUs whenever a change is detected.  Use the
+    stop() method to shut the watcher down.
+    """
+
+    def __init__(self,interval=1,callback=None,name=None):
+        super(CPUHotplugWatcher,self).__init__(name=name,daemon=True)
+        self.interval = interval
+        self.callback = callback
+        self.online = online_cpus()
+        self.__stopping = Event()
+
+    def run(self):
+        while not self.__stopping.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        """Stop watching for changes."""
+        self.__stopping.set()
+
+    def check(self):
+        """Check for changes to the set of online CPUs.
+
+        This method returns True if a change was detected and acted upon,
+        False otherwise.
+        """
+        refresh_cpu_info()
+        online = online_cpus()
+        if online == self.online:
+            return False
+        (old_online,self.online) = (self.online,online)
+        for thread in enumerate():
+            affinity = thread.affinity
+            if affinity is not None and thread.is_alive():
+                try:
+                    thread.affinity = affinity
+                except (EnvironmentError,ValueError):
+                    pass
+        if self.callback is not None:
+            self.callback(old_online,online)
+        return True
+
+
+class Rebalancer(Thread):
+    """Thread for balancing the CPU load of a group of pinned threads.
+
+    This thread samples the CPU time used by each thread in the given group
+    every "interval" seconds, and pins the threads to individual CPUs so as
+    to spread the load evenly.  The CPUs used are those given by the "cpus"
+    argument, or else the group's affinity, or else the process affinity.
+    Threads not yet pinned to one of those CPUs are placed on the least
+    loaded CPU.  After that, threads are moved off the busiest CPU only if:
+
+        * its load exceeds that of the least busy CPU by more than
+          "threshold", measured as a fraction of one CPU
+        * fewer than "max_moves" threads have been moved this interval
+        * the thread has not been moved in the last "cooldown" seconds
+
+    This avoids shuffling threads back and forth due to short-lived changes
+    in load.  The plan() static method contains the balancing logic, and
+    can be used independently of any actual threads.  Use the stop() method
+    to shut the rebalancer down.
+    """
+
+    def __init__(self,group,cpus=None,interval=1,threshold=0.25,
+                 max_moves=1,cooldown=5,name=None):
+        super(Rebalancer,self).__init__(name=name,daemon=True)
+        self.target_group = group
+        self.cpus = cpus
+        self.interval = interval
+        self.threshold = threshold
+        self.max_moves = max_moves
+        self.cooldown = cooldown
+        self.__stopping = Event()
+        self.__samples = weakref.WeakKeyDictionary()
+        self.__moved = weakref.WeakKeyDictionary()
+
+    def run(self):
+        while not self.__stopping.wait(self.interval):
+            self.rebalance()
+
+    def stop(self):
+        """Stop rebalancing."""
+        self.__stopping.set()
+
+    def rebalance(self):
+        """Sample the CPU usage of the group's threads and rebalance them.
+
+        The first call for each thread only takes a sample, since the load
+        is measured as the CPU time used between calls.  This method returns
+        a list of (thread,cpu) pairs for the threads that were moved.
+        """
+        cpus = self.cpus
+        if cpus is None:
+            cpus = self.target_group.affinity
+        if cpus is None:
+            cpus = process_affinity()
+        cpus = sorted(cpus)
+        now = _time()
+        loads = {}
+        assignments = {}
+        for thread in enumerate():
+            if thread.group is not self.target_group or thread is self:
+                continue
+            stats = thread.stats()
+            if stats is None or stats.cpu_time is None:
+                continue
+            sample = (now,stats.cpu_time)
+            last = self.__samples.get(thread)
+            self.__samples[thread] = sample
+            if last is None or now <= last[0]:
+                continue
+            loads[thread] = (sample[1] - last[1]) / (now - last[0])
+            affinity = thread.affinity
+            if affinity is not None and len(affinity) == 1:
+                cpu = iter(affinity).next()
+                if cpu in cpus:
+                    assignments[thread] = cpu
+        frozen = [t for (t,when) in self.__moved.items()
+                    if now - when < self.cooldown]
+        moves = self.plan(loads,assignments,cpus,self.threshold,
+                          self.max_moves,frozen)
+        for (thread,cpu) in moves:
+            try:
+                thread.affinity = [cpu]
+            except (EnvironmentError,ValueError):
+                pass
+            else:
+                self.__moved[thread] = now
+        return moves
+
+    @staticmethod
+    def plan(loads,assignments,cpus,threshold=0.25,max_moves=1,frozen=()):
+        """Plan the moves needed to balance load across the given CPUs.
+
+        Given a dict mapping each thread to its load (as a fraction of one
+        CPU) and a dict giving the CPU to which each thread is currently
+        assigned, this returns a list of (thread,cpu) moves.  Unassigned
+        threads are always placed, busiest first.  Then up to "max_moves"
+        threads not in "frozen" are moved from the busiest CPU to the least
+        busy, for as long as that reduces an imbalance of over "threshold".
+        """
+        if not cpus:
+            return []
+        cpu_loads = dict((cpu,0.0) for cpu in cpus)
+        on_cpu = dict((cpu,[]) for cpu in cpus)
+        unassigned = []
+        for (thread,load) in loads.iteritems():
+            cpu = assignments.get(thread)
+            if cpu in cpu_loads:
+                cpu_loads[cpu] += load
+                on_cpu[cpu].append(thread)
+            else:
+                unassigned.append(thread)
+        moves = []
+        unassigned.sort(key=lambda t: loads[t],reverse=True)
+        for thread in unassigned:
+            cpu = min(cpus,key=lambda c: (cpu_loads[c],c))
+            cpu_loads[cpu] += loads[thread]
+            on_cpu[cpu].append(thread)
+            moves.append((thread,cpu))
+        frozen = set(frozen)
+        for _ in xrange(max_moves):
+            busiest = max(cpus,key=lambda c: (cpu_loads[c],-c))
+            idlest = min(cpus,key=lambda c: (cpu_loads[c],c))
+            imbalance = cpu_loads[busiest] - cpu_loads[idlest]
+            if imbalance <= threshold:
+                break
+            #  Moving a thread helps only if its load is less than the
+            #  imbalance; the best move takes it closest to half of it.
+            candidates = [t for t in on_cpu[busiest]
+                            if t not in frozen and 0 < loads[t] < imbalance]
+            if not candidates:
+                break
+            thread = min(candidates,key=lambda t: abs(imbalance/2-loads[t]))
+            on_cpu[busiest].remove(thread)
+            on_cpu[idlest].append(thread)
+            cpu_loads[busiest] -= loads[thread]
+            cpu_loads[idlest] += loads[thread]
+            frozen.add(thread)
+            moves.append((thread,idlest))
+        return moves
 
 
 #  Patch current_thread() and enumerate() to always return instances
@@ -232,7 +1110,11 @@ class group_local(object):
 
 _current_thread = current_thread
 def current_thread():
-    thread = _current_thread()
+    #  This is called a lot, so we inline the fast path of the stdlib version.
+    try:
+        thread = _active[_get_ident()]
+    except KeyError:
+        thread = _current_thread()
     if not isinstance(thread,Thread):
         thread = Thread.from_thread(thread)
     return thread
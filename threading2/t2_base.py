@@ -1,7 +1,12 @@
 import threading2
+import operator
+from random import random as _random
+from itertools import count
+from collections import Set, MutableSet
 from threading import *
-from threading import _RLock,_Event,_Condition,_Semaphore,_BoundedSemaphore, \
+from threading import _Event,_Condition,_Semaphore,_BoundedSemaphore, \
                       _Timer,ThreadError,_time,_sleep,_get_ident,_allocate_lock
+from threading import _limbo,_active_limbo_lock,_start_new_thread
 
 
 
@@ -9,13 +14,71 @@ __all__ = ["active_count","activeCount","Condition","current_thread",
            "currentThread","enumerate","Event","local","Lock","RLock",
            "Semaphore","BoundedSemaphore","Thread","Timer","SHLock",
            "setprofile","settrace","stack_size","CPUSet","system_affinity",
-           "process_affinity"]
+           "process_affinity","effective_cpu_capacity","refresh_cpu_info",
+           "online_cpus","isolated_cpus","SCHED_OTHER","SCHED_FIFO",
+           "SCHED_RR","SCHED_BATCH","SCHED_IDLE","SCHED_DEADLINE",
+           "PILock","PIRLock","PICondition","IOPRIO_CLASS_NONE",
+           "IOPRIO_CLASS_RT","IOPRIO_CLASS_BE","IOPRIO_CLASS_IDLE",
+           "ThreadStats","current_cpu","cpu_local","ShardedAccumulator",
+           "ShardedCounter","LockTable","acquire_all","SeqLock",
+           "Barrier","SpinBarrier","BrokenBarrierError","CountDownLatch",
+           "Phaser"]
            
 
 
+#  Scheduling policies, for use with Thread.sched_policy.  The values match
+#  those used by linux, but support for each is platform-dependent.
+SCHED_OTHER = 0
+SCHED_FIFO = 1
+SCHED_RR = 2
+SCHED_BATCH = 3
+SCHED_IDLE = 5
+SCHED_DEADLINE = 6
+
+_SCHED_POLICIES = (SCHED_OTHER,SCHED_FIFO,SCHED_RR,SCHED_BATCH,SCHED_IDLE,
+                   SCHED_DEADLINE,)
+_SCHED_REALTIME_POLICIES = (SCHED_FIFO,SCHED_RR,)
+
+#  I/O scheduling classes, for use with Thread.io_priority.  The values match
+#  those used by linux, but support for each is platform-dependent.
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+
+#  The stack size for new threads is process-global state.  To give each
+#  thread its own stack size we temporarily change it while creating the
+#  OS thread, serializing with other such changes using this lock.  Threads
+#  created at the same time without holding it (e.g. by the standard
+#  threading module, or by C extensions) may pick up the temporary size.
+_stack_size_lock = _allocate_lock()
+_thread_stack_size = stack_size
+
+def stack_size(*args):
+    with _stack_size_lock:
+        return _thread_stack_size(*args)
+stack_size.__doc__ = _thread_stack_size.__doc__ + """
+
+Threads started with their own stack_size temporarily change this setting
+while their OS thread is created.  Calls to this function wait for them to
+finish, but threads created at the same time by code outside threading2
+may be given the temporary size."""
+
+
+#  The synchronisation primitives below use __slots__ so that programs can
+#  keep millions of them around, and allocate their internal helper objects
+#  only when they're first needed.  This lock serializes that allocation.
+#  It's only ever taken when the helper doesn't exist yet, so it sees very
+#  little contention.
+_lazy_init_lock = _allocate_lock()
+
+
 class _ContextManagerMixin(object):
     """Simple mixin mapping __enter__/__exit__ to acquire/release."""
 
+    __slots__ = ()
+
     def __enter__(self):
         self.acquire()
         return self
@@ -32,6 +95,8 @@ class Lock(_ContextManagerMixin):
     to Lock.acquire().
     """
 
+    __slots__ = ("__lock","__weakref__",)
+
     def __init__(self):
         self.__lock = _allocate_lock()
         super(Lock,self).__init__()
@@ -72,7 +137,7 @@ class Lock(_ContextManagerMixin):
         self.__lock.release()
 
 
-class RLock(_ContextManagerMixin,_RLock):
+class RLock(_ContextManagerMixin):
     """Re-implemented RLock object.
 
     This is pretty much a direct clone of the RLock object from the standard
@@ -82,6 +147,8 @@ class RLock(_ContextManagerMixin,_RLock):
     It also includes a fix for a memory leak present in Python 2.6 and older.
     """
 
+    __slots__ = ("__block","__owner","__count","__weakref__",)
+
     _LockClass = Lock
 
     def __init__(self):
@@ -90,6 +157,10 @@ class RLock(_ContextManagerMixin,_RLock):
         self.__owner = None
         self.__count = 0
 
+    def __repr__(self):
+        return "<%s owner=%r count=%d>" % (self.__class__.__name__,
+                                           self.__owner,self.__count)
+
     def acquire(self,blocking=True,timeout=None):
         me = _get_ident()
         if self.__owner == me:
@@ -109,6 +180,20 @@ class RLock(_ContextManagerMixin,_RLock):
             self.__owner = None
             self.__block.release()
 
+    #  These are used by Condition objects to fully release the lock
+    #  while waiting, and then restore it to its previous state.
+
+    def _release_save(self):
+        state = (self.__count,self.__owner)
+        self.__count = 0
+        self.__owner = None
+        self.__block.release()
+        return state
+
+    def _acquire_restore(self,state):
+        self.__block.acquire()
+        (self.__count,self.__owner) = state
+
     def _is_owned(self):
         return self.__owner == _get_ident()
 
@@ -152,42 +237,95 @@ class Condition(_Condition):
             self._acquire_restore(saved_state)
 
 
+class PILock(Lock):
+    """Lock object that protects against priority inversion.
+
+    When a high-priority thread blocks waiting for a lock that is held by a
+    low-priority thread, it can be held up indefinitely by medium-priority
+    threads that keep the lock holder from running.  PILock avoids this by
+    temporarily boosting the priority of the lock holder, either to that of
+    the highest-priority waiting thread (priority inheritance) or to a fixed
+    "ceiling" priority if one is given (priority ceiling).
+
+    A priority ceiling is a realtime priority as used by the sched_priority
+    attribute of Thread, and the lock may then only be used by threads with
+    a realtime scheduling policy and a priority no higher than the ceiling.
+
+    Unlike a standard Lock, a PILock must be released by the thread that
+    acquired it.  On platforms without native support this is just a Lock.
+    """
+
+    __slots__ = ()
+
+    def __init__(self,ceiling=None):
+        super(PILock,self).__init__()
+
+
+class PIRLock(RLock):
+    """RLock using PILock to protect against priority inversion."""
+    __slots__ = ()
+    _LockClass = PILock
+
+
+class PICondition(Condition):
+    """Condition using PIRLock to protect against priority inversion."""
+    _LockClass = PIRLock
+
+
 class Semaphore(_ContextManagerMixin):
     """Re-implemented Semaphore class.
 
     This is pretty much a direct clone of the Semaphore class from the standard
     threading module; the only difference is that it uses a custom Condition
     class so that acquire() has a "timeout" parameter.
+
+    The underlying Condition object is created on first use.
     """
 
+    __slots__ = ("__cond","__value","__weakref__",)
+
     _ConditionClass = Condition
 
     def __init__(self,value=1):
         if value < 0:
             raise ValueError("semaphore initial value must be >= 0")
         super(Semaphore,self).__init__()
-        self.__cond = self._ConditionClass()
+        self.__cond = None
         self.__value = value
 
+    def _get_cond(self):
+        with _lazy_init_lock:
+            if self.__cond is None:
+                self.__cond = self._ConditionClass()
+            return self.__cond
+
     def acquire(self,blocking=True,timeout=None):
-        with self.__cond:
+        cond = self.__cond
+        if cond is None:
+            cond = self._get_cond()
+        with cond:
             while self.__value == 0:
                 if not blocking:
                     return False
-                if not self.__cond.wait(timeout=timeout):
+                if not cond.wait(timeout=timeout):
                     return False
             self.__value = self.__value - 1
             return True
 
     def release(self):
-        with self.__cond:
+        cond = self.__cond
+        if cond is None:
+            cond = self._get_cond()
+        with cond:
             self.__value = self.__value + 1
-            self.__cond.notify()
+            cond.notify()
 
 
 class BoundedSemaphore(Semaphore):
     """Semaphore that checks that # releases is <= # acquires"""
 
+    __slots__ = ("_initial_value",)
+
     def __init__(self,value=1):
         super(BoundedSemaphore,self).__init__(value)
         self._initial_value = value
@@ -204,33 +342,510 @@ class Event(object):
     This is pretty much a direct clone of the Event class from the standard
     threading module; the only difference is that it uses a custom Condition
     class for easy extensibility.
+
+    The underlying Condition object is only created once some thread has to
+    wait for the event, so events that are never waited on stay small.
     """
 
+    __slots__ = ("__cond","__flag","__weakref__",)
+
     _ConditionClass = Condition
 
     def __init__(self):
         super(Event,self).__init__()
-        self.__cond = self._ConditionClass()
+        self.__cond = None
         self.__flag = False
 
+    def _get_cond(self):
+        with _lazy_init_lock:
+            if self.__cond is None:
+                self.__cond = self._ConditionClass()
+            return self.__cond
+
     def is_set(self):
         return self.__flag
     isSet = is_set
 
+    #  The flag is always written before the condition is checked in set(),
+    #  and the condition is always created before the flag is checked in
+    #  wait().  So if set() finds no condition, any thread that later
+    #  creates one is guaranteed to see the flag.
+
     def set(self):
-        with self.__cond:
-            self.__flag = True
-            self.__cond.notify_all()
+        self.__flag = True
+        cond = self.__cond
+        if cond is not None:
+            with cond:
+                self.__flag = True
+                cond.notify_all()
 
     def clear(self):
-        with self.__cond:
+        cond = self.__cond
+        if cond is None:
             self.__flag = False
+        else:
+            with cond:
+                self.__flag = False
 
     def wait(self,timeout=None):
-        with self.__cond:
+        if self.__flag:
+            return True
+        cond = self.__cond
+        if cond is None:
+            cond = self._get_cond()
+        with cond:
             if self.__flag:
                 return True
-            return self.__cond.wait(timeout)
+            return cond.wait(timeout)
+
+
+class BrokenBarrierError(RuntimeError):
+    """Exception raised when a Barrier is broken, reset or aborted."""
+    pass
+
+
+class _BarrierPhase(object):
+    """State of one phase of a Barrier, shared by the threads waiting in it."""
+
+    __slots__ = ("waiters","released","broken",)
+
+    def __init__(self):
+        self.waiters = []
+        self.released = False
+        self.broken = False
+
+
+class Barrier(object):
+    """Barrier for a fixed number of threads, as in Python 3.
+
+    Each of the "parties" threads calls wait(), which blocks until all of
+    them have done so; they are then all released together and the barrier
+    can be used again for the next phase.  If an "action" callable is given
+    it is called by one of the threads after they have all arrived but
+    before any are released.  The "timeout" argument gives a default for
+    the timeout argument of wait().
+
+    If a wait times out, the action raises an exception, or abort() is
+    called, the barrier is "broken": all current and future calls to wait()
+    raise BrokenBarrierError until reset() is called.
+
+    Rather than waking all the threads through a single shared Condition,
+    each waiting thread blocks on its own lock, which is released directly
+    by the last thread to arrive.
+    """
+
+    _LockClass = Lock
+    _WaiterLockClass = Lock
+
+    def __init__(self,parties,action=None,timeout=None):
+        if parties < 1:
+            raise ValueError("parties must be at least 1")
+        self.__lock = self._LockClass()
+        self.__parties = parties
+        self.__action = action
+        self.__timeout = timeout
+        self.__count = 0
+        self.__phase = _BarrierPhase()
+
+    @property
+    def parties(self):
+        """The number of threads required to pass the barrier."""
+        return self.__parties
+
+    @property
+    def n_waiting(self):
+        """The number of threads currently waiting at the barrier."""
+        if self.__phase.broken:
+            return 0
+        return self.__count
+
+    @property
+    def broken(self):
+        """True if the barrier is in the broken state."""
+        return self.__phase.broken
+
+    def wait(self,timeout=None):
+        """Wait until all threads have reached the barrier.
+
+        This returns an integer in the range 0 to parties-1, different for
+        each thread, which can be used to select a thread to do some special
+        housekeeping.  If the barrier is or becomes broken while waiting,
+        BrokenBarrierError is raised.
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        with self.__lock:
+            phase = self.__phase
+            if phase.broken:
+                raise BrokenBarrierError
+            index = self.__count
+            self.__count += 1
+            if self.__count == self.__parties:
+                try:
+                    if self.__action is not None:
+                        self.__action()
+                except:
+                    self.__break()
+                    raise
+                phase.released = True
+                self.__next_phase()
+                return index
+            waiter = self._WaiterLockClass()
+            waiter.acquire()
+            phase.waiters.append(waiter)
+        if not self._wait_for_phase(phase,waiter,timeout):
+            with self.__lock:
+                if not phase.released and not phase.broken:
+                    self.__break()
+        if not phase.released:
+            raise BrokenBarrierError
+        return index
+
+    def _wait_for_phase(self,phase,waiter,timeout):
+        """Wait for the given phase to be released or broken.
+
+        This blocks on the thread's own waiter lock, which is released when
+        the phase ends.  Returns False if the timeout expires first.
+        """
+        if timeout is None:
+            return waiter.acquire()
+        return waiter.acquire(timeout=timeout)
+
+    def reset(self):
+        """Return the barrier to its initial state.
+
+        Any threads currently waiting receive a BrokenBarrierError.
+        """
+        with self.__lock:
+            if self.__count or self.__phase.broken:
+                self.__break()
+                self.__next_phase()
+
+    def abort(self):
+        """Put the barrier into the broken state.
+
+        Any threads currently waiting, and any that call wait() before the
+        barrier is reset, receive a BrokenBarrierError.
+        """
+        with self.__lock:
+            self.__break()
+
+    def __break(self):
+        phase = self.__phase
+        phase.broken = True
+        self.__wake(phase)
+
+    def __next_phase(self):
+        self.__wake(self.__phase)
+        self.__phase = _BarrierPhase()
+        self.__count = 0
+
+    def __wake(self,phase):
+        waiters = phase.waiters
+        phase.waiters = []
+        for waiter in waiters:
+            waiter.release()
+
+
+class SpinBarrier(Barrier):
+    """Barrier whose threads spin while waiting, rather than blocking.
+
+    Blocking and waking a thread costs a trip through the OS scheduler, which
+    dominates the time taken for a barrier when phases are short.  Threads
+    waiting at a SpinBarrier instead poll a release flag, yielding to other
+    threads in between, and only block once they have spun for "spin_time"
+    seconds.  This is suitable for teams of threads that are each pinned to
+    their own CPU and that reach the barrier at about the same time.
+
+    Spinning only helps if every party has a CPU to itself; otherwise the
+    spinning threads just take time away from those yet to arrive.  So by
+    default the threads spin for up to a millisecond if there are no more
+    parties than CPUs available to the process, and don't spin at all if
+    there are.  Passing "spin_time" explicitly overrides this.
+
+    Each phase has its own flag, so like a sense-reversing barrier a fast
+    thread racing ahead into the next phase can never be mistaken for a
+    release of the current one, and the flag needs no resetting.
+    """
+
+    def __init__(self,parties,action=None,timeout=None,spin_time=None):
+        super(SpinBarrier,self).__init__(parties,action,timeout)
+        if spin_time is None:
+            if parties <= threading2.effective_cpu_capacity():
+                spin_time = 0.001
+            else:
+                spin_time = 0
+        self.spin_time = spin_time
+
+    def _wait_for_phase(self,phase,waiter,timeout):
+        if not self.spin_time:
+            return super(SpinBarrier,self)._wait_for_phase(phase,waiter,
+                                                            timeout)
+        start = _time()
+        spin_until = start + self.spin_time
+        if timeout is not None:
+            spin_until = min(spin_until,start + timeout)
+        while not (phase.released or phase.broken):
+            if _time() >= spin_until:
+                if timeout is not None:
+                    timeout = max(start + timeout - _time(),0)
+                return super(SpinBarrier,self)._wait_for_phase(phase,waiter,
+                                                                timeout)
+            _sleep(0)
+        return True
+
+
+class CountDownLatch(object):
+    """Latch that opens once it has been counted down to zero.
+
+    The latch starts with the given count.  Each call to count_down()
+    decrements it, and once it reaches zero all threads waiting in wait()
+    are released; later calls to wait() return immediately.  Unlike a
+    Barrier the latch cannot be reused, and the threads counting down
+    needn't wait.
+    """
+
+    __slots__ = ("__lock","__count","__event","__weakref__",)
+
+    _LockClass = Lock
+    _EventClass = Event
+
+    def __init__(self,count):
+        if count < 0:
+            raise ValueError("count must be >= 0")
+        super(CountDownLatch,self).__init__()
+        self.__lock = self._LockClass()
+        self.__count = count
+        self.__event = self._EventClass()
+        if not count:
+            self.__event.set()
+
+    @property
+    def count(self):
+        """The number of count_down() calls still needed to open the latch."""
+        return self.__count
+
+    def count_down(self):
+        """Decrement the count, opening the latch if it reaches zero."""
+        with self.__lock:
+            if self.__count:
+                self.__count -= 1
+                if not self.__count:
+                    self.__event.set()
+
+    def wait(self,timeout=None):
+        """Wait for the latch to open.
+
+        Returns True if the latch is open, or False if the timeout expired
+        before it opened.
+        """
+        return self.__event.wait(timeout)
+
+
+class Phaser(object):
+    """Reusable barrier with a varying number of parties, as in Java.
+
+    A Phaser proceeds through a series of numbered phases.  Threads join
+    as parties using register(), and each phase advances once every
+    registered party has arrived.  Parties can arrive without waiting using
+    arrive(), wait for the current phase to end with await_advance(), or do
+    both with arrive_and_await().  They can leave with arrive_and_deregister.
+
+    With hundreds of parties, a single phaser makes them all contend for
+    one lock.  Phasers can instead be arranged in a tree by passing a
+    "parent" phaser: each child acts as a single party of its parent while
+    it has parties of its own, and arrives at the parent once all its own
+    parties have arrived.  Arriving and waiting at a child touch only that
+    child's lock.  All phasers in a tree share the phase number of the root.
+
+    When a phase is about to advance, the root's on_advance() method is
+    called to decide whether the phaser should terminate.  By default it
+    terminates once there are no registered parties.  Waiting on a
+    terminated phaser returns immediately and registering new parties
+    raises RuntimeError.
+    """
+
+    _LockClass = Lock
+    _WaiterLockClass = Lock
+
+    def __init__(self,parties=0,parent=None):
+        if parties < 0:
+            raise ValueError("parties must be >= 0")
+        self.__lock = self._LockClass()
+        self.__parent = parent
+        self.__children = []
+        self.__registered = 0
+        self.__unarrived = 0
+        #  Locks held by waiting threads, keyed by the phase they wait on.
+        self.__waiters = {}
+        if parent is None:
+            self.__root = self
+            self.__phase = 0
+            self.__terminated = False
+        else:
+            self.__root = parent.__root
+            with parent.__lock:
+                parent.__children.append(self)
+        if parties:
+            self.register(parties)
+
+    @property
+    def parent(self):
+        """The parent of this phaser, or None if it is the root."""
+        return self.__parent
+
+    @property
+    def root(self):
+        """The root of this phaser's tree."""
+        return self.__root
+
+    @property
+    def phase(self):
+        """The current phase number."""
+        return self.__root.__phase
+
+    @property
+    def terminated(self):
+        """True if the phaser has been terminated."""
+        return self.__root.__terminated
+
+    @property
+    def registered_parties(self):
+        """The number of parties registered at this phaser."""
+        return self.__registered
+
+    @property
+    def unarrived_parties(self):
+        """The number of parties yet to arrive in the current phase."""
+        return self.__unarrived
+
+    @property
+    def arrived_parties(self):
+        """The number of parties that have arrived in the current phase."""
+        with self.__lock:
+            return self.__registered - self.__unarrived
+
+    def register(self,parties=1):
+        """Register new parties with this phaser, returning the phase.
+
+        The new parties must arrive in the current phase before it can
+        advance.
+        """
+        if parties < 0:
+            raise ValueError("parties must be >= 0")
+        with self.__lock:
+            if self.__root.__terminated:
+                raise RuntimeError("phaser is terminated")
+            #  A child with no parties isn't counted by its parent, so
+            #  join the parent as a party before taking on our own.
+            if not self.__registered and parties and self.__parent:
+                self.__parent.register(1)
+            self.__registered += parties
+            self.__unarrived += parties
+            return self.__root.__phase
+
+    def arrive(self):
+        """Arrive at the phaser without waiting, returning the phase."""
+        (phase,advanced) = self.__arrive(False)
+        if advanced is not None:
+            self.__root.__release_waiters(advanced)
+        return phase
+
+    def arrive_and_deregister(self):
+        """Arrive at the phaser and deregister, returning the phase."""
+        (phase,advanced) = self.__arrive(True)
+        if advanced is not None:
+            self.__root.__release_waiters(advanced)
+        return phase
+
+    def arrive_and_await(self,timeout=None):
+        """Arrive at the phaser and wait for the phase to advance.
+
+        Returns True if the phase advanced, or False if the timeout expired
+        first.  Even on timeout, the arrival still counts.
+        """
+        return self.await_advance(self.arrive(),timeout)
+
+    def await_advance(self,phase,timeout=None):
+        """Wait for the phaser to advance from the given phase.
+
+        Returns True if the phaser is no longer in the given phase, either
+        because it advanced or was terminated, or False if the timeout
+        expired first.
+        """
+        root = self.__root
+        with self.__lock:
+            if root.__phase != phase or root.__terminated:
+                return True
+            waiter = self._WaiterLockClass()
+            waiter.acquire()
+            self.__waiters.setdefault(phase,[]).append(waiter)
+        if timeout is None:
+            return waiter.acquire()
+        if waiter.acquire(timeout=timeout):
+            return True
+        with self.__lock:
+            waiters = self.__waiters.get(phase,())
+            if waiter not in waiters:
+                #  The phase advanced just as we timed out.
+                return True
+            waiters.remove(waiter)
+            return False
+
+    def force_termination(self):
+        """Terminate the phaser, releasing any waiting threads."""
+        root = self.__root
+        with root.__lock:
+            root.__terminated = True
+            phase = root.__phase
+        root.__release_waiters(phase)
+
+    def on_advance(self,phase,registered_parties):
+        """Hook called on the root phaser before advancing from a phase.
+
+        The phaser terminates if this returns True.  By default it does so
+        once there are no registered parties left.
+        """
+        return registered_parties == 0
+
+    #  A child arrives at its parent, or registers with it, while holding
+    #  its own lock.  Locks are thus always taken from leaf to root, and
+    #  waking the waiters after an advance takes each lock separately.
+
+    def __arrive(self,deregister):
+        root = self.__root
+        with self.__lock:
+            phase = root.__phase
+            if root.__terminated:
+                return (phase,None)
+            if not self.__unarrived:
+                raise RuntimeError("no unarrived parties at phaser")
+            self.__unarrived -= 1
+            if deregister:
+                self.__registered -= 1
+            if self.__unarrived:
+                return (phase,None)
+            #  All our parties have arrived.  Reset for the next phase and
+            #  pass the arrival up the tree, or advance if we're the root.
+            self.__unarrived = self.__registered
+            if self.__parent is not None:
+                return self.__parent.__arrive(not self.__registered)
+            if self.on_advance(phase,self.__registered):
+                self.__terminated = True
+            self.__phase = phase + 1
+            return (phase,phase)
+
+    def __release_waiters(self,phase):
+        with self.__lock:
+            released = []
+            for waiting_phase in self.__waiters.keys():
+                if waiting_phase <= phase:
+                    released.extend(self.__waiters.pop(waiting_phase))
+            children = list(self.__children)
+        for waiter in released:
+            waiter.release()
+        for child in children:
+            child.__release_waiters(phase)
 
 
 class Timer(_Timer):
@@ -242,6 +857,65 @@ class Timer(_Timer):
     pass
 
 
+#  Classes used by Thread.from_thread(), keyed by the class being upgraded
+#  to and the original class of the thread.
+_upgraded_classes = {}
+
+
+class ThreadStats(object):
+    """Snapshot of the resources used by a thread or group of threads.
+
+    ThreadStats objects have the following attributes, each of which is None
+    if the platform doesn't provide that information:
+
+        * cpu_time:  total CPU time used, in seconds
+        * voluntary_switches:  number of times the thread blocked
+        * involuntary_switches:  number of times the thread was preempted
+        * migrations:  number of times the thread moved between cpus
+        * cpu:  the cpu on which the thread last ran
+
+    Snapshots can be subtracted to get the resources used between them,
+    and added together to get the total for several threads.  The "cpu"
+    attribute is None for the total.
+    """
+
+    _FIELDS = ("cpu_time","voluntary_switches","involuntary_switches",
+               "migrations",)
+
+    def __init__(self,cpu_time=None,voluntary_switches=None,
+                 involuntary_switches=None,migrations=None,cpu=None):
+        self.cpu_time = cpu_time
+        self.voluntary_switches = voluntary_switches
+        self.involuntary_switches = involuntary_switches
+        self.migrations = migrations
+        self.cpu = cpu
+
+    def __repr__(self):
+        fields = self._FIELDS + ("cpu",)
+        args = ",".join("%s=%r" % (f,getattr(self,f)) for f in fields)
+        return "ThreadStats(%s)" % (args,)
+
+    def __add__(self,other):
+        if not isinstance(other,ThreadStats):
+            return NotImplemented
+        totals = {}
+        for f in self._FIELDS:
+            (v1,v2) = (getattr(self,f),getattr(other,f))
+            if v1 is not None and v2 is not None:
+                totals[f] = v1 + v2
+        return ThreadStats(**totals)
+
+    def __sub__(self,other):
+        if not isinstance(other,ThreadStats):
+            return NotImplemented
+        deltas = {}
+        for f in self._FIELDS:
+            (v1,v2) = (getattr(self,f),getattr(other,f))
+            if v1 is not None and v2 is not None:
+                deltas[f] = v1 - v2
+        return ThreadStats(cpu=self.cpu,**deltas)
+
+
 class Thread(Thread):
     """Extended Thread class.
 
@@ -252,6 +926,19 @@ class Thread(Thread):
           priority of a thread to a float between 0 and 1.
         * an "affinity" attribute, through which you can set the (advisory)
           CPU affinity of a thread.
+        * a "native_id" attribute giving the thread's kernel-level id,
+          where the platform supports it.
+        * "sched_policy", "sched_priority" and "sched_deadline" attributes,
+          through which you can explicitly select the OS scheduling policy
+          for the thread (e.g. SCHED_FIFO) where the platform supports it.
+        * an "io_priority" attribute, through which you can set the I/O
+          scheduling class and level of the thread (e.g. IOPRIO_CLASS_IDLE)
+          where the platform supports it.
+        * a stats() method, giving a ThreadStats snapshot of the resources
+          used by the thread where the platform supports it.
+        * a "stack_size" attribute, giving the size of the stack to create
+          for the thread when it is started.  Threads created at the same
+          moment by code outside threading2 may also get this size.
         * before_run() and after_run() methods that can be safely extended
           in subclasses.
 
@@ -260,17 +947,22 @@ class Thread(Thread):
         * support for thread groups using the existing "group" argument
         * support for "daemon" as an argument to the constructor
         * join() returns a bool indicating success of the join
+        * start() takes a "timeout" argument for groups with a limited
+          number of running threads, and returns a bool indicating success
 
     """
 
     _ConditionClass = None
 
     def __init__(self,group=None,target=None,name=None,args=(),kwargs={},
-                 daemon=None,priority=None,affinity=None):
+                 daemon=None,priority=None,affinity=None,
+                 sched_policy=None,sched_priority=None,sched_deadline=None,
+                 io_priority=None,stack_size=None):
         super(Thread,self).__init__(None,target,name,args,kwargs)
         if self._ConditionClass is not None:
             self.__block = self._ConditionClass()
         self.__ident = None
+        self.__native_id = None
         if daemon is not None:
             self.daemon = daemon
         if group is None:
@@ -285,6 +977,17 @@ class Thread(Thread):
             self.affinity = affinity
         else:
             self.__affinity = None
+        self.__sched_policy = None
+        self.__sched_priority = None
+        self.__sched_deadline = None
+        if sched_priority is not None:
+            self.sched_priority = sched_priority
+        if sched_deadline is not None:
+            self.sched_deadline = sched_deadline
+        if sched_policy is not None:
+            self.sched_policy = sched_policy
+        self.io_priority = io_priority
+        self.stack_size = stack_size
        
     @classmethod
     def from_thread(cls,thread):
@@ -295,26 +998,51 @@ class Thread(Thread):
         to a thread by some means other than (a) creating it, or (b) from the 
         methods of the threading2 module.
         """
-        new_classes = []
+        key = (cls,thread.__class__)
+        try:
+            (upgraded_cls,upgrades) = _upgraded_classes[key]
+        except KeyError:
+            (upgraded_cls,upgrades) = cls._make_upgraded_class(thread.__class__)
+            _upgraded_classes.setdefault(key,(upgraded_cls,upgrades))
+        if upgraded_cls is not None:
+            thread.__class__ = upgraded_cls
+        for upgrade in upgrades:
+            upgrade(thread)
+        return thread
+
+    @classmethod
+    def _make_upgraded_class(cls,thread_cls):
+        """Make the class for upgrading instances of thread_cls to cls.
+
+        This returns the new class (or None if no change of class is needed)
+        and the list of _upgrade_thread methods to call on each instance.
+        """
+        upgrades = []
         for new_cls in cls.__mro__:
-            if new_cls not in thread.__class__.__mro__:
-                new_classes.append(new_cls)
-        if isinstance(thread,cls):
-            pass
-        elif issubclass(cls,thread.__class__):
-            thread.__class__ = cls
+            if new_cls not in thread_cls.__mro__:
+                if "_upgrade_thread" in new_cls.__dict__:
+                    upgrades.append(new_cls.__dict__["_upgrade_thread"])
+        if issubclass(thread_cls,cls):
+            upgraded_cls = None
+        elif issubclass(cls,thread_cls):
+            upgraded_cls = cls
         else:
-            class UpgradedThread(thread.__class__,cls):
+            class UpgradedThread(thread_cls,cls):
                 pass
-            thread.__class__ = UpgradedThread
-        for new_cls in new_classes:
-            if hasattr(new_cls,"_upgrade_thread"):
-                new_cls._upgrade_thread(thread)
-        return thread
+            upgraded_cls = UpgradedThread
+        return (upgraded_cls,upgrades)
 
     def _upgrade_thread(self):
         self.__priority = None
         self.__affinity = None
+        self.__native_id = None
+        self.__sched_policy = None
+        self.__sched_priority = None
+        self.__sched_deadline = None
+        self.__io_priority = None
+        self.__stack_size = None
+        if self.ident == _get_ident():
+            self.__native_id = self._current_native_id()
         if getattr(self,"group",None) is None:
             self.group = threading2.default_group
 
@@ -322,23 +1050,94 @@ class Thread(Thread):
         super(Thread,self).join(timeout)
         return not self.is_alive()
 
-    def start(self):
+    def start(self,timeout=None):
+        """Start the thread's activity.
+
+        If the thread's group limits the number of threads that can run at
+        once, this blocks until the thread is admitted to run.  If the
+        optional "timeout" argument is given, give up after that many
+        seconds.  This method returns True if the thread was started, False
+        if a timeout occurred.
+        """
+        #  Check this here, since re-wrapping the run method of a thread
+        #  that's already running would confuse it.
+        if self.__started.is_set():
+            raise RuntimeError("threads can only be started once")
+        group = self.group
+        if not group._thread_started(self,timeout):
+            return False
+        size = self.__stack_size
+        if size is None:
+            size = getattr(self.group,"stack_size",None)
+        #  Threads with an explicit stack size can't come from the cache.
+        cache = None
+        if size is None:
+            cache = getattr(self.group,"cache",None)
         #  Trick the base class into running our wrapper methods
         self_run = self.run
         def run():
+            #  Break the reference cycle between the thread and this closure
+            if self.__dict__.get("run") is run:
+                del self.run
             self.before_run()
             try:
                 self_run()
             finally:
-                self.after_run()
+                try:
+                    self.after_run()
+                    if cache is not None:
+                        cache._park_current_thread(self)
+                finally:
+                    group._thread_finished(self)
         self.run = run
-        super(Thread,self).start()
+        try:
+            if cache is not None:
+                cache._start_thread(self)
+            elif size is None:
+                super(Thread,self).start()
+            else:
+                self._start_with_stack_size(size)
+        except Exception:
+            if self.__dict__.get("run") is run:
+                del self.run
+            group._thread_finished(self,False)
+            raise
+        return True
+
+    def _start_with_stack_size(self,size):
+        """Start the thread's OS thread with the given stack size.
+
+        This replicates threading.Thread.start(), so that the global stack
+        size is only changed while the OS thread is being created and not
+        while we wait for it to start running.
+        """
+        if not self.__initialized:
+            raise RuntimeError("thread.__init__() not called")
+        with _active_limbo_lock:
+            _limbo[self] = self
+        try:
+            with _stack_size_lock:
+                old_size = _thread_stack_size(size)
+                try:
+                    _start_new_thread(self.__bootstrap,())
+                finally:
+                    _thread_stack_size(old_size)
+        except Exception:
+            with _active_limbo_lock:
+                del _limbo[self]
+            raise
+        self.__started.wait()
 
     def before_run(self):
+        self.__native_id = self._current_native_id()
         if self.__priority is not None:
             self._set_priority(self.__priority)
         if self.__affinity is not None:
             self._set_affinity(self.__affinity)
+        if self.__sched_policy is not None:
+            self._apply_sched_policy()
+        if self.__io_priority is not None:
+            self._set_io_priority(self.__io_priority)
 
     def after_run(self):
         pass
@@ -347,14 +1146,40 @@ class Thread(Thread):
     if "ident" not in Thread.__dict__:
         def before_run(self):
             self.__ident = _get_ident()
+            self.__native_id = self._current_native_id()
             if self.__priority is not None:
                 self._set_priority(self.__priority)
             if self.__affinity is not None:
                 self._set_affinity(self.__affinity)
+            if self.__sched_policy is not None:
+                self._apply_sched_policy()
+            if self.__io_priority is not None:
+                self._set_io_priority(self.__io_priority)
         @property
         def ident(self):
             return self.__ident
 
+    @property
+    def native_id(self):
+        return self.__native_id
+
+    @staticmethod
+    def _current_native_id():
+        """Get the kernel-level id of the calling thread, if available."""
+        return None
+
+    def stats(self):
+        """Get a ThreadStats snapshot of the resources used by this thread.
+
+        If the thread is not running, None is returned.
+        """
+        if not self.is_alive():
+            return None
+        return self._read_stats()
+
+    def _read_stats(self):
+        return ThreadStats()
+
     def _get_group(self):
         return self.__group
     def _set_group(self,group):
@@ -374,7 +1199,7 @@ class Thread(Thread):
             raise ValueError("priority must be between 0 and 1")
         self.__priority = priority
         if self.is_alive():
-            self.priority = priority
+            self._set_priority(priority)
         return priority
     priority = property(_get_priority,_set_priority)
     def _set_priority(self,priority):
@@ -387,12 +1212,159 @@ class Thread(Thread):
             affinity = CPUSet(affinity)
         self.__affinity = affinity
         if self.is_alive():
-            self.affinity = affinity
+            self._set_affinity(affinity)
         return affinity
     affinity = property(_get_affinity,_set_affinity)
     def _set_affinity(self,affinity):
         return affinity
 
+    #  The OS scheduling policy for the thread, e.g. SCHED_FIFO.  If this is
+    #  None then the policy is left to the OS, influenced only by "priority".
+    def _get_sched_policy(self):
+        return self.__sched_policy
+    def _set_sched_policy(self,policy):
+        if policy is not None:
+            if policy not in _SCHED_POLICIES:
+                raise ValueError("unknown scheduling policy: %r" % (policy,))
+            if policy == SCHED_DEADLINE and self.__sched_deadline is None:
+                raise ValueError("SCHED_DEADLINE requires sched_deadline")
+        self.__sched_policy = policy
+        if self.is_alive():
+            if policy is not None:
+                self._apply_sched_policy()
+            else:
+                #  Hand the thread back to the normal policy, and let its
+                #  "priority" (if any) pick the details as usual.
+                self._set_sched_params(SCHED_OTHER,0,None)
+                if self.__priority is not None:
+                    self._set_priority(self.__priority)
+    sched_policy = property(_get_sched_policy,_set_sched_policy)
+
+    #  The static priority for realtime policies (SCHED_FIFO and SCHED_RR).
+    #  If this is None, the lowest available realtime priority is used.
+    def _get_sched_priority(self):
+        return self.__sched_priority
+    def _set_sched_priority(self,priority):
+        if priority is not None:
+            priority = int(priority)
+            if priority < 0:
+                raise ValueError("sched_priority must not be negative")
+        self.__sched_priority = priority
+        if self.is_alive() and self.__sched_policy is not None:
+            self._apply_sched_policy()
+    sched_priority = property(_get_sched_priority,_set_sched_priority)
+
+    #  A (runtime,deadline,period) tuple for SCHED_DEADLINE.  The thread is
+    #  guaranteed "runtime" seconds of CPU time within "deadline" seconds of
+    #  the start of every "period" seconds.
+    def _get_sched_deadline(self):
+        return self.__sched_deadline
+    def _set_sched_deadline(self,deadline):
+        if deadline is not None:
+            (runtime,deadline,period) = map(float,deadline)
+            if not 0 < runtime <= deadline <= period:
+                raise ValueError("must have 0 < runtime <= deadline <= period")
+            deadline = (runtime,deadline,period)
+        elif self.__sched_policy == SCHED_DEADLINE:
+            raise ValueError("SCHED_DEADLINE requires sched_deadline")
+        self.__sched_deadline = deadline
+        if self.is_alive() and self.__sched_policy == SCHED_DEADLINE:
+            self._apply_sched_policy()
+    sched_deadline = property(_get_sched_deadline,_set_sched_deadline)
+
+    def _apply_sched_policy(self):
+        policy = self.__sched_policy
+        priority = self.__sched_priority
+        if policy not in _SCHED_REALTIME_POLICIES:
+            priority = 0
+        deadline = None
+        if policy == SCHED_DEADLINE:
+            deadline = self.__sched_deadline
+        self._set_sched_params(policy,priority,deadline)
+
+    #  The I/O priority as an (ioclass,level) tuple, where level is between
+    #  0 (highest) and 7 (lowest).  A bare ioclass gets the middle level,
+    #  and any (ioclass,level) sequence is accepted in place of a tuple.
+    def _get_io_priority(self):
+        return self.__io_priority
+    def _set_io_priority(self,io_priority):
+        if io_priority is None:
+            #  Hand the thread back to the default I/O scheduling, which
+            #  follows its CPU priority.
+            self.__io_priority = None
+            if self.is_alive():
+                self._set_io_priority((IOPRIO_CLASS_NONE,0))
+            return None
+        if isinstance(io_priority,(int,long)):
+            if io_priority == IOPRIO_CLASS_IDLE:
+                io_priority = (io_priority,0)
+            else:
+                io_priority = (io_priority,4)
+        try:
+            (ioclass,level) = io_priority
+        except (TypeError,ValueError):
+            raise TypeError("io_priority must be an I/O class or an "
+                            "(ioclass,level) pair: %r" % (io_priority,))
+        if not isinstance(ioclass,(int,long)):
+            raise TypeError("I/O scheduling class must be an int: %r"
+                            % (ioclass,))
+        if not isinstance(level,(int,long)):
+            raise TypeError("I/O priority level must be an int: %r" % (level,))
+        if ioclass not in (IOPRIO_CLASS_NONE,IOPRIO_CLASS_RT,
+                           IOPRIO_CLASS_BE,IOPRIO_CLASS_IDLE,):
+            raise ValueError("unknown I/O scheduling class: %r" % (ioclass,))
+        if not 0 <= level <= 7:
+            raise ValueError("I/O priority level must be between 0 and 7")
+        io_priority = (ioclass,int(level))
+        self.__io_priority = io_priority
+        if self.is_alive():
+            self._set_io_priority(io_priority)
+        return io_priority
+    io_priority = property(_get_io_priority,_set_io_priority)
+    def _set_io_priority(self,io_priority):
+        return io_priority
+
+    #  The stack size to use when starting the thread, or None to use the
+    #  group's stack size or the global default.  Zero means the platform
+    #  default regardless of the global setting.
+    def _get_stack_size(self):
+        return self.__stack_size
+    def _set_stack_size(self,size):
+        if self.ident is not None:
+            raise RuntimeError("cannot set stack_size of a started thread")
+        if size is not None and size != 0 and size < 32768:
+            raise ValueError("stack_size must be 0 or at least 32768 bytes")
+        self.__stack_size = size
+    stack_size = property(_get_stack_size,_set_stack_size)
+
+    @staticmethod
+    def _get_thread_state():
+        """Get a snapshot of the OS-level state of the calling thread.
+
+        ThreadCache takes this when it creates an OS thread, and passes it
+        to _reset_thread_state() each time the thread is about to be parked.
+        """
+        return None
+
+    def _reset_thread_state(self,state):
+        """Return the OS-level state of the current thread to "state".
+
+        This is called at the end of run() for threads started from a
+        ThreadCache.  It returns True if the state was fully restored, so
+        that the underlying OS thread can be safely reused; otherwise the
+        OS thread is left to exit.
+        """
+        return True
+
+    def _set_sched_params(self,policy,priority,deadline):
+        """Apply the given scheduling parameters to the running thread.
+
+        If "priority" is None, the platform's lowest realtime priority is
+        used.  This does nothing by default; platform-specific subclasses
+        should override it.
+        """
+        pass
+
 
 class SHLock(_ContextManagerMixin):
     """Shareable lock class.
@@ -405,7 +1377,15 @@ class SHLock(_ContextManagerMixin):
     locks will cause a deadlock.  This restriction may go away in future.
     """
 
+    #  The "__dict__" slot keeps instances open to extra attributes, which
+    #  is handy for instrumentation.  The dict itself is only created if
+    #  such an attribute is actually set.
+    __slots__ = ("_lock","is_shared","_shared_owners","is_exclusive",
+                 "_exclusive_owner","_shared_queue","_exclusive_queue",
+                 "_free_waiters","__dict__","__weakref__",)
+
     class Context(_ContextManagerMixin):
+        __slots__ = ("parent","blocking","timeout","shared",)
         def __init__(self, parent,
                      blocking=True, timeout=None, shared=False):
             self.parent = parent
@@ -414,9 +1394,9 @@ class SHLock(_ContextManagerMixin):
             self.shared = shared
 
         def acquire(self):
-            self.parent.acquire(blocking=self.blocking,
-                                timeout=self.timeout,
-                                shared=self.shared)
+            return self.parent.acquire(blocking=self.blocking,
+                                       timeout=self.timeout,
+                                       shared=self.shared)
 
         def release(self):
             self.parent.release()
@@ -428,20 +1408,21 @@ class SHLock(_ContextManagerMixin):
         self._lock = self._LockClass()
         #  When a shared lock is held, is_shared will give the cumulative
         #  number of locks and _shared_owners maps each owning thread to
-        #  the number of locks is holds.
+        #  the number of locks is holds.  The dict is created on demand.
         self.is_shared = 0
-        self._shared_owners = {}
+        self._shared_owners = None
         #  When an exclusive lock is held, is_exclusive will give the number
         #  of locks held and _exclusive_owner will give the owning thread
         self.is_exclusive = 0
         self._exclusive_owner = None
         #  When someonce is forced to wait for a lock, they add themselves
         #  to one of these queues along with a "waiter" condition that 
-        #  is used to wake them up.
-        self._shared_queue = []
-        self._exclusive_queue = []
+        #  is used to wake them up.  Uncontended locks never need them,
+        #  so they're created on demand.
+        self._shared_queue = None
+        self._exclusive_queue = None
         #  This is for recycling waiter objects.
-        self._free_waiters = []
+        self._free_waiters = None
 
     def __call__(self,blocking=True,timeout=None,shared=False):
         return SHLock.Context(self, blocking=blocking,
@@ -451,10 +1432,11 @@ class SHLock(_ContextManagerMixin):
         """Acquire the lock in shared or exclusive mode."""
         with self._lock:
             if shared:
-                self._acquire_shared(blocking,timeout)
+                acquired = self._acquire_shared(blocking,timeout)
             else:
-                self._acquire_exclusive(blocking,timeout)
+                acquired = self._acquire_exclusive(blocking,timeout)
             assert not (self.is_shared and self.is_exclusive)
+            return acquired
 
     def release(self):
         """Release the lock."""
@@ -472,11 +1454,7 @@ class SHLock(_ContextManagerMixin):
                     #  If there are waiting shared locks, issue it to them
                     #  all and then wake everyone up.
                     if self._shared_queue:
-                        for (thread,waiter) in self._shared_queue:
-                            self.is_shared += 1
-                            self._shared_owners[thread] = 1
-                            waiter.notify()
-                        del self._shared_queue[:]
+                        self._grant_shared_queue()
                     #  Otherwise, if there are waiting exclusive locks,
                     #  they get first dibbs on the lock.
                     elif self._exclusive_queue:
@@ -519,18 +1497,26 @@ class SHLock(_ContextManagerMixin):
                 raise RuntimeError("can't downgrade SHLock object")
             if not blocking:
                 return False
+            if self._shared_queue is None:
+                self._shared_queue = []
             waiter = self._take_waiter()
             try:
                 self._shared_queue.append((me,waiter))
                 if not waiter.wait(timeout=timeout):
-                    self._shared_queue.remove((me,waiter))
-                    return False
+                    #  We may have been handed the lock just as we timed
+                    #  out, in which case we're no longer in the queue.
+                    if (me,waiter) in self._shared_queue:
+                        self._shared_queue.remove((me,waiter))
+                        return False
                 assert not self.is_exclusive
             finally:
                 self._return_waiter(waiter)
         else:
+            if self._shared_owners is None:
+                self._shared_owners = {}
             self.is_shared += 1
             self._shared_owners[me] = 1
+        return True
 
     def _acquire_exclusive(self,blocking=True,timeout=None):
         me = currentThread()
@@ -544,69 +1530,798 @@ class SHLock(_ContextManagerMixin):
         if self.is_shared or self.is_exclusive:
             if not blocking:
                 return False
+            if self._exclusive_queue is None:
+                self._exclusive_queue = []
             waiter = self._take_waiter()
             try:
                 self._exclusive_queue.append((me,waiter))
                 if not waiter.wait(timeout=timeout):
-                    self._exclusive_queue.remove((me,waiter))
-                    return False
+                    if self._exclusive_owner is not me:
+                        self._exclusive_queue.remove((me,waiter))
+                        #  Shared locks may have queued up behind us, and
+                        #  can now go ahead if no exclusive lock is held.
+                        if not self.is_exclusive and \
+                           not self._exclusive_queue and self._shared_queue:
+                            self._grant_shared_queue()
+                        return False
             finally:
                 self._return_waiter(waiter)
         else:
             self._exclusive_owner = me
             self.is_exclusive += 1
+        return True
+
+    def _grant_shared_queue(self):
+        if self._shared_owners is None:
+            self._shared_owners = {}
+        for (thread,waiter) in self._shared_queue:
+            self.is_shared += 1
+            self._shared_owners[thread] = 1
+            waiter.notify()
+        del self._shared_queue[:]
 
     def _take_waiter(self):
-        try:
+        if self._free_waiters:
             return self._free_waiters.pop()
-        except IndexError:
-            return self._ConditionClass(self._lock)
+        return self._ConditionClass(self._lock)
 
     def _return_waiter(self,waiter):
+        if self._free_waiters is None:
+            self._free_waiters = []
         self._free_waiters.append(waiter)
 
 
 
+class SeqLock(_ContextManagerMixin):
+    """Sequence lock, for small and frequently-read shared state.
+
+    Writers are serialized by an ordinary lock, and acquiring/releasing a
+    SeqLock (e.g. using a "with" statement) is how a writer gets exclusive
+    access.  Readers take no lock at all.  Instead they note the lock's
+    sequence number before reading, and check afterwards that no writer
+    was active in the meantime, retrying the read if there was:
+
+        while True:
+            seq = seqlock.read_begin()
+            value = (state.x,state.y)
+            if not seqlock.read_retry(seq):
+                break
+
+    The read() method wraps up this loop for a callable.  Since a read may
+    be retried it should have no side-effects, and it may see inconsistent
+    state before being retried.  Readers never block writers, so a steady
+    stream of writes can starve readers; use SHLock if writes are frequent.
+    """
+
+    __slots__ = ("__lock","__seq","__writer","__weakref__",)
+
+    _LockClass = Lock
+
+    def __init__(self):
+        super(SeqLock,self).__init__()
+        self.__lock = self._LockClass()
+        self.__seq = 0
+        self.__writer = None
+
+    @property
+    def sequence(self):
+        """The current sequence number, which is odd while writing."""
+        return self.__seq
+
+    def acquire(self,blocking=True,timeout=None):
+        """Acquire this lock for writing.
+
+        The "blocking" and "timeout" arguments are as for Lock.acquire(),
+        as is the return value.
+        """
+        if not self.__lock.acquire(blocking,timeout):
+            return False
+        self.__writer = _get_ident()
+        self.__seq += 1
+        return True
+
+    def release(self):
+        """Release this lock after writing.
+
+        Only the thread that acquired the lock may release it, since the
+        sequence number must not change while its write is in progress.
+        """
+        if not self.__seq & 1:
+            raise RuntimeError("release() called on unheld lock")
+        if self.__writer != _get_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+        self.__seq += 1
+        self.__writer = None
+        self.__lock.release()
+
+    def read_begin(self):
+        """Begin a read, returning the sequence number to check against.
+
+        If a write is in progress this waits for it to finish, spinning
+        rather than blocking.
+        """
+        seq = self.__seq
+        if not seq & 1:
+            return seq
+        if self.__writer == _get_ident():
+            raise RuntimeError("cannot read while holding SeqLock for write")
+        delay = 0
+        while seq & 1:
+            _sleep(delay)
+            delay = min(delay*2 or 0.00001,0.001)
+            seq = self.__seq
+        return seq
+
+    def read_retry(self,seq):
+        """Check whether a read begun at the given sequence must be retried."""
+        return self.__seq != seq
+
+    def read(self,func,*args,**kwds):
+        """Call func(*args,**kwds) as a reader, returning its result.
+
+        The call is retried until it completes without a concurrent write.
+        If it raises an exception while a write was in progress, it is
+        retried as well since the exception may be due to inconsistent
+        state.
+        """
+        while True:
+            seq = self.read_begin()
+            try:
+                result = func(*args,**kwds)
+            except Exception:
+                if self.__seq == seq:
+                    raise
+            else:
+                if self.__seq == seq:
+                    return result
+
+
+def acquire_all(locks,blocking=True,timeout=None,shared=False):
+    """Acquire all of the given locks, without risk of deadlock.
+
+    Acquiring several locks one after the other can deadlock if another
+    thread acquires them in a different order.  This function never blocks
+    waiting for one lock while holding another; instead it tries to grab
+    each lock in a stable order, and if one isn't available it releases
+    everything, backs off for a random interval, and then waits for just
+    the unavailable lock before trying again.
+
+    The locks may be any mixture of Lock, RLock, SHLock or other objects
+    with a compatible acquire() method.  If "shared" is true then SHLock
+    objects are acquired in shared mode; other locks are unaffected.  The
+    "blocking" and "timeout" arguments are as for Lock.acquire().
+
+    This returns an object that is true while it holds the locks, and false
+    if they couldn't be acquired.  It has a release() method, and can be
+    used as a context manager that releases the locks on exit:
+
+        with acquire_all([lock1,lock2]):
+            ...
+
+    Entering the context after a failed acquire raises RuntimeError.
+    """
+    #  Order the locks by id, which is stable for as long as they're alive,
+    #  and only try to acquire each distinct lock once.
+    ordered = []
+    seen = set()
+    for lock in sorted(locks,key=id):
+        if id(lock) not in seen:
+            seen.add(id(lock))
+            ordered.append(lock)
+    if not ordered:
+        return _AcquiredLocks(())
+    if timeout is not None:
+        endtime = _time() + timeout
+    delay = 0.0005
+    first = 0
+    while True:
+        #  Block on the first lock, which holds up no-one else since we're
+        #  not holding anything yet.  The others are tried without waiting.
+        if timeout is not None:
+            timeout = max(endtime - _time(),0)
+        if not _acquire_one(ordered[first],blocking,timeout,shared):
+            return _AcquiredLocks(None)
+        held = [ordered[first]]
+        try:
+            for i in xrange(len(ordered)):
+                if i == first:
+                    continue
+                if not _acquire_one(ordered[i],False,None,shared):
+                    break
+                held.append(ordered[i])
+            else:
+                acquired = held
+                held = None
+                return _AcquiredLocks(acquired)
+        finally:
+            if held:
+                for held_lock in reversed(held):
+                    held_lock.release()
+        #  Back off before waiting for the lock that we couldn't get,
+        #  giving its holder a chance to finish with all of its locks.
+        if not blocking:
+            return _AcquiredLocks(None)
+        first = i
+        delay = min(delay*2,0.05)
+        backoff = _random() * delay
+        if timeout is not None:
+            remaining = endtime - _time()
+            if remaining <= 0:
+                return _AcquiredLocks(None)
+            backoff = min(backoff,remaining)
+        _sleep(backoff)
+
+
+def _acquire_one(lock,blocking,timeout,shared):
+    if shared and isinstance(lock,SHLock):
+        return lock.acquire(blocking,timeout,shared=True)
+    if timeout is None:
+        return lock.acquire(blocking)
+    return lock.acquire(blocking,timeout)
+
+
+class _AcquiredLocks(object):
+    """Result of acquire_all(), for releasing the acquired locks."""
+
+    __slots__ = ("locks",)
+
+    def __init__(self,locks):
+        self.locks = locks
+
+    def __nonzero__(self):
+        return self.locks is not None
+
+    def release(self):
+        """Release all of the acquired locks."""
+        if self.locks is None:
+            raise RuntimeError("locks were not acquired")
+        (locks,self.locks) = (self.locks,None)
+        for lock in reversed(locks):
+            lock.release()
+
+    def __enter__(self):
+        if self.locks is None:
+            raise RuntimeError("locks were not acquired")
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.release()
+
+
+class LockTable(object):
+    """Table of locks keyed by arbitrary hashable objects.
+
+    Creating a separate lock for each of millions of keys wastes memory,
+    while a single global lock serializes everything.  A LockTable sits in
+    between: it holds a fixed number of lock "stripes" and maps each key
+    onto one of them by its hash.  Distinct keys may share a stripe, so
+    holding the lock for one key can block another unrelated key.  Choose
+    the number of stripes to keep this contention acceptably low; the
+    stats() method can help with tuning.
+
+    The "kind" argument gives the class of lock used for each stripe, and
+    may be Lock, RLock or SHLock.  The "shared" argument to the acquire
+    methods is only valid with SHLock stripes.
+
+    To lock several keys at once, use acquire_many().  It always acquires
+    stripes in the same order, so that threads locking overlapping sets of
+    keys cannot deadlock.  This guarantee is void if a thread already holds
+    a stripe from the same table when it calls acquire_many().
+
+    Calling the table returns a context manager for locking some keys:
+
+        with table(key1,key2,timeout=5):
+            ...
+
+    If the keys cannot be locked, entering the context raises RuntimeError.
+    """
+
+    _STAT_FIELDS = ("acquired","contended","timeouts","total_wait",
+                    "max_wait",)
+
+    class Context(object):
+        __slots__ = ("table","keys","blocking","timeout","shared",)
+        def __init__(self,table,keys,blocking=True,timeout=None,
+                     shared=False):
+            self.table = table
+            self.keys = keys
+            self.blocking = blocking
+            self.timeout = timeout
+            self.shared = shared
+
+        def __enter__(self):
+            if not self.table.acquire_many(self.keys,self.blocking,
+                                           self.timeout,self.shared):
+                raise RuntimeError("could not acquire locks")
+            return self
+
+        def __exit__(self,exc_type,exc_value,traceback):
+            self.table.release_many(self.keys)
+
+    def __init__(self,stripes=64,kind=Lock):
+        stripes = int(stripes)
+        if stripes < 1:
+            raise ValueError("number of stripes must be at least 1")
+        self.stripes = stripes
+        self.kind = kind
+        self.__shareable = isinstance(kind,type) and issubclass(kind,SHLock)
+        self.__locks = [kind() for _ in xrange(stripes)]
+        self.__stats_locks = [_allocate_lock() for _ in xrange(stripes)]
+        self.__stats = [[0,0,0,0.0,0.0] for _ in xrange(stripes)]
+
+    def __call__(self,*keys,**kwds):
+        return LockTable.Context(self,keys,**kwds)
+
+    def stripe_of(self,key):
+        """Get the index of the stripe used to lock the given key."""
+        return hash(key) % self.stripes
+
+    def lock_for(self,key):
+        """Get the underlying lock object used for the given key."""
+        return self.__locks[hash(key) % self.stripes]
+
+    def acquire(self,key,blocking=True,timeout=None,shared=False):
+        """Acquire the lock for the given key.
+
+        The "blocking" and "timeout" arguments are as for Lock.acquire().
+        This returns True if the lock was successfully acquired and False
+        otherwise.
+        """
+        return self._acquire_stripe(hash(key) % self.stripes,
+                                    blocking,timeout,shared)
+
+    def release(self,key):
+        """Release the lock for the given key."""
+        self.__locks[hash(key) % self.stripes].release()
+
+    def acquire_many(self,keys,blocking=True,timeout=None,shared=False):
+        """Acquire the locks for all of the given keys.
+
+        The stripes are acquired in a fixed global order, and each stripe
+        only once no matter how many of the keys map onto it.  If any of
+        them can't be acquired within the timeout then those already held
+        are released and False is returned.
+        """
+        if timeout is not None:
+            endtime = _time() + timeout
+        held = []
+        try:
+            for stripe in self._stripes_of(keys):
+                if timeout is not None:
+                    timeout = max(endtime - _time(),0)
+                if not self._acquire_stripe(stripe,blocking,timeout,shared):
+                    break
+                held.append(stripe)
+            else:
+                held = None
+                return True
+            return False
+        finally:
+            if held:
+                for stripe in reversed(held):
+                    self.__locks[stripe].release()
+
+    def release_many(self,keys):
+        """Release the locks for all of the given keys."""
+        for stripe in reversed(self._stripes_of(keys)):
+            self.__locks[stripe].release()
+
+    def stats(self):
+        """Get contention statistics for each stripe in this table.
+
+        This returns a list with a dict for each stripe, with the following
+        keys:
+
+            * acquired:    number of times the stripe has been acquired
+            * contended:   number of acquisitions that had to wait
+            * timeouts:    number of acquisitions that failed
+            * total_wait:  total seconds spent waiting for the stripe
+            * max_wait:    longest time spent waiting for the stripe
+
+        A high ratio of contended to acquired on most stripes suggests the
+        keys themselves are contended; if it's concentrated on only a few
+        stripes, using more stripes may help.
+        """
+        stats = []
+        for (stats_lock,values) in zip(self.__stats_locks,self.__stats):
+            with stats_lock:
+                stats.append(dict(zip(self._STAT_FIELDS,values)))
+        return stats
+
+    def reset_stats(self):
+        """Reset the contention statistics for each stripe to zero."""
+        for (stats_lock,values) in zip(self.__stats_locks,self.__stats):
+            with stats_lock:
+                values[:] = [0,0,0,0.0,0.0]
+
+    def _stripes_of(self,keys):
+        return sorted(set(hash(key) % self.stripes for key in keys))
+
+    def _acquire_stripe(self,stripe,blocking=True,timeout=None,shared=False):
+        lock = self.__locks[stripe]
+        if shared:
+            if not self.__shareable:
+                raise ValueError("%s stripes can't be shared" % (self.kind,))
+            acquire = lambda *args: lock.acquire(*args,shared=True)
+        else:
+            acquire = lock.acquire
+        #  Try to grab it without waiting, so we can tell whether this
+        #  acquisition was contended.
+        if acquire(False):
+            wait = None
+            acquired = True
+        elif not blocking:
+            wait = 0.0
+            acquired = False
+        else:
+            start = _time()
+            acquired = acquire(True,timeout)
+            wait = _time() - start
+        values = self.__stats[stripe]
+        with self.__stats_locks[stripe]:
+            if acquired:
+                values[0] += 1
+            else:
+                values[2] += 1
+            if wait is not None:
+                values[1] += 1
+                values[3] += wait
+                if wait > values[4]:
+                    values[4] = wait
+        return acquired
+
+
+
 #  Utilities for handling CPU affinity
 
-class CPUSet(set):
+class CPUSet(object):
     """Object representing a set of CPUs on which a thread is to run.
 
     This is a python-level representation of the concept of a "CPU mask" as
     used in various thread-affinity libraries.  Each CPU in the system is
     represented by an integer, with the first being CPU zero.
+
+    Internally the set is stored as an integer bitmask, so conversion to and
+    from bitmasks is free and set operations work a machine word at a time.
+    It supports the same interface as the builtin set type, and instances
+    can be freely mixed with builtin sets.
+
+    CPUSet objects can also be parsed from and formatted to the "cpu list"
+    format used by the linux kernel in /sys and /proc:
+
+        >>> CPUSet.from_cpulist("0-3,8-11") == CPUSet([0,1,2,3,8,9,10,11])
+        True
+        >>> CPUSet([0,1,2,3,8,9,10,11]).to_cpulist()
+        '0-3,8-11'
+
     """
 
+    __slots__ = ("_mask",)
+
     def __init__(self,set_or_mask=None):
-        super(CPUSet,self).__init__()
+        self._mask = 0
         if set_or_mask is not None:
             if isinstance(set_or_mask,(int,long)):
-                cpu = 0
-                cur_mask = set_or_mask
-                while cur_mask:
-                    if cur_mask & 1:
-                        self.add(cpu)
-                    cur_mask = cur_mask >> 1
-                    cpu += 1
+                if set_or_mask < 0:
+                    raise ValueError("bitmask must not be negative")
+                self._mask = set_or_mask
+            elif isinstance(set_or_mask,CPUSet):
+                self._mask = set_or_mask._mask
             else:
                 for i in set_or_mask:
                     self.add(i)
 
-    def add(self,cpu):
-        return super(CPUSet,self).add(int(cpu))
+    @classmethod
+    def from_cpulist(cls,cpulist):
+        """Create a CPUSet from a string in kernel "cpu list" format.
+
+        This is a comma-separated list of CPU numbers and inclusive ranges,
+        e.g. "0-3,8-11" for CPUs zero to three and eight to eleven.
+        """
+        mask = 0
+        for item in cpulist.strip().split(","):
+            item = item.strip()
+            if not item:
+                continue
+            try:
+                if "-" in item:
+                    (first,last) = item.split("-",1)
+                    (first,last) = (int(first),int(last))
+                else:
+                    first = last = int(item)
+            except ValueError:
+                raise ValueError("invalid cpu list: %r" % (cpulist,))
+            if first < 0 or last < first:
+                raise ValueError("invalid cpu list: %r" % (cpulist,))
+            mask |= ((1 << (last - first + 1)) - 1) << first
+        return cls(mask)
+
+    def to_cpulist(self):
+        """Format this CPUSet as a string in kernel "cpu list" format."""
+        items = []
+        mask = self._mask
+        base = 0
+        while mask:
+            #  Skip to the start of the next run of set bits,
+            #  then find its length.
+            low = mask & -mask
+            skip = low.bit_length() - 1
+            mask >>= skip
+            base += skip
+            run = (~mask & (mask + 1)).bit_length() - 1
+            if run == 1:
+                items.append(str(base))
+            else:
+                items.append("%d-%d" % (base,base + run - 1))
+            mask >>= run
+            base += run
+        return ",".join(items)
 
     def to_bitmask(self):
-        bitmask = 0
-        for cpu in self:
-            bitmask |= 1 << cpu
-        return bitmask
+        return self._mask
+
+    @staticmethod
+    def _bitmask_of(other):
+        if isinstance(other,CPUSet):
+            return other._mask
+        return CPUSet(other)._mask
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__,list(self),)
+
+    def __reduce__(self):
+        return (self.__class__,(self._mask,))
+
+    def __len__(self):
+        return bin(self._mask).count("1")
+
+    def __nonzero__(self):
+        return self._mask != 0
+
+    def __iter__(self):
+        mask = self._mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __contains__(self,cpu):
+        try:
+            cpu = int(cpu)
+        except (TypeError,ValueError):
+            return False
+        if cpu < 0:
+            return False
+        return bool((self._mask >> cpu) & 1)
+
+    def add(self,cpu):
+        cpu = int(cpu)
+        if cpu < 0:
+            raise ValueError("invalid cpu: %d" % (cpu,))
+        self._mask |= 1 << cpu
+
+    def discard(self,cpu):
+        if cpu in self:
+            self._mask &= ~(1 << int(cpu))
+
+    def remove(self,cpu):
+        if cpu not in self:
+            raise KeyError(cpu)
+        self._mask &= ~(1 << int(cpu))
+
+    def pop(self):
+        if not self._mask:
+            raise KeyError("pop from an empty CPUSet")
+        low = self._mask & -self._mask
+        self._mask ^= low
+        return low.bit_length() - 1
+
+    def clear(self):
+        self._mask = 0
+
+    def copy(self):
+        return self.__class__(self._mask)
+    __copy__ = copy
+
+    def union(self,*others):
+        mask = self._mask
+        for other in others:
+            mask |= self._bitmask_of(other)
+        return self.__class__(mask)
+
+    def intersection(self,*others):
+        mask = self._mask
+        for other in others:
+            mask &= self._bitmask_of(other)
+        return self.__class__(mask)
+
+    def difference(self,*others):
+        mask = self._mask
+        for other in others:
+            mask &= ~self._bitmask_of(other)
+        return self.__class__(mask)
+
+    def symmetric_difference(self,other):
+        return self.__class__(self._mask ^ self._bitmask_of(other))
+
+    def update(self,*others):
+        for other in others:
+            self._mask |= self._bitmask_of(other)
+
+    def intersection_update(self,*others):
+        for other in others:
+            self._mask &= self._bitmask_of(other)
+
+    def difference_update(self,*others):
+        for other in others:
+            self._mask &= ~self._bitmask_of(other)
+
+    def symmetric_difference_update(self,other):
+        self._mask ^= self._bitmask_of(other)
+
+    def issubset(self,other):
+        return not (self._mask & ~self._bitmask_of(other))
+
+    def issuperset(self,other):
+        return not (self._bitmask_of(other) & ~self._mask)
+
+    def isdisjoint(self,other):
+        return not (self._mask & self._bitmask_of(other))
+
+    #  Operators follow the builtin set type, and only accept other sets.
+
+    def _operand(self,other):
+        if isinstance(other,CPUSet):
+            return other._mask
+        if isinstance(other,(set,frozenset,Set)):
+            try:
+                return CPUSet(other)._mask
+            except (TypeError,ValueError):
+                return None
+        return None
+
+    def __eq__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            if isinstance(other,(set,frozenset,Set)):
+                return False
+            return NotImplemented
+        return self._mask == mask
+
+    def __ne__(self,other):
+        res = self.__eq__(other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    __hash__ = None
+
+    def __le__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return not (self._mask & ~mask)
+
+    def __lt__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self._mask != mask and not (self._mask & ~mask)
+
+    def __ge__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return not (mask & ~self._mask)
+
+    def __gt__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self._mask != mask and not (mask & ~self._mask)
+
+    def __or__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self.__class__(self._mask | mask)
+    __ror__ = __or__
+
+    def __and__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self.__class__(self._mask & mask)
+    __rand__ = __and__
+
+    def __xor__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self.__class__(self._mask ^ mask)
+    __rxor__ = __xor__
+
+    def __sub__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self.__class__(self._mask & ~mask)
+
+    def __rsub__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        return self.__class__(mask & ~self._mask)
+
+    def __ior__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        self._mask |= mask
+        return self
+
+    def __iand__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        self._mask &= mask
+        return self
+
+    def __ixor__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        self._mask ^= mask
+        return self
+
+    def __isub__(self,other):
+        mask = self._operand(other)
+        if mask is None:
+            return NotImplemented
+        self._mask &= ~mask
+        return self
+
+MutableSet.register(CPUSet)
 
 
 def system_affinity():
-    """Get the set of CPUs available on this system."""
+    """Get the set of CPUs available on this system.
+
+    Where the platform supports it, this excludes any CPUs that the process
+    is barred from using by its container, e.g. by a cgroup cpuset.
+    """
     return CPUSet((0,))
 
 
+def online_cpus():
+    """Get the set of CPUs that are currently online.
+
+    Unlike system_affinity(), this includes CPUs that the process is not
+    permitted to use.
+    """
+    return system_affinity()
+
+
+def isolated_cpus():
+    """Get the set of CPUs that are isolated from general scheduling.
+
+    On linux these are the CPUs given in the "isolcpus" and "nohz_full"
+    kernel parameters, which are normally reserved for latency-sensitive
+    threads that have been explicitly pinned to them.
+    """
+    return CPUSet()
+
+
+def refresh_cpu_info():
+    """Discard any cached information about the CPUs on this system.
+
+    Information such as the result of system_affinity() is cached after it
+    is first calculated.  Call this function if you know it has changed,
+    e.g. because CPUs have been brought online or taken offline.
+    """
+    pass
+
+
 def process_affinity(affinity=None):
     """Get or set the CPU affinity set for the current process.
 
@@ -620,3 +2335,150 @@ def process_affinity(affinity=None):
             raise ValueError("unknown cpus: %s" % affinity)
     return system_affinity()
 
+
+def effective_cpu_capacity():
+    """Get the number of CPUs worth of processing time available to us.
+
+    This is the number of CPUs in the process affinity set, further limited
+    by any CPU quota imposed on the process (e.g. by the cpu.max setting of
+    a cgroup) and rounded up to a whole number.  It's the number to use when
+    deciding how many CPU-bound threads to run.
+    """
+    return max(len(process_affinity()),1)
+
+
+def current_cpu():
+    """Get the number of the CPU on which the calling thread is running.
+
+    The thread may be moved to another CPU at any moment, so the result is
+    only a hint.  If the platform can't tell, None is returned.
+    """
+    return None
+
+
+#  Where the current cpu is unknown, per-cpu data is instead spread across
+#  a fixed number of slots, with each thread assigned a slot in turn.
+_NUM_THREAD_SLOTS = 16
+_thread_slots = local()
+_next_thread_slot = count()
+
+def _current_thread_slot():
+    try:
+        return _thread_slots.slot
+    except AttributeError:
+        slot = _thread_slots.slot = _next_thread_slot.next()
+        return slot
+
+
+class _CPUShardedMixin(object):
+    """Mixin for objects that keep a separate slot for each cpu.
+
+    Subclasses call _current_slot() to find the slot for the calling thread.
+    Platforms that can cheaply find the current cpu should override the
+    _current_cpu and _num_slots hooks; the defaults assign slots by thread.
+    """
+
+    _current_cpu = staticmethod(_current_thread_slot)
+
+    @staticmethod
+    def _num_slots():
+        return _NUM_THREAD_SLOTS
+
+
+class cpu_local(_CPUShardedMixin):
+    """CPU-local storage object.
+
+    Instances of cpu_local behave simlarly to threading.local() instances,
+    except that the values of their attributes are common to all threads
+    running on a single CPU.  Since threads can move between CPUs at any
+    time, this is only suitable for data where it doesn't matter which slot
+    gets used, such as caches or statistics that are later combined.
+
+    Where the current CPU can't be determined, each thread is assigned to one
+    of a fixed number of slots instead.
+    """
+
+    def __init__(self):
+        slots = [{} for _ in xrange(type(self)._num_slots())]
+        object.__setattr__(self,"_cpu_local__slots",slots)
+
+    def __getattribute__(self,name):
+        slots = object.__getattribute__(self,"_cpu_local__slots")
+        try:
+            return slots[type(self)._current_cpu() % len(slots)][name]
+        except KeyError:
+            return object.__getattribute__(self,name)
+
+    def __setattr__(self,name,value):
+        slots = object.__getattribute__(self,"_cpu_local__slots")
+        slots[type(self)._current_cpu() % len(slots)][name] = value
+
+    def __delattr__(self,name):
+        slots = object.__getattribute__(self,"_cpu_local__slots")
+        try:
+            del slots[type(self)._current_cpu() % len(slots)][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ShardedAccumulator(_CPUShardedMixin):
+    """Accumulator that can be updated by many threads without contention.
+
+    The accumulated value is split into a shard for each CPU, and add() only
+    updates the shard of the CPU on which the calling thread is running.  The
+    "value" property combines all the shards.  The function "func" is used
+    both to update a shard and to combine the shards, so it must be
+    associative and commutative (e.g. operator.add or max), and "initial"
+    must be its identity value.
+    """
+
+    def __init__(self,func=operator.add,initial=0):
+        self.func = func
+        self.initial = initial
+        self._shards = [[_allocate_lock(),initial]
+                        for _ in xrange(self._num_slots())]
+
+    def add(self,value):
+        """Add the given value into the accumulator."""
+        shards = self._shards
+        shard = shards[self._current_cpu() % len(shards)]
+        with shard[0]:
+            shard[1] = self.func(shard[1],value)
+
+    @property
+    def value(self):
+        return reduce(self.func,[shard[1] for shard in self._shards])
+
+    def reset(self):
+        """Reset the accumulator to its initial value."""
+        for shard in self._shards:
+            with shard[0]:
+                shard[1] = self.initial
+
+
+class ShardedCounter(ShardedAccumulator):
+    """Counter that can be incremented by many threads without contention.
+
+    This is a ShardedAccumulator that sums its values, with some convenience
+    methods for counting.
+    """
+
+    def __init__(self,value=0):
+        super(ShardedCounter,self).__init__(operator.add,0)
+        self._shards[0][1] = value
+
+    def increment(self,n=1):
+        """Increment the counter by the given amount."""
+        shards = self._shards
+        shard = shards[self._current_cpu() % len(shards)]
+        with shard[0]:
+            shard[1] += n
+    add = increment
+
+    def decrement(self,n=1):
+        """Decrement the counter by the given amount."""
+        self.increment(-n)
+
+    @property
+    def value(self):
+        return sum([shard[1] for shard in self._shards])
@@ -1,12 +1,13 @@
 
 import os
+import math
 import errno
 from ctypes import *
 from ctypes.util import find_library
 
 import t2_base
 from t2_base import *
-from t2_base import __all__
+from t2_base import __all__,_time,_get_ident
 
 libc = find_library("c")
 if libc is None:
@@ -19,33 +20,147 @@ if pthread is None:
 pthread = CDLL(pthread,use_errno=True)
 
 
-SCHED_OTHER = 0
-SCHED_FIFO = 1
-SCHED_RR = 2
+PRIO_PROCESS = 0
 
 
 class _sched_param(Structure):
     _fields_ = [("priority",c_int32)]
 
 
-# _cpuset is the structure representing a set of cpus.  Ordinarily you'd
-# manipulate it using platform-specific macros, but we don't have that luxury.
-# Instread, we adjust the definition of the structure in response to EINVAL.
-# TODO: there's no guarantee the cpu_set_t structure is a long array bitmask.
-_CPUSET_SIZE = 1
-_MAX_CPUSET_SIZE = 8
-_HAVE_ADJUSTED_CPUSET_SIZE = False
-_cpuset_bits_t = c_int32
-class _cpuset(Structure):
-    _fields_ = [("bits",_cpuset_bits_t*_CPUSET_SIZE)]
+class _sched_attr(Structure):
+    _fields_ = [("size",c_uint32),
+                ("sched_policy",c_uint32),
+                ("sched_flags",c_uint64),
+                ("sched_nice",c_int32),
+                ("sched_priority",c_uint32),
+                ("sched_runtime",c_uint64),
+                ("sched_deadline",c_uint64),
+                ("sched_period",c_uint64)]
 
-def _incr_cpuset_size():
-    global _cpuset
+
+#  Some linux functionality is only available as raw syscalls, whose numbers
+#  depend on the machine architecture.
+if os.uname()[0] == "Linux":
+    _MACHINE = os.uname()[4]
+    if _MACHINE in ("i386","i486","i586","i686",):
+        _MACHINE = "i386"
+    elif _MACHINE.startswith("arm"):
+        _MACHINE = "arm"
+    elif _MACHINE.startswith("ppc"):
+        _MACHINE = "ppc"
+else:
+    _MACHINE = None
+
+_SYSCALLS = {
+    "gettid": {"x86_64":186,"i386":224,"arm":224,"aarch64":178,
+               "ppc":207,"s390x":236,},
+    "sched_setattr": {"x86_64":314,"i386":351,"arm":380,"aarch64":274,
+                      "ppc":355,"s390x":345,},
+    "ioprio_set": {"x86_64":251,"i386":289,"arm":314,"aarch64":30,
+                   "ppc":273,"s390x":282,},
+    "ioprio_get": {"x86_64":252,"i386":290,"arm":315,"aarch64":31,
+                   "ppc":274,"s390x":283,},
+}
+
+def _syscall(name):
+    """Get a function invoking the named linux syscall, or None."""
+    try:
+        nr = _SYSCALLS[name][_MACHINE]
+    except KeyError:
+        return None
+    def syscall(*args):
+        return libc.syscall(nr,*args)
+    return syscall
+
+
+#  Linux schedules threads according to their kernel-level thread id, which
+#  is not the same as the pthread_t we get from thread.get_ident().  Newer
+#  versions of glibc let us fetch it directly, older ones need a syscall.
+if hasattr(libc,"gettid"):
+    def _gettid():
+        return libc.gettid()
+else:
+    _gettid = _syscall("gettid")
+
+_sched_setattr = _syscall("sched_setattr")
+_ioprio_set = _syscall("ioprio_set")
+_ioprio_get = _syscall("ioprio_get")
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+
+#  A set of cpus is passed to the kernel as a cpu_set_t, which is a bitmask
+#  stored as an array of unsigned longs.  Ordinarily you'd manipulate it using
+#  platform-specific macros, but we don't have that luxury.  Worse, its size
+#  depends on the number of cpus the kernel was configured to support.  We
+#  start with the size glibc uses by default and keep doubling it until the
+#  kernel stops complaining with EINVAL, then cache the size for later calls.
+_cpuset_bits_t = c_ulong
+_CPUSET_WORD_BITS = 8*sizeof(_cpuset_bits_t)
+_MIN_CPUSET_SIZE = 1024 // _CPUSET_WORD_BITS
+_MAX_CPUSET_SIZE = 65536 // _CPUSET_WORD_BITS
+_CPUSET_SIZE = None
+
+
+def _cpuset_from_cpus(cpus,size):
+    """Convert a set of cpus into a cpuset array of the given size."""
+    bitmask = CPUSet(cpus).to_bitmask()
+    if bitmask >> (size*_CPUSET_WORD_BITS):
+        raise ValueError("unknown cpus: %s" % (cpus,))
+    mask = (_cpuset_bits_t*size)()
+    chunkmask = (1 << _CPUSET_WORD_BITS) - 1
+    i = 0
+    while bitmask:
+        mask[i] = bitmask & chunkmask
+        bitmask = bitmask >> _CPUSET_WORD_BITS
+        i += 1
+    return mask
+
+
+def _cpus_from_cpuset(mask):
+    """Convert a cpuset array into a CPUSet object."""
+    intmask = 0
+    for i in xrange(len(mask)-1,-1,-1):
+        intmask = (intmask << _CPUSET_WORD_BITS) | mask[i]
+    return CPUSet(intmask)
+
+
+def _get_cpuset(getter):
+    """Fetch a cpuset array using the given getter function.
+
+    The getter is called as getter(nbytes,mask) and must return zero on
+    success or an errno value on failure.  If the size of the kernel's
+    cpu_set_t is not yet known, this function determines it by retrying
+    with progressively larger masks.
+    """
     global _CPUSET_SIZE
-    _CPUSET_SIZE += 1
-    class _cpuset(Structure):
-        _fields_ = [("bits",_cpuset_bits_t*_CPUSET_SIZE)]
+    if _CPUSET_SIZE is not None:
+        mask = (_cpuset_bits_t*_CPUSET_SIZE)()
+        res = getter(sizeof(mask),mask)
+        if res:
+            raise OSError(res,os.strerror(res))
+        return mask
+    size = _MIN_CPUSET_SIZE
+    while True:
+        mask = (_cpuset_bits_t*size)()
+        res = getter(sizeof(mask),mask)
+        if not res:
+            _CPUSET_SIZE = size
+            return mask
+        if res != errno.EINVAL or size >= _MAX_CPUSET_SIZE:
+            raise OSError(res,os.strerror(res))
+        size *= 2
+
 
+def _cpuset_size():
+    """Get the size of the kernel's cpu_set_t, in words."""
+    if _CPUSET_SIZE is None:
+        if _do_get_proc_affinity is not None:
+            _do_get_proc_affinity(0)
+        else:
+            _do_get_affinity(pthread.pthread_self())
+    return _CPUSET_SIZE
 
 
 def _priority_range(policy=None):
@@ -66,38 +181,351 @@ def _priority_range(policy=None):
     return (min,max)
     
 
+def _priority_to_nice(priority):
+    """Map a priority between 0 and 1 onto a nice value.
+
+    The default priority of 0.5 maps to the default nice value of zero,
+    with lower priorities spread evenly over the positive nice values and
+    higher priorities over the negative ones.
+    """
+    if priority <= 0.5:
+        return int(round(19 * (1 - 2*priority)))
+    else:
+        return -int(round(20 * (2*priority - 1)))
+
+
+def _do_set_priority(tid,priority,set_policy=True):
+    """Set the priority of the thread with the given kernel-level id.
+
+    On linux the nice value applies to individual threads, so we use it to
+    implement thread priorities.  At the bottom end of the scale we also
+    switch the thread to the SCHED_BATCH or SCHED_IDLE policy, so that it
+    gives way to interactive threads as much as possible.
+
+    Raising a thread's priority above the default normally requires special
+    privileges.  Since priorities are advisory, failures due to missing
+    privileges are silently ignored.
+
+    If "set_policy" is False then the thread's scheduling policy is left
+    alone, and only its nice value is changed.
+    """
+    if set_policy:
+        if priority <= 0:
+            policy = SCHED_IDLE
+        elif priority < 0.25:
+            policy = SCHED_BATCH
+        else:
+            policy = SCHED_OTHER
+        if libc.sched_setscheduler(tid,policy,byref(_sched_param(0))) < 0:
+            eno = get_errno()
+            if eno not in (errno.EPERM,errno.EINVAL,):
+                raise OSError(eno,"sched_setscheduler")
+    if libc.setpriority(PRIO_PROCESS,tid,_priority_to_nice(priority)) < 0:
+        eno = get_errno()
+        if eno not in (errno.EPERM,errno.EACCES,):
+            raise OSError(eno,"setpriority")
+
+
+def _do_set_sched_params(tid,policy,priority,deadline):
+    """Set the scheduling policy of the thread with the given kernel-level id.
+
+    If we lack the privileges to use the requested policy (e.g. a realtime
+    policy without CAP_SYS_NICE) then the thread is left unchanged.
+    """
+    if policy == SCHED_DEADLINE:
+        if _sched_setattr is None:
+            raise OSError(errno.ENOSYS,"sched_setattr")
+        (runtime,deadline,period) = [int(v * 1e9) for v in deadline]
+        attr = _sched_attr(sizeof(_sched_attr),policy,0,0,0,
+                           runtime,deadline,period)
+        res = _sched_setattr(tid,byref(attr),0)
+        func = "sched_setattr"
+    else:
+        if priority is None:
+            priority = libc.sched_get_priority_min(policy)
+        param = _sched_param(priority)
+        res = libc.sched_setscheduler(tid,policy,byref(param))
+        func = "sched_setscheduler"
+    if res < 0:
+        eno = get_errno()
+        if eno != errno.EPERM:
+            raise OSError(eno,func)
+
+
 #  Try to define _do_get_affinity and _do_set_affinity based on availability
 #  of the necessary functions in libpthread.
 if hasattr(pthread,"pthread_setaffinity_np"):
+    pthread.pthread_self.restype = c_ulong
     def _do_set_affinity(tid,affinity):
-        if not _HAVE_ADJUSTED_CPUSET_SIZE:
-            _do_get_affinity(tid)
-        affinity = CPUSet(affinity)
-        mask = c_long()
-        mask.value = affinity.to_bitmask()
-        res = pthread.pthread_setaffinity_np(tid,sizeof(mask),byref(mask))
+        mask = _cpuset_from_cpus(affinity,_cpuset_size())
+        res = pthread.pthread_setaffinity_np(c_ulong(tid),sizeof(mask),
+                                             byref(mask))
         if res:
             raise OSError(res,"pthread_setaffinity_np")
     def _do_get_affinity(tid):
-        global _HAVE_ADJUSTED_CPUSET_SIZE
-        _HAVE_ADJUSTED_CPUSET_SIZE = True
-        mask = _cpuset()
-        res = pthread.pthread_getaffinity_np(tid,sizeof(mask),byref(mask))
-        if res:
-            if res == errno.EINVAL and _CPUSET_SIZE < _MAX_CPUSET_SIZE:
-                _incr_cpuset_size()
-                return _do_get_affinity(tid)
-            raise OSError(res,"pthread_get_affinity_np")
-        intmask = 0
-        shift = 8*sizeof(_cpuset_bits_t)
-        for i in xrange(len(mask.bits)):
-            intmask |= mask.bits[i] << (i*shift)
-        return CPUSet(intmask)
+        def getter(size,mask):
+            return pthread.pthread_getaffinity_np(c_ulong(tid),size,
+                                                  byref(mask))
+        try:
+            return _cpus_from_cpuset(_get_cpuset(getter))
+        except OSError, e:
+            raise OSError(e.errno,"pthread_getaffinity_np")
 else:
     _do_set_affinity = None
     _do_get_affinity = None
 
 
+def _do_set_io_priority(tid,io_priority):
+    """Set the I/O priority of the thread with the given kernel-level id.
+
+    The realtime I/O class requires special privileges; as with other
+    priorities, failures due to missing privileges are silently ignored.
+    """
+    (ioclass,level) = io_priority
+    value = (ioclass << IOPRIO_CLASS_SHIFT) | level
+    if _ioprio_set(IOPRIO_WHO_PROCESS,tid,value) < 0:
+        eno = get_errno()
+        if eno != errno.EPERM:
+            raise OSError(eno,"ioprio_set")
+
+
+def _do_get_io_priority(tid):
+    """Get the I/O priority of the thread with the given kernel-level id."""
+    value = _ioprio_get(IOPRIO_WHO_PROCESS,tid)
+    if value < 0:
+        raise OSError(get_errno(),"ioprio_get")
+    return (value >> IOPRIO_CLASS_SHIFT,value & ((1 << IOPRIO_CLASS_SHIFT)-1))
+
+
+def _do_get_thread_state(tid,ident):
+    """Get the scheduling state of a thread, for reuse checks by ThreadCache.
+
+    The thread is identified by both its kernel-level id and its pthread id.
+    This returns a (nice,policy,sched_priority,io_priority,affinity) tuple,
+    with None for any items that can't be read on this system.
+    """
+    set_errno(0)
+    nice = libc.getpriority(PRIO_PROCESS,tid)
+    if nice == -1 and get_errno():
+        raise OSError(get_errno(),"getpriority")
+    policy = libc.sched_getscheduler(tid)
+    if policy < 0:
+        raise OSError(get_errno(),"sched_getscheduler")
+    param = _sched_param()
+    if libc.sched_getparam(tid,byref(param)) < 0:
+        raise OSError(get_errno(),"sched_getparam")
+    io_priority = None
+    if _ioprio_get is not None:
+        io_priority = _do_get_io_priority(tid)
+    affinity = None
+    if _do_get_affinity is not None:
+        affinity = _do_get_affinity(ident)
+    return (nice,policy,param.priority,io_priority,affinity)
+
+
+def _do_restore_thread_state(tid,ident,state):
+    """Put a thread back into a state from _do_get_thread_state().
+
+    Errors are ignored, since e.g. an unprivileged process can lower the
+    priority of a thread but not raise it again.  Instead, the state is read
+    back and we return True only if it was fully restored.
+    """
+    current = _do_get_thread_state(tid,ident)
+    if current == state:
+        return True
+    (nice,policy,sched_priority,io_priority,affinity) = state
+    if current[1:3] != (policy,sched_priority) and policy != SCHED_DEADLINE:
+        libc.sched_setscheduler(tid,policy,byref(_sched_param(sched_priority)))
+    if current[0] != nice:
+        libc.setpriority(PRIO_PROCESS,tid,nice)
+    if current[3] != io_priority and _ioprio_set is not None:
+        #  The kernel may report a level for IOPRIO_CLASS_NONE, but
+        #  won't accept one back.
+        if io_priority[0] == IOPRIO_CLASS_NONE:
+            io_priority = (IOPRIO_CLASS_NONE,0)
+        try:
+            _do_set_io_priority(tid,io_priority)
+        except OSError:
+            pass
+    if current[4] != affinity:
+        try:
+            _do_set_affinity(ident,affinity)
+        except (OSError,ValueError):
+            pass
+    return _do_get_thread_state(tid,ident) == state
+
+
+#  Per-thread resource accounting, read from the kernel's task directory.
+_PROC_TASK_DIR = "/proc/self/task"
+_CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+#  Fields of interest in /proc/self/task/<tid>/sched and .../status.
+_SCHED_FIELDS = {"nr_voluntary_switches":"voluntary_switches",
+                 "nr_involuntary_switches":"involuntary_switches",
+                 "se.nr_migrations":"migrations",}
+_STATUS_FIELDS = {"voluntary_ctxt_switches":"voluntary_switches",
+                  "nonvoluntary_ctxt_switches":"involuntary_switches",}
+
+
+if hasattr(libc,"clock_gettime"):
+    def _thread_cpu_time(tid):
+        """Get the CPU time used by the given thread, or None on error.
+
+        This uses the thread's CPU-time clock, as would be returned by
+        pthread_getcpuclockid().  We construct the clock id from the tid
+        directly, so that it's safe to use on threads that have exited.
+        """
+        ts = _timespec()
+        clockid = c_int(((~tid) << 3) | 6)
+        if libc.clock_gettime(clockid,byref(ts)) != 0:
+            return None
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+else:
+    def _thread_cpu_time(tid):
+        return None
+
+
+def _parse_fields(data,fields,sep):
+    """Parse "name<sep>value" lines, returning the named integer fields."""
+    values = {}
+    for ln in data.split("\n"):
+        (name,_,value) = ln.partition(sep)
+        name = name.strip()
+        if name in fields:
+            values[fields[name]] = int(value.strip().split(".")[0])
+    return values
+
+
+def _do_get_stats(tid):
+    """Get a ThreadStats snapshot for the given kernel-level thread id.
+
+    If the thread no longer exists then None is returned.
+    """
+    taskdir = "%s/%d" % (_PROC_TASK_DIR,tid,)
+    stat = _read_file(taskdir + "/stat")
+    if stat is None:
+        return None
+    #  Fields are numbered from one, and the third follows the command name.
+    fields = stat.rsplit(")",1)[1].split()
+    values = {"cpu":int(fields[39-3])}
+    values["cpu_time"] = _thread_cpu_time(tid)
+    if values["cpu_time"] is None:
+        ticks = int(fields[14-3]) + int(fields[15-3])
+        values["cpu_time"] = ticks / float(_CLK_TCK)
+    sched = _read_file(taskdir + "/sched")
+    if sched is not None:
+        values.update(_parse_fields(sched,_SCHED_FIELDS,":"))
+    else:
+        status = _read_file(taskdir + "/status")
+        if status is None:
+            return None
+        values.update(_parse_fields(status,_STATUS_FIELDS,":"))
+    return ThreadStats(**values)
+
+
+#  Native mutexes with priority inheritance.  The pthread types are opaque
+#  and their size varies by platform, so we over-allocate them.
+PTHREAD_MUTEX_ERRORCHECK = 2
+PTHREAD_PRIO_INHERIT = 1
+PTHREAD_PRIO_PROTECT = 2
+
+class _pthread_mutex_t(Structure):
+    _fields_ = [("data",c_uint64*8)]
+
+class _pthread_mutexattr_t(Structure):
+    _fields_ = [("data",c_uint64*2)]
+
+class _timespec(Structure):
+    _fields_ = [("tv_sec",c_long),("tv_nsec",c_long)]
+
+
+if hasattr(pthread,"pthread_mutexattr_setprotocol"):
+
+    class PILock(PILock):
+
+        __doc__ = t2_base.PILock.__doc__
+
+        def __init__(self,ceiling=None):
+            self.__mutex = None
+            super(PILock,self).__init__(ceiling)
+            attr = _pthread_mutexattr_t()
+            res = pthread.pthread_mutexattr_init(byref(attr))
+            if res:
+                raise OSError(res,"pthread_mutexattr_init")
+            try:
+                res = pthread.pthread_mutexattr_settype(byref(attr),
+                                                   PTHREAD_MUTEX_ERRORCHECK)
+                if res:
+                    raise OSError(res,"pthread_mutexattr_settype")
+                if ceiling is None:
+                    protocol = PTHREAD_PRIO_INHERIT
+                else:
+                    protocol = PTHREAD_PRIO_PROTECT
+                res = pthread.pthread_mutexattr_setprotocol(byref(attr),
+                                                            protocol)
+                if res:
+                    raise OSError(res,"pthread_mutexattr_setprotocol")
+                if ceiling is not None:
+                    res = pthread.pthread_mutexattr_setprioceiling(byref(attr),
+                                                                 int(ceiling))
+                    if res:
+                        raise OSError(res,"pthread_mutexattr_setprioceiling")
+                mutex = _pthread_mutex_t()
+                res = pthread.pthread_mutex_init(byref(mutex),byref(attr))
+                if res:
+                    raise OSError(res,"pthread_mutex_init")
+                self.__mutex = mutex
+            finally:
+                pthread.pthread_mutexattr_destroy(byref(attr))
+
+        def __del__(self):
+            if self.__mutex is not None:
+                pthread.pthread_mutex_destroy(byref(self.__mutex))
+
+        def acquire(self,blocking=True,timeout=None):
+            if not blocking:
+                res = pthread.pthread_mutex_trylock(byref(self.__mutex))
+                if res in (errno.EBUSY,errno.EDEADLK,):
+                    return False
+                func = "pthread_mutex_trylock"
+            elif timeout is None:
+                res = pthread.pthread_mutex_lock(byref(self.__mutex))
+                func = "pthread_mutex_lock"
+            else:
+                endtime = _time() + max(timeout,0)
+                abstime = _timespec(int(endtime),
+                                    int((endtime - int(endtime)) * 1e9))
+                res = pthread.pthread_mutex_timedlock(byref(self.__mutex),
+                                                      byref(abstime))
+                if res in (errno.ETIMEDOUT,errno.EDEADLK,):
+                    return False
+                func = "pthread_mutex_timedlock"
+            if res == errno.EDEADLK:
+                raise RuntimeError("cannot acquire a PILock recursively")
+            if res:
+                raise OSError(res,func)
+            return True
+        acquire.__doc__ = Lock.acquire.__doc__
+
+        def release(self):
+            """Release this lock."""
+            res = pthread.pthread_mutex_unlock(byref(self.__mutex))
+            if res == errno.EPERM:
+                raise RuntimeError("cannot release un-acquired lock")
+            if res:
+                raise OSError(res,"pthread_mutex_unlock")
+
+
+    class PIRLock(PIRLock):
+        __doc__ = t2_base.PIRLock.__doc__
+        _LockClass = PILock
+
+
+    class PICondition(PICondition):
+        __doc__ = t2_base.PICondition.__doc__
+        _LockClass = PIRLock
+
+
 class Thread(Thread):
 
     if hasattr(pthread,"pthread_setpriority"):
@@ -123,69 +551,366 @@ class Thread(Thread):
                     raise OSError(res,"pthread_setpriority")
             return priority
 
+    elif _gettid is not None and hasattr(libc,"setpriority"):
+        def _set_priority(self,priority):
+            priority = super(Thread,self)._set_priority(priority)
+            #  Until before_run() has recorded the thread's id there is
+            #  nothing to apply it to; before_run() will apply it itself.
+            #  Passing None through would mean tid 0, the calling thread.
+            if self.native_id is None:
+                return priority
+            set_policy = self.sched_policy is None
+            _do_set_priority(self.native_id,priority,set_policy)
+            return priority
+
+    if _gettid is not None:
+        _current_native_id = staticmethod(_gettid)
+        def _set_sched_params(self,policy,priority,deadline):
+            #  As for _set_priority, before_run() will apply these once
+            #  the thread's id is known.
+            if self.native_id is None:
+                return
+            _do_set_sched_params(self.native_id,policy,priority,deadline)
+
+    if _gettid is not None and _ioprio_set is not None:
+        def _set_io_priority(self,io_priority):
+            io_priority = super(Thread,self)._set_io_priority(io_priority)
+            #  As for _set_priority, before_run() will apply this once
+            #  the thread's id is known.
+            if self.native_id is None:
+                return io_priority
+            _do_set_io_priority(self.native_id,io_priority)
+            return io_priority
+
+    if _gettid is not None:
+        def _read_stats(self):
+            tid = self.native_id
+            if tid is None:
+                return super(Thread,self)._read_stats()
+            return _do_get_stats(tid)
+
+        @staticmethod
+        def _get_thread_state():
+            try:
+                return _do_get_thread_state(_gettid(),_get_ident())
+            except OSError:
+                return None
+
+        def _reset_thread_state(self,state):
+            if state is None:
+                return False
+            try:
+                return _do_restore_thread_state(self.native_id,self.ident,
+                                                state)
+            except OSError:
+                return False
+
     if _do_set_affinity is not None:
         def _set_affinity(self,affinity):
             affinity = super(Thread,self)._set_affinity(affinity)
             me = self.ident
-            _do_set_affinity(me,affinity)
+            #  Only try to use the cpus that are currently online; the full
+            #  set will be re-applied if the others come back online.
+            online = _sysfs_cpus("online")
+            if online and not affinity.issubset(online):
+                #  Our cached view may predate a cpu coming online.
+                _cpu_info_cache.pop("sysfs_online",None)
+                online = _sysfs_cpus("online")
+            if online:
+                if not affinity & online:
+                    raise ValueError("no online cpus in %s" % (affinity,))
+                _do_set_affinity(me,affinity & online)
+            else:
+                _do_set_affinity(me,affinity)
             return affinity
 
 
-def system_affinity():
-    #  Try to read cpu info from /proc
+#  Locations from which to read cpu and cgroup information.  These are
+#  module-level variables so they can be pointed at fake trees for testing.
+_SYSFS_CPU_DIR = "/sys/devices/system/cpu"
+_PROC_CPUINFO = "/proc/cpuinfo"
+_CGROUP_ROOT = "/sys/fs/cgroup"
+_PROC_SELF_CGROUP = "/proc/self/cgroup"
+
+#  Information about the system's cpus is expensive to gather and rarely
+#  changes, so it's cached here until refresh_cpu_info() is called.
+_cpu_info_cache = {}
+
+
+def refresh_cpu_info():
+    _cpu_info_cache.clear()
+refresh_cpu_info.__doc__ = t2_base.refresh_cpu_info.__doc__
+
+
+def _read_file(path):
+    """Read the stripped contents of a small file, or None on error."""
+    try:
+        with open(path,"r") as f:
+            return f.read().strip()
+    except EnvironmentError:
+        return None
+
+
+def _cgroup_dirs(controller):
+    """Get the directories of the cgroup we belong to for a controller.
+
+    The directories are listed innermost first, ending at the root of
+    the hierarchy.  Both cgroup v1 and the v2 unified hierarchy are
+    supported.  If we are not in a cgroup then an empty list is returned.
+    """
+    paths = {}
+    for ln in (_read_file(_PROC_SELF_CGROUP) or "").splitlines():
+        try:
+            (_,controllers,path) = ln.split(":",2)
+        except ValueError:
+            continue
+        for name in controllers.split(","):
+            paths[name] = path
+    mounts = []
+    if controller in paths:
+        path = paths[controller]
+        try:
+            for name in os.listdir(_CGROUP_ROOT):
+                if controller in name.split(","):
+                    mounts.append(os.path.join(_CGROUP_ROOT,name))
+        except EnvironmentError:
+            pass
+    elif "" in paths:
+        path = paths[""]
+        for mount in (_CGROUP_ROOT,os.path.join(_CGROUP_ROOT,"unified")):
+            if os.path.exists(os.path.join(mount,"cgroup.controllers")):
+                mounts.append(mount)
+                break
+    dirs = []
+    for mount in mounts:
+        #  Inside a container our cgroup may be mounted as the root of the
+        #  hierarchy, in which case the path given in /proc won't exist.
+        #  Walking up the path until we find something sorts that out.
+        cur_path = path
+        while True:
+            dir = os.path.normpath(os.path.join(mount,cur_path.lstrip("/")))
+            if os.path.isdir(dir) and dir not in dirs:
+                dirs.append(dir)
+            if cur_path in ("","/"):
+                break
+            cur_path = os.path.dirname(cur_path)
+    return dirs
+
+
+def _cgroup_cpuset():
+    """Get the set of CPUs permitted by our cgroup, or None if unknown.
+
+    The result is cached, so callers must not modify it.
+    """
+    try:
+        return _cpu_info_cache["cgroup_cpuset"]
+    except KeyError:
+        pass
+    cpus = None
+    for dir in _cgroup_dirs("cpuset"):
+        for name in ("cpuset.cpus.effective","cpuset.effective_cpus",
+                     "cpuset.cpus",):
+            cpulist = _read_file(os.path.join(dir,name))
+            if cpulist:
+                try:
+                    cpus = CPUSet.from_cpulist(cpulist)
+                except ValueError:
+                    pass
+                else:
+                    break
+        if cpus is not None:
+            break
+    _cpu_info_cache["cgroup_cpuset"] = cpus
+    return cpus
+
+
+def _cgroup_cpu_quota():
+    """Get the CPU quota imposed by our cgroup, or None if unlimited.
+
+    The quota is given as a (possibly fractional) number of CPUs.  Limits
+    are inherited down the hierarchy, so this is the smallest quota found
+    in our cgroup or any of its ancestors.
+    """
     try:
-        with open("/proc/cpuinfo","r") as cpuinfo:
+        return _cpu_info_cache["cgroup_cpu_quota"]
+    except KeyError:
+        pass
+    quota = None
+    for dir in _cgroup_dirs("cpu"):
+        limit = _read_file(os.path.join(dir,"cpu.max"))
+        if limit is not None:
+            #  cgroup v2, e.g. "max 100000" or "50000 100000"
+            try:
+                (max,period) = limit.split()
+                if max == "max":
+                    continue
+                limit = float(max) / float(period)
+            except (ValueError,ZeroDivisionError):
+                continue
+        else:
+            #  cgroup v1, with -1 meaning unlimited
+            max = _read_file(os.path.join(dir,"cpu.cfs_quota_us"))
+            period = _read_file(os.path.join(dir,"cpu.cfs_period_us"))
+            try:
+                limit = float(max) / float(period)
+            except (TypeError,ValueError,ZeroDivisionError):
+                continue
+            if limit <= 0:
+                continue
+        if quota is None or limit < quota:
+            quota = limit
+    _cpu_info_cache["cgroup_cpu_quota"] = quota
+    return quota
+
+
+def _restrict_to_cgroup(affinity):
+    """Remove any CPUs not permitted by our cgroup from the given set."""
+    cgroup_cpus = _cgroup_cpuset()
+    if cgroup_cpus:
+        restricted = affinity & cgroup_cpus
+        if restricted:
+            return restricted
+    return affinity
+
+
+def _sysfs_cpus(name):
+    """Read a set of cpus from the named file in the sysfs cpu directory.
+
+    The result is cached, so callers must not modify it.  If the file does
+    not exist or cannot be parsed, None is returned.
+    """
+    key = "sysfs_" + name
+    try:
+        return _cpu_info_cache[key]
+    except KeyError:
+        pass
+    cpus = None
+    cpulist = _read_file(os.path.join(_SYSFS_CPU_DIR,name))
+    if cpulist is not None:
+        try:
+            cpus = CPUSet.from_cpulist(cpulist)
+        except ValueError:
+            #  e.g. nohz_full contains "(null)" when not in use.
+            pass
+    _cpu_info_cache[key] = cpus
+    return cpus
+
+
+def online_cpus():
+    online = _sysfs_cpus("online")
+    if online is None:
+        return system_affinity()
+    return online.copy()
+online_cpus.__doc__ = t2_base.online_cpus.__doc__
+
+
+def isolated_cpus():
+    isolated = CPUSet()
+    for name in ("isolated","nohz_full",):
+        cpus = _sysfs_cpus(name)
+        if cpus is not None:
+            isolated |= cpus
+    return isolated
+isolated_cpus.__doc__ = t2_base.isolated_cpus.__doc__
+
+
+def _read_system_affinity():
+    """Determine the set of CPUs available on this system, without caching."""
+    #  The kernel gives the online cpus in sysfs; fall back to the much
+    #  larger /proc/cpuinfo if that's not available.
+    online = _sysfs_cpus("online")
+    if online:
+        return _restrict_to_cgroup(online)
+    try:
+        with open(_PROC_CPUINFO,"r") as cpuinfo:
             affinity = CPUSet()
             for ln in cpuinfo:
                 info = ln.split()
                 if len(info) == 3:
                     if info[0] == "processor" and info[1] == ":":
                          affinity.add(info[2])
-            return affinity
+            if affinity:
+                return _restrict_to_cgroup(affinity)
     except EnvironmentError:
         pass
     #  Fall back to the process affinity
     return process_affinity()
+
+
+def system_affinity():
+    try:
+        affinity = _cpu_info_cache["system_affinity"]
+    except KeyError:
+        affinity = _read_system_affinity()
+        _cpu_info_cache["system_affinity"] = affinity
+    return affinity.copy()
 system_affinity.__doc__ = t2_base.system_affinity.__doc__
 
 
+def effective_cpu_capacity():
+    capacity = len(process_affinity())
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        capacity = min(capacity,int(math.ceil(quota)))
+    return max(capacity,1)
+effective_cpu_capacity.__doc__ = t2_base.effective_cpu_capacity.__doc__
+
+
 if hasattr(libc,"sched_setaffinity"):
 
     def _do_set_proc_affinity(pid,affinity):
-        if not _HAVE_ADJUSTED_CPUSET_SIZE:
-            _do_get_affinity(pid)
-        affinity = CPUSet(affinity)
-        print "AFFINITY", affinity
-        mask = _cpuset()
-        bitmask = affinity.to_bitmask()
-        chunkmask = 2**(8*sizeof(_cpuset_bits_t))-1
-        for i in xrange(_CPUSET_SIZE):
-            mask.bits[i] = bitmask & chunkmask
-            bitmask = bitmask >> (8*sizeof(_cpuset_bits_t))
+        mask = _cpuset_from_cpus(affinity,_cpuset_size())
         if libc.sched_setaffinity(pid,sizeof(mask),byref(mask)) < 0:
             raise OSError(get_errno(),"sched_setaffinity")
 
     def _do_get_proc_affinity(pid):
-        global _HAVE_ADJUSTED_CPUSET_SIZE
-        _HAVE_ADJUSTED_CPUSET_SIZE = True
-        mask = _cpuset()
-        if libc.sched_getaffinity(pid,sizeof(mask),byref(mask)) < 0:
-            eno = get_errno()
-            if eno == errno.EINVAL and _CPUSET_SIZE < _MAX_CPUSET_SIZE:
-                _incr_cpuset_size()
-                return _do_get_affinity(pid)
-            raise OSError(eno,"sched_getaffinity")
-        intmask = 0
-        shift = 8*sizeof(_cpuset_bits_t)
-        for i in xrange(len(mask.bits)):
-            intmask |= mask.bits[i] << (i*shift)
-        return CPUSet(intmask)
+        def getter(size,mask):
+            if libc.sched_getaffinity(pid,size,byref(mask)) < 0:
+                return get_errno()
+            return 0
+        try:
+            return _cpus_from_cpuset(_get_cpuset(getter))
+        except OSError, e:
+            raise OSError(e.errno,"sched_getaffinity")
 
     def process_affinity(affinity=None):
         pid = os.getpid()
         if affinity is not None:
             _do_set_proc_affinity(pid,affinity)
-        return _do_get_proc_affinity(pid)
+        return _restrict_to_cgroup(_do_get_proc_affinity(pid))
     process_affinity.__doc__ = t2_base.process_affinity.__doc__
 
+else:
+    _do_set_proc_affinity = None
+    _do_get_proc_affinity = None
+
+
+if hasattr(libc,"sched_getcpu"):
+
+    def current_cpu():
+        cpu = libc.sched_getcpu()
+        if cpu < 0:
+            return None
+        return cpu
+    current_cpu.__doc__ = t2_base.current_cpu.__doc__
+
+    class _CPUShardedMixin(t2_base._CPUShardedMixin):
+        """Mixin using sched_getcpu() to find the slot for each thread."""
+
+        #  sched_getcpu() returns -1 on error, which maps to the last slot.
+        _current_cpu = libc.sched_getcpu
+
+        @staticmethod
+        def _num_slots():
+            return max(system_affinity()) + 1
+
+    class cpu_local(_CPUShardedMixin,cpu_local):
+        __doc__ = t2_base.cpu_local.__doc__
+
+    class ShardedAccumulator(_CPUShardedMixin,ShardedAccumulator):
+        __doc__ = t2_base.ShardedAccumulator.__doc__
 
+    #  Derive from our own ShardedAccumulator, so that the class hierarchy
+    #  matches that of the base implementation.
+    class ShardedCounter(ShardedAccumulator,t2_base.ShardedCounter):
+        __doc__ = t2_base.ShardedCounter.__doc__
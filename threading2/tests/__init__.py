@@ -7,6 +7,19 @@ import unittest
 import doctest
 import random
 import time
+import errno
+import pickle
+import shutil
+import tempfile
+import subprocess
+import select
+import signal
+import traceback
+import ctypes
+import gc
+import weakref
+import thread
+import threading
 
 import threading2
 from threading2 import *
@@ -54,6 +67,25 @@ class TestSHLock(unittest.TestCase):
             print done, threads
             raise RuntimeError("SHLock test error")
 
+    def test_exclusive_timeout(self):
+        #  Shared locks queued behind a timed-out exclusive lock must
+        #  not be left waiting.
+        lock = SHLock()
+        lock.acquire(shared=True)
+        results = []
+        exclusive = Thread(target=lambda: results.append(
+                                             lock.acquire(timeout=0.1)))
+        exclusive.start()
+        time.sleep(0.02)
+        shared = Thread(target=lambda: results.append(
+                                             lock.acquire(shared=True)))
+        shared.daemon = True
+        shared.start()
+        exclusive.join()
+        shared.join(5)
+        self.assertEquals(results,[False,True])
+        self.assertEquals(lock.is_shared,2)
+
 class TestSHLockContext(unittest.TestCase):
     class TestPassed(Exception): pass
 
@@ -139,6 +171,2527 @@ class TestCPUSet(unittest.TestCase):
         self.assertEquals(CPUSet("012").to_bitmask(),7)
         for i in xrange(100):
             self.assertEquals(CPUSet(i).to_bitmask(),i)
+        self.assertEquals(CPUSet([383]).to_bitmask(),1 << 383)
+
+    def test_cpulist(self):
+        self.assertEquals(CPUSet.from_cpulist(""),CPUSet())
+        self.assertEquals(CPUSet.from_cpulist("0\n"),CPUSet([0]))
+        self.assertEquals(CPUSet.from_cpulist("0-3,8-11"),
+                          CPUSet([0,1,2,3,8,9,10,11]))
+        self.assertEquals(CPUSet.from_cpulist("5,1-2,383"),
+                          CPUSet([1,2,5,383]))
+        self.assertRaises(ValueError,CPUSet.from_cpulist,"3-1")
+        self.assertRaises(ValueError,CPUSet.from_cpulist,"0-x")
+        self.assertEquals(CPUSet().to_cpulist(),"")
+        self.assertEquals(CPUSet([7]).to_cpulist(),"7")
+        self.assertEquals(CPUSet([0,2,3,4,7,8]).to_cpulist(),"0,2-4,7-8")
+        self.assertEquals(CPUSet(xrange(384)).to_cpulist(),"0-383")
+        for i in xrange(300):
+            cpus = CPUSet(random.getrandbits(64))
+            self.assertEquals(CPUSet.from_cpulist(cpus.to_cpulist()),cpus)
+
+    def test_set_operations(self):
+        a = CPUSet([0,1,2,3,200])
+        b = CPUSet([2,3,4,200,300])
+        self.assertEquals(len(a),5)
+        self.assertEquals(list(a),[0,1,2,3,200])
+        self.assertTrue(200 in a)
+        self.assertFalse(300 in a)
+        self.assertFalse(-1 in a)
+        self.assertEquals(a | b,CPUSet([0,1,2,3,4,200,300]))
+        self.assertEquals(a & b,CPUSet([2,3,200]))
+        self.assertEquals(a - b,CPUSet([0,1]))
+        self.assertEquals(a ^ b,CPUSet([0,1,4,300]))
+        self.assertEquals(a.union([7],b),CPUSet([0,1,2,3,4,7,200,300]))
+        self.assertEquals(a.intersection(b,[3]),CPUSet([3]))
+        self.assertEquals(a.difference(b,[0]),CPUSet([1]))
+        self.assertTrue(CPUSet([2,3]).issubset(a))
+        self.assertTrue(a.issuperset([0,200]))
+        self.assertTrue(a.isdisjoint([5,6]))
+        self.assertTrue(CPUSet([2,3]) < a)
+        self.assertFalse(a < a)
+        self.assertTrue(a <= a)
+        c = a.copy()
+        c |= b
+        c -= set([300])
+        self.assertEquals(c,CPUSet([0,1,2,3,4,200]))
+        self.assertEquals(a,CPUSet([0,1,2,3,200]))
+        c.discard(4)
+        c.discard(4)
+        c.remove(200)
+        self.assertRaises(KeyError,c.remove,200)
+        self.assertEquals(c.pop(),0)
+        c.clear()
+        self.assertFalse(c)
+        self.assertRaises(KeyError,c.pop)
+        self.assertRaises(ValueError,c.add,-1)
+
+    def test_builtin_set_compatibility(self):
+        a = CPUSet([1,2,3])
+        self.assertEquals(a,set([1,2,3]))
+        self.assertEquals(set([1,2,3]),a)
+        self.assertNotEquals(a,set([1,2]))
+        self.assertNotEquals(a,set(["a"]))
+        self.assertEquals(set([3,4]) | a,CPUSet([1,2,3,4]))
+        self.assertEquals(set([3,4]) - a,CPUSet([4]))
+        self.assertTrue(isinstance(set([3,4]) & a,CPUSet))
+        self.assertEquals(a & frozenset([3,4]),CPUSet([3]))
+        self.assertTrue(set([1]) <= a)
+        self.assertEquals(sorted(set(a)),[1,2,3])
+        self.assertRaises(TypeError,hash,a)
+        self.assertEquals(pickle.loads(pickle.dumps(a)),a)
+
+if sys.platform != "win32":
+    try:
+        from threading2 import t2_posix
+    except ImportError:
+        t2_posix = None
+else:
+    t2_posix = None
+
+
+class TestPosixAffinity(unittest.TestCase):
+    """Testcases for affinity handling on posix platforms."""
+
+    def setUp(self):
+        if t2_posix is None or t2_posix._do_get_proc_affinity is None:
+            raise unittest.SkipTest("posix affinity functions not available")
+
+    def test_large_cpuset_roundtrip(self):
+        bits = t2_posix._CPUSET_WORD_BITS
+        cpus = CPUSet([0,1,63,64,127,255,256,383,1023])
+        mask = t2_posix._cpuset_from_cpus(cpus,1024 // bits)
+        self.assertEquals(len(mask),1024 // bits)
+        self.assertEquals(mask[383 // bits],1 << (383 % bits))
+        self.assertEquals(t2_posix._cpus_from_cpuset(mask),cpus)
+        cpus = CPUSet(xrange(384))
+        mask = t2_posix._cpuset_from_cpus(cpus,1024 // bits)
+        self.assertEquals(t2_posix._cpus_from_cpuset(mask),cpus)
+
+    def test_cpuset_too_small(self):
+        bits = t2_posix._CPUSET_WORD_BITS
+        self.assertRaises(ValueError,t2_posix._cpuset_from_cpus,
+                          CPUSet([4*bits]),4)
+
+    def test_cpuset_size_probing(self):
+        #  Simulate a kernel configured for 4096 cpus, with cpu 383 online.
+        bits = t2_posix._CPUSET_WORD_BITS
+        calls = []
+        def getter(size,mask):
+            calls.append(size)
+            if size < 4096 // 8:
+                return errno.EINVAL
+            mask[383 // bits] = 1 << (383 % bits)
+            return 0
+        old_size = t2_posix._CPUSET_SIZE
+        t2_posix._CPUSET_SIZE = None
+        try:
+            mask = t2_posix._get_cpuset(getter)
+            self.assertEquals(t2_posix._CPUSET_SIZE,4096 // bits)
+            self.assertEquals(t2_posix._cpus_from_cpuset(mask),CPUSet([383]))
+            self.assertEquals(calls,[128,256,512])
+            #  Once probed, the size is cached and used directly.
+            del calls[:]
+            t2_posix._get_cpuset(getter)
+            self.assertEquals(calls,[512])
+        finally:
+            t2_posix._CPUSET_SIZE = old_size
+
+    def test_cpuset_size_probing_error(self):
+        def getter(size,mask):
+            return errno.EINVAL
+        old_size = t2_posix._CPUSET_SIZE
+        t2_posix._CPUSET_SIZE = None
+        try:
+            self.assertRaises(OSError,t2_posix._get_cpuset,getter)
+            self.assertEquals(t2_posix._CPUSET_SIZE,None)
+        finally:
+            t2_posix._CPUSET_SIZE = old_size
+
+    def test_process_affinity(self):
+        affinity = process_affinity()
+        self.assertTrue(affinity)
+        self.assertEquals(process_affinity(affinity),affinity)
+
+    def test_thread_affinity(self):
+        if t2_posix._do_set_affinity is None:
+            raise unittest.SkipTest("thread affinity not available")
+        affinity = CPUSet([max(process_affinity())])
+        seen = []
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+            seen.append(t2_posix._do_get_affinity(t.ident))
+        t = Thread(target=target,affinity=affinity)
+        t.start()
+        ready.wait(10)
+        t.affinity = process_affinity()
+        done.set()
+        t.join()
+        self.assertEquals(seen,[process_affinity()])
+
+
+class FakeSysTestCase(unittest.TestCase):
+    """Base class for testcases that use a fake /sys and /proc tree."""
+
+    def setUp(self):
+        if t2_posix is None:
+            raise unittest.SkipTest("posix functions not available")
+        self.tempdir = tempfile.mkdtemp()
+        self.old_paths = {}
+        for (name,path) in (("_SYSFS_CPU_DIR","sys_cpu"),
+                            ("_PROC_CPUINFO","cpuinfo"),
+                            ("_CGROUP_ROOT","cgroup"),
+                            ("_PROC_SELF_CGROUP","proc_cgroup"),):
+            self.old_paths[name] = getattr(t2_posix,name)
+            setattr(t2_posix,name,os.path.join(self.tempdir,path))
+        refresh_cpu_info()
+
+    def tearDown(self):
+        for (name,path) in self.old_paths.iteritems():
+            setattr(t2_posix,name,path)
+        shutil.rmtree(self.tempdir)
+        refresh_cpu_info()
+
+    def write_file(self,path,contents):
+        path = os.path.join(self.tempdir,path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path,"w") as f:
+            f.write(contents)
+        refresh_cpu_info()
+
+
+class TestCgroups(FakeSysTestCase):
+    """Testcases for cgroup detection, using fake cgroup trees."""
+
+    def test_no_cgroups(self):
+        self.assertEquals(t2_posix._cgroup_cpuset(),None)
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),None)
+
+    def test_cgroup_v2(self):
+        self.write_file("proc_cgroup","0::/kubepods/pod1/ctr\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/kubepods/cpu.max","400000 100000\n")
+        self.write_file("cgroup/kubepods/pod1/cpu.max","max 100000\n")
+        self.write_file("cgroup/kubepods/pod1/ctr/cpu.max","250000 100000\n")
+        self.write_file("cgroup/kubepods/pod1/ctr/cpuset.cpus.effective",
+                        "2-3,8\n")
+        self.assertEquals(t2_posix._cgroup_cpuset(),CPUSet([2,3,8]))
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),2.5)
+        self.write_file("cgroup/kubepods/cpu.max","150000 100000\n")
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),1.5)
+
+    def test_cgroup_v2_unlimited(self):
+        self.write_file("proc_cgroup","0::/\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpu.max","max 100000\n")
+        self.assertEquals(t2_posix._cgroup_cpuset(),None)
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),None)
+
+    def test_cgroup_v2_namespaced(self):
+        #  Our cgroup is mounted as the root, so the path doesn't exist.
+        self.write_file("proc_cgroup","0::/docker/abcdef\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpu.max","50000 100000\n")
+        self.write_file("cgroup/cpuset.cpus.effective","1\n")
+        self.assertEquals(t2_posix._cgroup_cpuset(),CPUSet([1]))
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),0.5)
+
+    def test_cgroup_v1(self):
+        self.write_file("proc_cgroup","5:cpuset:/docker/abc\n"
+                                      "3:cpu,cpuacct:/docker/abc\n"
+                                      "1:name=systemd:/docker/abc\n")
+        self.write_file("cgroup/cpuset/docker/abc/cpuset.effective_cpus",
+                        "0-5\n")
+        self.write_file("cgroup/cpu,cpuacct/docker/abc/cpu.cfs_quota_us",
+                        "300000\n")
+        self.write_file("cgroup/cpu,cpuacct/docker/abc/cpu.cfs_period_us",
+                        "100000\n")
+        self.write_file("cgroup/cpu,cpuacct/cpu.cfs_quota_us","-1\n")
+        self.write_file("cgroup/cpu,cpuacct/cpu.cfs_period_us","100000\n")
+        self.assertEquals(t2_posix._cgroup_cpuset(),CPUSet(xrange(6)))
+        self.assertEquals(t2_posix._cgroup_cpu_quota(),3.0)
+
+    def test_effective_cpu_capacity(self):
+        self.assertEquals(effective_cpu_capacity(),len(process_affinity()))
+        self.write_file("proc_cgroup","0::/\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpu.max","10000 100000\n")
+        self.assertEquals(effective_cpu_capacity(),1)
+
+    def test_affinity_restricted_to_cgroup(self):
+        cpus = process_affinity()
+        self.write_file("proc_cgroup","0::/\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpuset.cpus.effective","%d\n" % (max(cpus),))
+        self.assertEquals(process_affinity(),CPUSet([max(cpus)]))
+        self.assertEquals(system_affinity(),CPUSet([max(cpus)]))
+
+
+class TestSystemAffinity(FakeSysTestCase):
+    """Testcases for reading and caching system cpu information."""
+
+    def test_sysfs_online(self):
+        self.write_file("sys_cpu/online","0-383\n")
+        self.write_file("cpuinfo","processor\t: 0\n")
+        self.assertEquals(system_affinity(),CPUSet(xrange(384)))
+
+    def test_proc_cpuinfo(self):
+        self.write_file("cpuinfo","processor\t: 0\nflags\t: fpu\n\n"
+                                  "processor\t: 1\nflags\t: fpu\n\n")
+        self.assertEquals(system_affinity(),CPUSet([0,1]))
+
+    def test_fallback_to_process_affinity(self):
+        self.assertEquals(system_affinity(),process_affinity())
+
+    def test_caching(self):
+        self.write_file("sys_cpu/online","0-7\n")
+        affinity = system_affinity()
+        self.assertEquals(affinity,CPUSet(xrange(8)))
+        #  Modifying the result must not affect the cache.
+        affinity.add(8)
+        self.assertEquals(system_affinity(),CPUSet(xrange(8)))
+        #  Changes are not seen until the cache is refreshed.
+        with open(os.path.join(self.tempdir,"sys_cpu/online"),"w") as f:
+            f.write("0-3\n")
+        self.assertEquals(system_affinity(),CPUSet(xrange(8)))
+        refresh_cpu_info()
+        self.assertEquals(system_affinity(),CPUSet(xrange(4)))
+
+    def test_restricted_to_cgroup(self):
+        self.write_file("sys_cpu/online","0-7\n")
+        self.write_file("proc_cgroup","0::/\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpuset.cpus.effective","2-3\n")
+        self.assertEquals(system_affinity(),CPUSet([2,3]))
+
+
+class TestCPUHotplug(FakeSysTestCase):
+    """Testcases for online/isolated cpus and the hotplug watcher."""
+
+    def test_online_and_isolated_cpus(self):
+        self.write_file("sys_cpu/online","0-3\n")
+        self.write_file("sys_cpu/isolated","\n")
+        self.write_file("sys_cpu/nohz_full","(null)\n")
+        self.assertEquals(online_cpus(),CPUSet([0,1,2,3]))
+        self.assertEquals(isolated_cpus(),CPUSet())
+        self.write_file("sys_cpu/isolated","2\n")
+        self.write_file("sys_cpu/nohz_full","2-3\n")
+        self.assertEquals(isolated_cpus(),CPUSet([2,3]))
+
+    def test_online_cpus_include_cgroup_exclusions(self):
+        self.write_file("sys_cpu/online","0-3\n")
+        self.write_file("proc_cgroup","0::/\n")
+        self.write_file("cgroup/cgroup.controllers","cpuset cpu\n")
+        self.write_file("cgroup/cpuset.cpus.effective","1\n")
+        self.assertEquals(online_cpus(),CPUSet([0,1,2,3]))
+        self.assertEquals(system_affinity(),CPUSet([1]))
+
+    def test_offline_affinity(self):
+        if t2_posix._do_set_affinity is None:
+            raise unittest.SkipTest("thread affinity not available")
+        cpu = max(process_affinity())
+        self.write_file("sys_cpu/online","%d\n" % (cpu,))
+        errors = []
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+        t = Thread(target=target)
+        t.start()
+        try:
+            ready.wait(10)
+            try:
+                t.affinity = [cpu + 1]
+            except ValueError:
+                pass
+            else:
+                errors.append("offline cpu accepted")
+            t.affinity = [cpu,cpu + 1]
+            self.assertEquals(t.affinity,CPUSet([cpu,cpu + 1]))
+            self.assertEquals(t2_posix._do_get_affinity(t.ident),
+                              CPUSet([cpu]))
+        finally:
+            done.set()
+            t.join()
+        self.assertEquals(errors,[])
+
+    def test_affinity_rereads_online_cpus(self):
+        if t2_posix._do_set_affinity is None:
+            raise unittest.SkipTest("thread affinity not available")
+        cpu = max(process_affinity())
+        self.write_file("sys_cpu/online","%d\n" % (cpu + 1,))
+        self.assertEquals(online_cpus(),CPUSet([cpu + 1]))
+        #  The cpu comes online without the cache being refreshed.
+        with open(os.path.join(self.tempdir,"sys_cpu/online"),"w") as f:
+            f.write("%d\n" % (cpu,))
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+        t = Thread(target=target)
+        t.start()
+        try:
+            ready.wait(10)
+            t.affinity = [cpu]
+            self.assertEquals(t2_posix._do_get_affinity(t.ident),
+                              CPUSet([cpu]))
+            self.assertEquals(online_cpus(),CPUSet([cpu]))
+        finally:
+            done.set()
+            t.join()
+
+    def test_hotplug_watcher(self):
+        self.write_file("sys_cpu/online","0-3\n")
+        changes = []
+        def callback(old,new):
+            changes.append((old,new))
+        watcher = CPUHotplugWatcher(callback=callback)
+        self.assertFalse(watcher.check())
+        self.write_file("sys_cpu/online","0-1\n")
+        self.assertTrue(watcher.check())
+        self.assertEquals(changes,[(CPUSet(xrange(4)),CPUSet(xrange(2)))])
+        self.assertFalse(watcher.check())
+
+    def test_hotplug_watcher_reapplies_affinity(self):
+        if t2_posix._do_set_affinity is None:
+            raise unittest.SkipTest("thread affinity not available")
+        cpu = max(process_affinity())
+        self.write_file("sys_cpu/online","%d\n" % (cpu,))
+        watcher = CPUHotplugWatcher(interval=0.01)
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+        group = ThreadGroup()
+        t = Thread(target=target,group=group)
+        t.start()
+        try:
+            ready.wait(10)
+            group.affinity = [cpu,cpu + 1]
+            applied = []
+            def do_set_affinity(tid,affinity):
+                applied.append(affinity)
+            old_do_set_affinity = t2_posix._do_set_affinity
+            t2_posix._do_set_affinity = do_set_affinity
+            try:
+                watcher.start()
+                self.write_file("sys_cpu/online","%d-%d\n" % (cpu,cpu + 1))
+                for _ in xrange(1000):
+                    if applied:
+                        break
+                    time.sleep(0.01)
+            finally:
+                watcher.stop()
+                watcher.join()
+                t2_posix._do_set_affinity = old_do_set_affinity
+            self.assertTrue(CPUSet([cpu,cpu + 1]) in applied)
+        finally:
+            done.set()
+            t.join()
+
+
+def can_raise_nice(nice):
+    """Check whether we could move a thread at nice 19 back to "nice"."""
+    if os.geteuid() == 0:
+        return True
+    try:
+        with open("/proc/self/limits","r") as f:
+            for line in f:
+                if line.startswith("Max nice priority"):
+                    return 20 - int(line.split()[3]) <= nice
+    except (EnvironmentError,ValueError):
+        pass
+    return False
+
+
+def read_task_stat(tid):
+    """Read the fields of /proc/self/task/<tid>/stat, indexed from one."""
+    with open("/proc/self/task/%d/stat" % (tid,),"r") as f:
+        data = f.read()
+    (pid,rest) = data.split(" (",1)
+    (comm,rest) = rest.rsplit(") ",1)
+    return [None,pid,comm] + rest.split()
+
+
+class DelayedThread(Thread):
+    """Thread that is alive, but has not yet run before_run(), until told."""
+
+    def __init__(self,*args,**kwds):
+        self.proceed = Event()
+        super(DelayedThread,self).__init__(*args,**kwds)
+
+    def before_run(self):
+        self.proceed.wait(10)
+        super(DelayedThread,self).before_run()
+
+
+class TestLinuxPriority(unittest.TestCase):
+    """Testcases for thread priorities on linux."""
+
+    def setUp(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+
+    def run_with_priority(self,priority,new_priority=None):
+        """Run a thread with the given priority, returning (nice,policy)."""
+        results = []
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+            stat = read_task_stat(t.native_id)
+            results.append((int(stat[19]),int(stat[41])))
+        t = Thread(target=target,priority=priority)
+        t.start()
+        ready.wait(10)
+        if new_priority is not None:
+            t.priority = new_priority
+        done.set()
+        t.join()
+        return results[0]
+
+    def test_native_id(self):
+        ids = []
+        t = Thread(target=lambda: ids.append(t2_posix._gettid()))
+        self.assertEquals(t.native_id,None)
+        t.start()
+        t.join()
+        self.assertEquals(ids,[t.native_id])
+        self.assertNotEquals(t.native_id,os.getpid())
+
+    def test_low_priorities(self):
+        self.assertEquals(self.run_with_priority(0.5),(0,t2_posix.SCHED_OTHER))
+        self.assertEquals(self.run_with_priority(0.3),(8,t2_posix.SCHED_OTHER))
+        self.assertEquals(self.run_with_priority(0.1),(15,t2_posix.SCHED_BATCH))
+        self.assertEquals(self.run_with_priority(0),(19,t2_posix.SCHED_IDLE))
+
+    def test_high_priority(self):
+        (nice,policy) = self.run_with_priority(1)
+        self.assertEquals(policy,t2_posix.SCHED_OTHER)
+        #  Only privileged processes can raise their priority.
+        self.assertTrue(nice in (-20,0))
+
+    def test_change_priority_while_running(self):
+        self.assertEquals(self.run_with_priority(0.5,0.1),
+                          (15,t2_posix.SCHED_BATCH))
+
+    def test_set_priority_before_run(self):
+        me = t2_posix._gettid()
+        before = read_task_stat(me)[19]
+        results = []
+        def target():
+            results.append(int(read_task_stat(t.native_id)[19]))
+        t = DelayedThread(target=target)
+        t.start()
+        self.assertTrue(t.is_alive())
+        self.assertEquals(t.native_id,None)
+        t.priority = 0.3
+        #  Must not have been applied to the calling thread instead.
+        self.assertEquals(read_task_stat(me)[19],before)
+        t.proceed.set()
+        t.join()
+        self.assertEquals(results,[8])
+
+    def test_group_priority(self):
+        results = []
+        ready = Semaphore(0)
+        done = Event()
+        def target():
+            ready.release()
+            done.wait(10)
+            me = current_thread()
+            results.append(int(read_task_stat(me.native_id)[19]))
+        group = ThreadGroup()
+        threads = [Thread(target=target,group=group) for _ in xrange(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            ready.acquire()
+        group.priority = 0.25
+        done.set()
+        group.join()
+        self.assertEquals(results,[10,10,10])
+
+
+class TestSchedPolicy(unittest.TestCase):
+    """Testcases for explicit scheduling policies."""
+
+    def run_with_policy(self,group=None,**kwds):
+        """Run a thread with the given policy, returning (policy,rtprio)."""
+        results = []
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+            if t.native_id is not None:
+                stat = read_task_stat(t.native_id)
+                results.append((int(stat[41]),int(stat[40])))
+            else:
+                results.append(None)
+        t = Thread(target=target,group=group,**kwds)
+        t.start()
+        ready.wait(10)
+        return (t,done,results)
+
+    def test_validation(self):
+        self.assertRaises(ValueError,Thread,sched_policy=42)
+        self.assertRaises(ValueError,Thread,sched_policy=SCHED_DEADLINE)
+        self.assertRaises(ValueError,Thread,sched_priority=-1)
+        self.assertRaises(ValueError,Thread,sched_deadline=(2,1,1))
+        t = Thread(sched_policy=SCHED_DEADLINE,sched_deadline=(1,2,3))
+        self.assertEquals(t.sched_deadline,(1.0,2.0,3.0))
+        self.assertRaises(ValueError,setattr,t,"sched_deadline",None)
+
+    def test_batch_and_idle(self):
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_BATCH)
+        done.set()
+        t.join()
+        if results == [None]:
+            raise unittest.SkipTest("scheduling policies not supported")
+        self.assertEquals(results,[(SCHED_BATCH,0)])
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_BATCH)
+        t.sched_policy = SCHED_IDLE
+        done.set()
+        t.join()
+        self.assertEquals(results,[(SCHED_IDLE,0)])
+
+    def test_policy_overrides_priority(self):
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_OTHER,
+                                                priority=0)
+        done.set()
+        t.join()
+        if results == [None]:
+            raise unittest.SkipTest("scheduling policies not supported")
+        self.assertEquals(results,[(SCHED_OTHER,0)])
+
+    def test_realtime(self):
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_FIFO,
+                                                sched_priority=10)
+        t.sched_priority = 20
+        done.set()
+        t.join()
+        if results == [None]:
+            raise unittest.SkipTest("scheduling policies not supported")
+        #  Without the necessary privileges, the policy is left unchanged.
+        self.assertTrue(results[0] in ((SCHED_FIFO,20),(SCHED_OTHER,0)))
+
+    def test_reset_policy(self):
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_BATCH)
+        t.sched_policy = None
+        done.set()
+        t.join()
+        if results == [None]:
+            raise unittest.SkipTest("scheduling policies not supported")
+        self.assertEquals(results,[(SCHED_OTHER,0)])
+        #  The thread's priority decides the policy once again.
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_OTHER,
+                                                priority=0.1)
+        t.sched_policy = None
+        done.set()
+        t.join()
+        self.assertEquals(results,[(SCHED_BATCH,0)])
+
+    def test_set_policy_before_run(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        me = t2_posix._gettid()
+        before = read_task_stat(me)[41]
+        results = []
+        def target():
+            results.append(int(read_task_stat(t.native_id)[41]))
+        t = DelayedThread(target=target)
+        t.start()
+        self.assertEquals(t.native_id,None)
+        t.sched_policy = SCHED_BATCH
+        #  Must not have been applied to the calling thread instead.
+        self.assertEquals(read_task_stat(me)[41],before)
+        t.proceed.set()
+        t.join()
+        self.assertEquals(results,[SCHED_BATCH])
+
+    def test_group_policy(self):
+        group = ThreadGroup()
+        runs = [self.run_with_policy(group=group) for _ in xrange(3)]
+        group.sched_priority = 5
+        group.sched_policy = SCHED_RR
+        self.assertEquals(group.sched_policy,SCHED_RR)
+        for (t,done,results) in runs:
+            self.assertEquals(t.sched_policy,SCHED_RR)
+            self.assertEquals(t.sched_priority,5)
+            done.set()
+            t.join()
+            if results == [None]:
+                raise unittest.SkipTest("scheduling policies not supported")
+            self.assertTrue(results[0] in ((SCHED_RR,5),(SCHED_OTHER,0)))
+
+    def test_group_policy_rollback(self):
+        group = ThreadGroup()
+        t1 = Thread(group=group,sched_deadline=(1,2,3))
+        t2 = Thread(group=group)
+        self.assertRaises(ValueError,setattr,group,"sched_policy",
+                          SCHED_DEADLINE)
+        self.assertEquals(group.sched_policy,None)
+        self.assertEquals(t1.sched_policy,None)
+        self.assertEquals(t2.sched_policy,None)
+
+    def test_deadline(self):
+        if t2_posix is None or t2_posix._sched_setattr is None:
+            raise unittest.SkipTest("SCHED_DEADLINE not supported")
+        (t,done,results) = self.run_with_policy(sched_policy=SCHED_DEADLINE,
+                                        sched_deadline=(0.001,0.01,0.01))
+        done.set()
+        t.join()
+        self.assertTrue(results[0] in ((SCHED_DEADLINE,0),(SCHED_OTHER,0)))
+
+
+class TestPILock(unittest.TestCase):
+    """Testcases for priority-inheritance locks."""
+
+    def test_basic(self):
+        lock = PILock()
+        self.assertTrue(lock.acquire())
+        self.assertFalse(lock.acquire(False))
+        self.assertFalse(lock.acquire(timeout=0.01))
+        results = []
+        t = Thread(target=lambda: results.append(lock.acquire(timeout=0.01)))
+        t.start()
+        t.join()
+        self.assertEquals(results,[False])
+        lock.release()
+        with lock:
+            pass
+        self.assertRaises(RuntimeError,lock.release)
+
+    def test_class_hierarchy(self):
+        lock = PILock()
+        self.assertTrue(isinstance(lock,threading2.t2_base.PILock))
+        self.assertTrue(isinstance(lock,Lock))
+        self.assertTrue(isinstance(PIRLock(),RLock))
+        self.assertTrue(isinstance(PICondition(),Condition))
+
+    def test_rlock_and_condition(self):
+        lock = PIRLock()
+        with lock:
+            with lock:
+                pass
+        cond = PICondition()
+        results = []
+        def waiter():
+            with cond:
+                results.append(cond.wait(10))
+        t = Thread(target=waiter)
+        with cond:
+            t.start()
+            self.assertFalse(cond.wait(0.01))
+        for _ in xrange(1000):
+            with cond:
+                cond.notify()
+            if results:
+                break
+            time.sleep(0.01)
+        t.join()
+        self.assertEquals(results,[True])
+
+    def test_as_lock_class(self):
+        class PISHLock(SHLock):
+            _LockClass = PILock
+        lock = PISHLock()
+        lock.acquire(shared=True)
+        lock.acquire(shared=True)
+        lock.release()
+        lock.release()
+        lock.acquire()
+        lock.release()
+
+    def check_inversion(self,lock):
+        """Check whether a low-priority holder of the lock gets boosted.
+
+        A SCHED_OTHER thread takes the lock, then a SCHED_FIFO thread blocks
+        trying to acquire it.  We return the kernel priority of the holder
+        while the high-priority thread is waiting.
+        """
+        results = {}
+        held = Event()
+        done = Event()
+        def low():
+            with lock:
+                held.set()
+                done.wait(10)
+        def high():
+            stat = read_task_stat(current_thread().native_id)
+            results["high_policy"] = int(stat[41])
+            with lock:
+                pass
+        tlow = Thread(target=low)
+        thigh = Thread(target=high,sched_policy=SCHED_FIFO,sched_priority=50)
+        tlow.start()
+        try:
+            held.wait(10)
+            results["before"] = int(read_task_stat(tlow.native_id)[18])
+            thigh.start()
+            for _ in xrange(100):
+                time.sleep(0.01)
+                results["during"] = int(read_task_stat(tlow.native_id)[18])
+                if results["during"] != results["before"]:
+                    break
+        finally:
+            done.set()
+            tlow.join()
+            thigh.join()
+        if results.get("high_policy") != SCHED_FIFO:
+            raise unittest.SkipTest("unable to use realtime priorities")
+        return results
+
+    def test_priority_inversion(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        if not hasattr(t2_posix.pthread,"pthread_mutexattr_setprotocol"):
+            raise unittest.SkipTest("priority inheritance not available")
+        #  With a standard lock, the holder keeps its normal priority
+        #  and can be starved by medium-priority threads.
+        results = self.check_inversion(Lock())
+        self.assertEquals(results["during"],results["before"])
+        #  With a PILock, it inherits the priority of the waiting thread.
+        #  The kernel reports a SCHED_FIFO priority of p as -1-p.
+        results = self.check_inversion(PILock())
+        self.assertTrue(results["before"] >= 0)
+        self.assertEquals(results["during"],-51)
+
+
+class TestIOPriority(unittest.TestCase):
+    """Testcases for per-thread I/O priorities."""
+
+    def setUp(self):
+        if t2_posix is None or t2_posix._ioprio_get is None:
+            raise unittest.SkipTest("ioprio_get not available")
+
+    def run_with_io_priority(self,group=None,**kwds):
+        """Run a thread, returning the I/O priority it sees via ioprio_get."""
+        results = []
+        ready = Event()
+        done = Event()
+        def target():
+            ready.set()
+            done.wait(10)
+            results.append(t2_posix._do_get_io_priority(t.native_id))
+        t = Thread(target=target,group=group,**kwds)
+        t.start()
+        ready.wait(10)
+        return (t,done,results)
+
+    def test_validation(self):
+        self.assertRaises(ValueError,Thread,io_priority=42)
+        self.assertRaises(ValueError,Thread,io_priority=(IOPRIO_CLASS_BE,8))
+        self.assertEquals(Thread().io_priority,None)
+        t = Thread(io_priority=IOPRIO_CLASS_BE)
+        self.assertEquals(t.io_priority,(IOPRIO_CLASS_BE,4))
+        t.io_priority = IOPRIO_CLASS_IDLE
+        self.assertEquals(t.io_priority,(IOPRIO_CLASS_IDLE,0))
+        t.io_priority = [IOPRIO_CLASS_BE,6]
+        self.assertEquals(t.io_priority,(IOPRIO_CLASS_BE,6))
+        for bad in ("idle",(IOPRIO_CLASS_BE,),(IOPRIO_CLASS_BE,"4"),
+                    (IOPRIO_CLASS_BE,4.5),1.0,):
+            self.assertRaises(TypeError,setattr,t,"io_priority",bad)
+        self.assertEquals(t.io_priority,(IOPRIO_CLASS_BE,6))
+
+    def test_io_priority(self):
+        for io_priority in ((IOPRIO_CLASS_BE,7),(IOPRIO_CLASS_BE,0),
+                            (IOPRIO_CLASS_IDLE,0),):
+            (t,done,results) = self.run_with_io_priority(io_priority=io_priority)
+            done.set()
+            t.join()
+            self.assertEquals(results,[io_priority])
+
+    def test_realtime(self):
+        (t,done,results) = self.run_with_io_priority(io_priority=IOPRIO_CLASS_RT)
+        done.set()
+        t.join()
+        #  This needs CAP_SYS_ADMIN, and is silently ignored without it.
+        self.assertTrue(results[0] == (IOPRIO_CLASS_RT,4) or
+                        results[0][0] != IOPRIO_CLASS_RT)
+
+    def test_change_while_running(self):
+        (t,done,results) = self.run_with_io_priority()
+        t.io_priority = (IOPRIO_CLASS_BE,6)
+        done.set()
+        t.join()
+        self.assertEquals(results,[(IOPRIO_CLASS_BE,6)])
+
+    def test_reset_io_priority(self):
+        (t,done,default) = self.run_with_io_priority()
+        done.set()
+        t.join()
+        (t,done,results) = self.run_with_io_priority(io_priority=IOPRIO_CLASS_IDLE)
+        t.io_priority = None
+        self.assertEquals(t.io_priority,None)
+        done.set()
+        t.join()
+        self.assertEquals(results,default)
+        #  Likewise when a group's setting is cleared.
+        group = ThreadGroup()
+        group.io_priority = IOPRIO_CLASS_IDLE
+        (t,done,results) = self.run_with_io_priority(group=group)
+        group.io_priority = None
+        done.set()
+        t.join()
+        self.assertEquals(results,default)
+
+    def test_set_io_priority_before_run(self):
+        me = t2_posix._gettid()
+        before = t2_posix._do_get_io_priority(me)
+        results = []
+        def target():
+            results.append(t2_posix._do_get_io_priority(t.native_id))
+        t = DelayedThread(target=target)
+        t.start()
+        self.assertEquals(t.native_id,None)
+        t.io_priority = IOPRIO_CLASS_IDLE
+        #  Must not have been applied to the calling thread instead.
+        self.assertEquals(t2_posix._do_get_io_priority(me),before)
+        t.proceed.set()
+        t.join()
+        self.assertEquals(results,[(IOPRIO_CLASS_IDLE,0)])
+
+    def test_group_io_priority(self):
+        group = ThreadGroup()
+        group.io_priority = (IOPRIO_CLASS_BE,5)
+        (t1,done1,results1) = self.run_with_io_priority(group=group)
+        (t2,done2,results2) = self.run_with_io_priority(group=group)
+        group.io_priority = IOPRIO_CLASS_IDLE
+        done1.set()
+        done2.set()
+        group.join()
+        self.assertEquals(group.io_priority,IOPRIO_CLASS_IDLE)
+        self.assertEquals(results1,[(IOPRIO_CLASS_IDLE,0)])
+        self.assertEquals(results2,[(IOPRIO_CLASS_IDLE,0)])
+
+
+class TestStackSize(unittest.TestCase):
+    """Testcases for per-thread stack sizes."""
+
+    def get_stack_size(self):
+        """Get the stack size of the calling thread, or None if unknown."""
+        pthread = getattr(t2_posix,"pthread",None)
+        if not hasattr(pthread,"pthread_getattr_np"):
+            return None
+        attr = ctypes.create_string_buffer(128)
+        self_id = ctypes.c_ulong(pthread.pthread_self())
+        if pthread.pthread_getattr_np(self_id,attr) != 0:
+            return None
+        try:
+            size = ctypes.c_size_t()
+            pthread.pthread_attr_getstacksize(attr,ctypes.byref(size))
+            return size.value
+        finally:
+            pthread.pthread_attr_destroy(attr)
+
+    def assertStackSize(self,size,expected):
+        #  glibc may reuse a cached stack up to four times the requested size
+        self.assertTrue(expected <= size <= 4*expected,size)
+
+    def run_and_get_stack_size(self,**kwds):
+        results = []
+        t = Thread(target=lambda: results.append(self.get_stack_size()),**kwds)
+        t.start()
+        t.join()
+        return (t,results[0])
+
+    def test_validation(self):
+        self.assertRaises(ValueError,Thread,stack_size=1024)
+        t = Thread(stack_size=0)
+        self.assertEquals(t.stack_size,0)
+        t.start()
+        t.join()
+        self.assertRaises(RuntimeError,setattr,t,"stack_size",65536)
+
+    def test_stack_size(self):
+        old_size = stack_size()
+        (t,size) = self.run_and_get_stack_size(stack_size=256*1024)
+        self.assertEquals(stack_size(),old_size)
+        if size is None:
+            raise unittest.SkipTest("cannot determine thread stack size")
+        self.assertStackSize(size,256*1024)
+        (t,size) = self.run_and_get_stack_size(stack_size=2*1024*1024)
+        self.assertStackSize(size,2*1024*1024)
+
+    def test_group_stack_size(self):
+        group = ThreadGroup(stack_size=256*1024)
+        (t,size) = self.run_and_get_stack_size(group=group)
+        if size is None:
+            raise unittest.SkipTest("cannot determine thread stack size")
+        self.assertStackSize(size,256*1024)
+        (t,size) = self.run_and_get_stack_size(group=group,
+                                               stack_size=1024*1024)
+        self.assertStackSize(size,1024*1024)
+
+    def test_concurrent_start(self):
+        old_size = stack_size()
+        results = []
+        lock = Lock()
+        def check(expected):
+            size = self.get_stack_size()
+            with lock:
+                results.append(size is None or expected <= size <= 4*expected)
+        def spawn(expected):
+            for _ in xrange(20):
+                t = Thread(target=check,args=(expected,),stack_size=expected)
+                t.start()
+                t.join()
+        spawners = [Thread(target=spawn,args=(n*128*1024,))
+                    for n in xrange(1,5)]
+        for t in spawners:
+            t.start()
+        for t in spawners:
+            t.join()
+        self.assertEquals(len(results),80)
+        self.assertTrue(all(results))
+        self.assertEquals(stack_size(),old_size)
+
+    def test_mixed_concurrent_start(self):
+        results = []
+        lock = Lock()
+        def check(expected):
+            size = self.get_stack_size()
+            with lock:
+                results.append(size is None or expected <= size <= 4*expected)
+        #  Sized threads get their own size even while unsized threads,
+        #  including fresh threads spawned by a cache, start around them.
+        cache = ThreadCache(max_idle=0)
+        def spawn(**kwds):
+            for _ in xrange(20):
+                if "stack_size" in kwds:
+                    t = Thread(target=check,args=(kwds["stack_size"],),**kwds)
+                else:
+                    t = Thread(**kwds)
+                t.start()
+                t.join()
+        spawners = [Thread(target=spawn,kwargs={"stack_size":128*1024}),
+                    Thread(target=spawn,kwargs={"stack_size":256*1024}),
+                    Thread(target=spawn),
+                    Thread(target=spawn,
+                           kwargs={"group":ThreadGroup(cache=cache)})]
+        for t in spawners:
+            t.start()
+        for t in spawners:
+            t.join()
+        cache.clear()
+        self.assertEquals(len(results),40)
+        self.assertTrue(all(results))
+
+    def test_unsized_start_does_not_lock(self):
+        cache = ThreadCache(max_idle=0)
+        started = []
+        def start_threads():
+            for group in (None,ThreadGroup(cache=cache)):
+                t = Thread(group=group)
+                started.append(t.start())
+                t.join()
+        threading2.t2_base._stack_size_lock.acquire()
+        try:
+            t = Thread(target=start_threads)
+            t.start()
+            t.join(5)
+            self.assertEquals(started,[True,True])
+        finally:
+            threading2.t2_base._stack_size_lock.release()
+            t.join()
+            cache.clear()
+
+
+class TestGroupJoin(unittest.TestCase):
+    """Testcases for waiting on the threads in a ThreadGroup."""
+
+    def start_threads(self,group,num_threads):
+        """Start threads that each exit when their event is set."""
+        events = []
+        threads = []
+        for _ in xrange(num_threads):
+            e = Event()
+            t = Thread(target=e.wait,group=group)
+            t.start()
+            events.append(e)
+            threads.append(t)
+        return (threads,events)
+
+    def test_join(self):
+        group = ThreadGroup()
+        self.assertTrue(group.join())
+        (threads,events) = self.start_threads(group,5)
+        self.assertFalse(group.join(0.01))
+        for e in events[:4]:
+            e.set()
+        self.assertFalse(group.join(0.01))
+        events[4].set()
+        self.assertTrue(group.join())
+        self.assertTrue(group.join(0))
+
+    def test_join_unstarted(self):
+        group = ThreadGroup()
+        t = Thread(group=group)
+        self.assertTrue(group.join(0))
+        t.start()
+        self.assertRaises(RuntimeError,t.start)
+        self.assertTrue(group.join(1))
+
+    def test_join_waits_for_exit(self):
+        group = ThreadGroup()
+        #  Widen the gap between a thread being counted as finished
+        #  and actually exiting.
+        thread_finished = group._thread_finished
+        def slow_thread_finished(thread,ran=True):
+            thread_finished(thread,ran)
+            time.sleep(0.05)
+        group._thread_finished = slow_thread_finished
+        (threads,events) = self.start_threads(group,3)
+        for e in events:
+            e.set()
+        self.assertTrue(group.join(5))
+        self.assertEquals([t.is_alive() for t in threads],[False]*3)
+        (threads,events) = self.start_threads(group,3)
+        for e in events:
+            e.set()
+        self.assertTrue(group.join())
+        self.assertEquals([t.is_alive() for t in threads],[False]*3)
+
+    def test_join_from_member(self):
+        results = []
+        def join_group():
+            try:
+                current_thread().group.join(1)
+            except RuntimeError:
+                results.append(True)
+            else:
+                results.append(False)
+        group = ThreadGroup()
+        Thread(target=join_group,group=group).start()
+        self.assertTrue(group.join(5))
+        #  Including the default group, which every thread belongs to.
+        t = Thread(target=join_group)
+        t.start()
+        t.join()
+        self.assertEquals(results,[True,True])
+
+    def test_join_any(self):
+        group = ThreadGroup()
+        self.assertEquals(group.join_any(),None)
+        (threads,events) = self.start_threads(group,3)
+        self.assertEquals(group.join_any(0.01),None)
+        for i in (2,0,1):
+            events[i].set()
+            self.assertTrue(group.join_any() is threads[i])
+        self.assertEquals(group.join_any(),None)
+
+    def test_join_any_collects_garbage(self):
+        group = ThreadGroup()
+        num_active = threading.active_count()
+        for _ in xrange(100):
+            t = Thread(group=group)
+            t.start()
+            t.join()
+        del t
+        #  The threading module keeps a reference to each thread for a
+        #  little while after join() returns.
+        for _ in xrange(500):
+            if threading.active_count() <= num_active:
+                break
+            time.sleep(0.01)
+        gc.collect()
+        self.assertEquals(group.join_any(),None)
+        self.assertTrue(len(group._ThreadGroup__finished) <= 32)
+
+    def test_as_completed(self):
+        group = ThreadGroup()
+        (threads,events) = self.start_threads(group,4)
+        order = [3,1,2,0]
+        def finish():
+            for i in order:
+                time.sleep(0.01)
+                events[i].set()
+        Thread(target=finish).start()
+        completed = list(group.as_completed())
+        self.assertEquals(completed,[threads[i] for i in order])
+        (threads,events) = self.start_threads(group,2)
+        events[0].set()
+        completed = list(group.as_completed(timeout=0.2))
+        self.assertEquals(completed,[threads[0]])
+        events[1].set()
+        self.assertEquals(list(group.as_completed()),[threads[1]])
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """Testcases for limiting the number of running threads in a group."""
+
+    def test_max_running(self):
+        group = ThreadGroup(max_running=2)
+        lock = Lock()
+        state = dict(running=0,max_running=0)
+        def target():
+            with lock:
+                state["running"] += 1
+                state["max_running"] = max(state["max_running"],
+                                           state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+        for _ in xrange(8):
+            self.assertTrue(Thread(target=target,group=group).start())
+        self.assertTrue(group.join(10))
+        self.assertEquals(state["max_running"],2)
+        stats = group.admission_stats()
+        self.assertEquals(stats["admitted"],8)
+        self.assertEquals(stats["running"],0)
+        self.assertEquals(stats["queued"],0)
+        self.assertEquals(stats["max_queued"],1)
+        self.assertTrue(stats["total_wait"] > 0)
+
+    def test_timeout(self):
+        group = ThreadGroup(max_running=1)
+        done = Event()
+        t1 = Thread(target=done.wait,group=group)
+        self.assertTrue(t1.start(timeout=0))
+        t2 = Thread(target=done.wait,group=group)
+        self.assertFalse(t2.start(timeout=0.01))
+        self.assertFalse(t2.is_alive())
+        self.assertEquals(group.admission_stats()["rejected"],1)
+        done.set()
+        self.assertTrue(t2.start(timeout=1))
+        self.assertTrue(group.join(1))
+
+    def test_fifo_order(self):
+        group = ThreadGroup(max_running=1)
+        done = Event()
+        order = []
+        blocker = Thread(target=done.wait,group=group)
+        blocker.start()
+        starters = []
+        for i in xrange(4):
+            t = Thread(target=order.append,args=(i,),group=group)
+            starter = Thread(target=t.start)
+            starter.start()
+            while group.admission_stats()["queued"] < i + 1:
+                time.sleep(0.001)
+            starters.append(starter)
+        done.set()
+        for starter in starters:
+            starter.join()
+        self.assertTrue(group.join(1))
+        self.assertEquals(order,[0,1,2,3])
+
+    def test_change_limit(self):
+        group = ThreadGroup(max_running=1)
+        self.assertRaises(ValueError,setattr,group,"max_running",0)
+        done = Event()
+        Thread(target=done.wait,group=group).start()
+        t = Thread(target=done.wait,group=group)
+        starter = Thread(target=t.start)
+        starter.start()
+        while group.admission_stats()["queued"] < 1:
+            time.sleep(0.001)
+        group.max_running = 2
+        self.assertTrue(starter.join(1))
+        self.assertEquals(group.admission_stats()["running"],2)
+        group.max_running = None
+        for _ in xrange(3):
+            Thread(target=done.wait,group=group).start(timeout=0)
+        self.assertEquals(group.admission_stats()["running"],5)
+        done.set()
+        self.assertTrue(group.join(1))
+
+
+class TestThreadStats(unittest.TestCase):
+    """Testcases for per-thread and per-group resource accounting."""
+
+    def test_arithmetic(self):
+        s1 = ThreadStats(1.5,10,2,1,cpu=3)
+        s2 = ThreadStats(0.5,4,1,None,cpu=1)
+        total = s1 + s2
+        self.assertEquals(total.cpu_time,2.0)
+        self.assertEquals(total.voluntary_switches,14)
+        self.assertEquals(total.involuntary_switches,3)
+        self.assertEquals(total.migrations,None)
+        self.assertEquals(total.cpu,None)
+        delta = s1 - s2
+        self.assertEquals(delta.cpu_time,1.0)
+        self.assertEquals(delta.voluntary_switches,6)
+        self.assertEquals(delta.cpu,3)
+
+    def test_not_running(self):
+        t = Thread()
+        self.assertEquals(t.stats(),None)
+        t.start()
+        t.join()
+        self.assertEquals(t.stats(),None)
+
+    def test_stats(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        ready = Event()
+        done = Event()
+        def spin():
+            end = time.time() + 0.05
+            while time.time() < end:
+                pass
+            ready.set()
+            for _ in xrange(5):
+                time.sleep(0.001)
+            done.wait()
+        group = ThreadGroup()
+        threads = [Thread(target=spin,group=group) for _ in xrange(2)]
+        for t in threads:
+            t.start()
+        try:
+            ready.wait(10)
+            stats = threads[0].stats()
+            self.assertTrue(stats.cpu_time >= 0.01,stats)
+            self.assertTrue(stats.voluntary_switches >= 1,stats)
+            self.assertTrue(stats.involuntary_switches >= 0,stats)
+            self.assertTrue(stats.cpu in process_affinity(),stats)
+            gstats = group.stats()
+            self.assertTrue(gstats.cpu_time >= stats.cpu_time,gstats)
+            self.assertEquals(gstats.cpu,None)
+            later = threads[0].stats()
+            self.assertTrue((later - stats).cpu_time >= 0)
+        finally:
+            done.set()
+            group.join()
+
+    def test_fallbacks(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        tid = current_thread().native_id
+        stats = t2_posix._do_get_stats(tid)
+        old_cpu_time = t2_posix._thread_cpu_time
+        old_task_dir = t2_posix._PROC_TASK_DIR
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tempdir,str(tid)))
+            for name in ("stat","status"):
+                shutil.copy("/proc/self/task/%d/%s" % (tid,name),
+                            os.path.join(tempdir,str(tid),name))
+            t2_posix._PROC_TASK_DIR = tempdir
+            t2_posix._thread_cpu_time = lambda tid: None
+            fallback = t2_posix._do_get_stats(tid)
+        finally:
+            t2_posix._thread_cpu_time = old_cpu_time
+            t2_posix._PROC_TASK_DIR = old_task_dir
+            shutil.rmtree(tempdir)
+        self.assertEquals(fallback.migrations,None)
+        self.assertTrue(fallback.voluntary_switches is not None)
+        self.assertTrue(abs(fallback.cpu_time - stats.cpu_time) < 0.1)
+        self.assertEquals(t2_posix._do_get_stats(2**22 + 1),None)
+
+
+class FakeLoadThread(Thread):
+    """Thread reporting a fake CPU time, and ignoring its affinity."""
+
+    def __init__(self,*args,**kwds):
+        super(FakeLoadThread,self).__init__(*args,**kwds)
+        self.fake_cpu_time = 0.0
+
+    def stats(self):
+        return ThreadStats(cpu_time=self.fake_cpu_time)
+
+    def _set_affinity(self,affinity):
+        return affinity
+
+
+class TestRebalancer(unittest.TestCase):
+    """Testcases for the CPU load rebalancer."""
+
+    def test_plan_placement(self):
+        loads = dict(a=0.9,b=0.5,c=0.4,d=0.1)
+        moves = dict(Rebalancer.plan(loads,{},[0,1]))
+        self.assertEquals(moves,dict(a=0,b=1,c=1,d=0))
+        moves = dict(Rebalancer.plan(loads,dict(a=0,b=1),[0,1]))
+        self.assertEquals(moves,dict(c=1,d=0))
+        moves = dict(Rebalancer.plan(loads,dict(a=5),[0,1]))
+        self.assertEquals(moves,dict(a=0,b=1,c=1,d=0))
+        self.assertEquals(Rebalancer.plan(loads,{},[]),[])
+
+    def test_plan_rebalance(self):
+        loads = dict(a=0.9,b=0.5,c=0.4,d=0.1)
+        skewed = dict(a=0,b=0,c=0,d=1)
+        moves = Rebalancer.plan(loads,skewed,[0,1])
+        self.assertEquals(moves,[("a",1)])
+        moves = Rebalancer.plan(loads,skewed,[0,1],max_moves=3)
+        self.assertEquals(moves,[("a",1)])
+        moves = Rebalancer.plan(loads,skewed,[0,1],frozen=["a"])
+        self.assertEquals(moves,[("b",1)])
+        moves = Rebalancer.plan(loads,skewed,[0,1],frozen=["a"],max_moves=3)
+        self.assertEquals(moves,[("b",1),("c",1)])
+        moves = Rebalancer.plan(loads,skewed,[0,1],frozen=["a","b","c"])
+        self.assertEquals(moves,[])
+
+    def test_plan_hysteresis(self):
+        loads = dict(a=0.2,b=0.5,c=0.4)
+        moves = Rebalancer.plan(loads,dict(a=0,b=1,c=1),[0,1],threshold=0.8)
+        self.assertEquals(moves,[])
+        moves = Rebalancer.plan(loads,dict(a=0,b=1,c=1),[0,1],threshold=0.2)
+        self.assertEquals(moves,[("c",0)])
+        #  A single thread that is too heavy to move is left alone.
+        moves = Rebalancer.plan(dict(a=1.0),dict(a=0),[0,1],threshold=0.2)
+        self.assertEquals(moves,[])
+
+    def test_rebalance(self):
+        group = ThreadGroup()
+        done = Event()
+        threads = [FakeLoadThread(target=done.wait,group=group,affinity=[0])
+                   for _ in xrange(4)]
+        for t in threads:
+            t.start()
+        try:
+            balancer = Rebalancer(group,cpus=[0,1],cooldown=0)
+            self.assertEquals(balancer.rebalance(),[])
+            for t in threads:
+                t.fake_cpu_time += 10
+            moves = balancer.rebalance()
+            self.assertEquals(len(moves),1)
+            self.assertEquals(moves[0][0].affinity,CPUSet([1]))
+            for t in threads:
+                t.fake_cpu_time += 10
+            self.assertEquals(len(balancer.rebalance()),1)
+            for t in threads:
+                t.fake_cpu_time += 10
+            self.assertEquals(balancer.rebalance(),[])
+            cpus = sorted(iter(t.affinity).next() for t in threads)
+            self.assertEquals(cpus,[0,0,1,1])
+        finally:
+            done.set()
+            group.join()
+
+    def test_run(self):
+        group = ThreadGroup()
+        done = Event()
+        t = FakeLoadThread(target=done.wait,group=group)
+        t.start()
+        balancer = Rebalancer(group,cpus=[3],interval=0.01)
+        balancer.start()
+        try:
+            for _ in xrange(100):
+                t.fake_cpu_time += 0.01
+                if t.affinity is not None:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(t.affinity,CPUSet([3]))
+        finally:
+            balancer.stop()
+            balancer.join()
+            done.set()
+            group.join()
+
+
+class TestForeignThreads(unittest.TestCase):
+    """Testcases for upgrading threads not created by threading2."""
+
+    def run_foreign_threads(self,num_threads,func):
+        """Run func in raw threads, returning results and cleaning up."""
+        results = []
+        done = Semaphore(0)
+        def target():
+            try:
+                results.append(func())
+            finally:
+                done.release()
+        for _ in xrange(num_threads):
+            thread.start_new_thread(target,())
+        for _ in xrange(num_threads):
+            done.acquire()
+        #  Dummy threads are never removed from _active by the stdlib.
+        with threading._active_limbo_lock:
+            for t in results:
+                threading._active.pop(t.ident,None)
+        return results
+
+    def count_upgraded_classes(self):
+        gc.collect()
+        return len([obj for obj in gc.get_objects()
+                        if isinstance(obj,type) and
+                           obj.__name__ == "UpgradedThread"])
+
+    def test_current_thread(self):
+        def get_thread():
+            t = current_thread()
+            self.assertTrue(current_thread() is t)
+            return t
+        threads = self.run_foreign_threads(10,get_thread)
+        self.assertEquals(len(set(threads)),10)
+        self.assertEquals(len(set(t.__class__ for t in threads)),1)
+        for t in threads:
+            self.assertTrue(isinstance(t,Thread))
+            self.assertTrue(isinstance(t,threading._DummyThread))
+            self.assertTrue(t.group is threading2.default_group)
+            self.assertEquals(t.priority,None)
+        self.assertTrue(current_thread() is threading.current_thread())
+
+    def test_upgraded_classes_are_cached(self):
+        threads = self.run_foreign_threads(5,current_thread)
+        num_classes = self.count_upgraded_classes()
+        threads.extend(self.run_foreign_threads(200,current_thread))
+        self.assertEquals(self.count_upgraded_classes(),num_classes)
+
+    def test_from_thread(self):
+        class MyThread(threading.Thread):
+            pass
+        class MyThread2(Thread):
+            pass
+        t1 = MyThread()
+        t2 = MyThread()
+        self.assertTrue(Thread.from_thread(t1) is t1)
+        self.assertTrue(Thread.from_thread(t2) is t2)
+        self.assertTrue(t1.__class__ is t2.__class__)
+        self.assertTrue(isinstance(t1,MyThread))
+        self.assertEquals(t1.native_id,None)
+        t3 = Thread()
+        self.assertTrue(Thread.from_thread(t3).__class__ is Thread)
+        t4 = threading.Thread()
+        self.assertTrue(MyThread2.from_thread(t4).__class__ is MyThread2)
+        self.assertTrue(t4.group is threading2.default_group)
+
+
+class TestGroupLocal(unittest.TestCase):
+    """Testcases for group-local storage."""
+
+    def run_in_group(self,group,func):
+        results = []
+        t = Thread(target=lambda: results.append(func()),group=group)
+        t.start()
+        t.join()
+        return results[0]
+
+    def test_basic(self):
+        data = group_local()
+        self.assertRaises(AttributeError,getattr,data,"x")
+        data.x = 1
+        self.assertEquals(data.x,1)
+        data.x = 2
+        self.assertEquals(data.x,2)
+        del data.x
+        self.assertRaises(AttributeError,getattr,data,"x")
+        self.assertRaises(AttributeError,delattr,data,"x")
+
+    def test_groups(self):
+        data = group_local()
+        data.x = "default"
+        group1 = ThreadGroup()
+        group2 = ThreadGroup()
+        self.assertEquals(self.run_in_group(None,lambda: data.x),"default")
+        self.assertFalse(self.run_in_group(group1,lambda: hasattr(data,"x")))
+        def set_x():
+            data.x = "group1"
+            return data.x
+        self.assertEquals(self.run_in_group(group1,set_x),"group1")
+        self.assertEquals(self.run_in_group(group1,lambda: data.x),"group1")
+        self.assertFalse(self.run_in_group(group2,lambda: hasattr(data,"x")))
+        self.assertEquals(data.x,"default")
+
+    def test_concurrent_reads(self):
+        data = group_local()
+        data.x = 0
+        errors = []
+        done = Event()
+        def reader():
+            while not done.is_set():
+                #  Values are only ever increased, so must never go back
+                (x1,x2) = (data.x,data.x)
+                if x1 > x2:
+                    errors.append((x1,x2))
+        def writer():
+            for i in xrange(1000):
+                data.x = i
+            data.y = "done"
+        readers = [Thread(target=reader) for _ in xrange(4)]
+        for t in readers:
+            t.start()
+        try:
+            writer()
+        finally:
+            done.set()
+            for t in readers:
+                t.join()
+        self.assertEquals(errors,[])
+        self.assertEquals((data.x,data.y),(999,"done"))
+
+    def test_thread_cache(self):
+        data = group_local()
+        cache = ThreadCache()
+        group1 = ThreadGroup(cache=cache)
+        group2 = ThreadGroup(cache=cache)
+        def set_x(value):
+            data.x = value
+            return (current_thread().ident,data.x)
+        try:
+            (ident1,x1) = self.run_in_group(group1,lambda: set_x(1))
+            (ident2,x2) = self.run_in_group(group2,lambda: set_x(2))
+        finally:
+            cache.clear()
+        self.assertEquals(ident1,ident2)
+        self.assertEquals((x1,x2),(1,2))
+        self.assertEquals(self.run_in_group(group1,lambda: data.x),1)
+
+
+class TestCPULocal(unittest.TestCase):
+    """Testcases for per-cpu storage and sharded counters."""
+
+    def run_threads(self,num_threads,func):
+        threads = [Thread(target=func) for _ in xrange(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_current_cpu(self):
+        cpu = current_cpu()
+        if cpu is None:
+            raise unittest.SkipTest("current cpu not available")
+        self.assertTrue(cpu in system_affinity())
+
+    def test_cpu_local(self):
+        for cls in (cpu_local,threading2.t2_base.cpu_local):
+            data = cls()
+            self.assertFalse(hasattr(data,"x"))
+            data.x = 1
+            self.assertEquals(data.x,1)
+            del data.x
+            self.assertRaises(AttributeError,delattr,data,"x")
+            self.assertTrue(isinstance(data,cls))
+
+    def test_thread_slots(self):
+        #  Without a current cpu, each thread gets its own slot in turn.
+        t2_base = threading2.t2_base
+        data = t2_base.cpu_local()
+        data.x = "main"
+        num_slots = t2_base._NUM_THREAD_SLOTS
+        main_slot = t2_base._current_thread_slot() % num_slots
+        results = []
+        def target():
+            slot = t2_base._current_thread_slot() % num_slots
+            results.append((slot == main_slot,hasattr(data,"x")))
+        self.run_threads(4,target)
+        self.assertEquals(len(results),4)
+        for (same_slot,has_x) in results:
+            self.assertEquals(same_slot,has_x)
+        self.assertEquals(data.x,"main")
+
+    def test_sharded_counter(self):
+        for cls in (ShardedCounter,threading2.t2_base.ShardedCounter):
+            counter = cls(10)
+            self.assertEquals(counter.value,10)
+            def target():
+                for _ in xrange(1000):
+                    counter.increment()
+                counter.decrement(500)
+            self.run_threads(8,target)
+            self.assertEquals(counter.value,10 + 8 * 500)
+            counter.reset()
+            self.assertEquals(counter.value,0)
+
+    def test_sharded_accumulator(self):
+        for cls in (ShardedAccumulator,threading2.t2_base.ShardedAccumulator):
+            total = cls()
+            biggest = cls(max,0)
+            def target():
+                for i in xrange(100):
+                    total.add(i)
+                    biggest.add(i)
+            self.run_threads(8,target)
+            self.assertEquals(total.value,8 * sum(xrange(100)))
+            self.assertEquals(biggest.value,99)
+
+    def test_class_hierarchy(self):
+        self.assertTrue(issubclass(ShardedCounter,ShardedAccumulator))
+        self.assertTrue(isinstance(ShardedCounter(),ShardedAccumulator))
+        self.assertTrue(isinstance(ShardedCounter(),
+                                   threading2.t2_base.ShardedCounter))
+
+
+class TestCompactPrimitives(unittest.TestCase):
+    """Testcases for the slot-based synchronisation primitives."""
+
+    def test_no_instance_dict(self):
+        for cls in (Lock,RLock,Event,Semaphore,BoundedSemaphore):
+            obj = cls()
+            self.assertFalse(hasattr(obj,"__dict__"))
+            self.assertRaises(AttributeError,setattr,obj,"extra",1)
+            self.assertTrue(weakref.ref(obj)() is obj)
+
+    def test_subclassing(self):
+        for base in (Lock,RLock,Event,Semaphore,BoundedSemaphore,SHLock):
+            class Sub(base):
+                pass
+            obj = Sub()
+            obj.extra = 1
+            self.assertEquals(obj.extra,1)
+            if hasattr(obj,"acquire"):
+                with obj:
+                    pass
+
+    def test_rlock_condition(self):
+        lock = RLock()
+        cond = Condition(lock)
+        ready = []
+        def target():
+            with cond:
+                ready.append(True)
+                cond.notify()
+        with lock:
+            with lock:
+                t = Thread(target=target)
+                t.start()
+                while not ready:
+                    self.assertTrue(cond.wait(timeout=5))
+                self.assertTrue(lock._is_owned())
+        self.assertFalse(lock._is_owned())
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+        t.join()
+
+    def test_lazy_event(self):
+        event = Event()
+        event.set()
+        event.clear()
+        self.assertFalse(event.wait(0.01))
+        self.assertTrue(event._Event__cond is not None)
+        event = Event()
+        t = Thread(target=event.set)
+        t.start()
+        self.assertTrue(event.wait(5))
+        t.join()
+        event = Event()
+        event.set()
+        self.assertTrue(event.wait())
+        self.assertTrue(event._Event__cond is None)
+
+    def test_lazy_semaphore(self):
+        sem = BoundedSemaphore(2)
+        self.assertTrue(sem._Semaphore__cond is None)
+        self.assertTrue(sem.acquire())
+        self.assertTrue(sem.acquire())
+        self.assertFalse(sem.acquire(timeout=0.01))
+        sem.release()
+        sem.release()
+        self.assertRaises(ValueError,sem.release)
+
+    def test_lazy_shlock(self):
+        lock = SHLock()
+        with lock:
+            pass
+        self.assertTrue(lock._shared_queue is None)
+        self.assertTrue(lock._exclusive_queue is None)
+        self.assertTrue(lock._free_waiters is None)
+        lock.acquire(shared=True)
+        t = Thread(target=lambda: lock.acquire(timeout=0.01))
+        t.start()
+        t.join()
+        lock.release()
+        self.assertEquals(lock._exclusive_queue,[])
+        self.assertEquals(len(lock._free_waiters),1)
+
+
+class TestLockTable(unittest.TestCase):
+    """Testcases for LockTable class."""
+
+    def test_basic(self):
+        for kind in (Lock,RLock,SHLock):
+            table = LockTable(8,kind)
+            self.assertTrue(isinstance(table.lock_for("x"),kind))
+            self.assertTrue(table.lock_for(8) is table.lock_for(0))
+            self.assertTrue(table.acquire("x"))
+            table.release("x")
+            with table("x","y",timeout=1):
+                pass
+        self.assertRaises(ValueError,LockTable,0)
+
+    def test_timeout(self):
+        table = LockTable(4)
+        table.acquire(1)
+        results = []
+        def target():
+            results.append(table.acquire(5,timeout=0.05))
+            results.append(table.acquire(2,blocking=False))
+            table.release(2)
+            results.append(table.acquire_many([2,3,5],timeout=0.05))
+            results.append(table.lock_for(2).acquire(False))
+            table.release(2)
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        self.assertEquals(results,[False,True,False,True])
+        def enter():
+            try:
+                with table(1,timeout=0.01):
+                    pass
+            except RuntimeError:
+                results.append(None)
+        t = Thread(target=enter)
+        t.start()
+        t.join()
+        self.assertEquals(results[-1],None)
+        table.release(1)
+        stats = table.stats()
+        self.assertEquals(len(stats),4)
+        self.assertEquals(stats[1]["acquired"],1)
+        self.assertEquals(stats[1]["timeouts"],3)
+        self.assertEquals(stats[1]["contended"],3)
+        self.assertTrue(stats[1]["max_wait"] >= 0.04)
+        table.reset_stats()
+        self.assertEquals(table.stats()[1]["timeouts"],0)
+
+    def test_shared(self):
+        table = LockTable(4,SHLock)
+        self.assertTrue(table.acquire("x",shared=True))
+        results = []
+        def target():
+            results.append(table.acquire("x",shared=True,timeout=1))
+            table.release("x")
+            results.append(table.acquire("x",timeout=0.01))
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        table.release("x")
+        self.assertEquals(results,[True,False])
+        self.assertRaises(ValueError,LockTable(4).acquire,"x",shared=True)
+
+    def test_acquire_many(self):
+        #  Threads locking overlapping sets of keys in different orders
+        #  must not deadlock, even with keys sharing a stripe.
+        table = LockTable(16)
+        keys = range(32)
+        counts = dict((key,0) for key in keys)
+        def target(seed):
+            rng = random.Random(seed)
+            for _ in xrange(200):
+                locked = rng.sample(keys,4)
+                with table(*locked):
+                    for key in locked:
+                        counts[key] += 1
+        threads = [Thread(target=target,args=(i,)) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        self.assertEquals(sum(counts.itervalues()),8 * 200 * 4)
+        self.assertTrue(table.acquire_many(keys,blocking=False))
+        table.release_many(keys)
+
+
+class TestSeqLock(unittest.TestCase):
+    """Testcases for SeqLock class."""
+
+    def test_basic(self):
+        lock = SeqLock()
+        self.assertFalse(hasattr(lock,"__dict__"))
+        seq = lock.read_begin()
+        self.assertEquals(seq,0)
+        self.assertFalse(lock.read_retry(seq))
+        with lock:
+            self.assertEquals(lock.sequence,1)
+            self.assertRaises(RuntimeError,lock.read_begin)
+        self.assertTrue(lock.read_retry(seq))
+        self.assertEquals(lock.read_begin(),2)
+        self.assertRaises(RuntimeError,lock.release)
+        self.assertEquals(lock.read(lambda x,y=0: x + y,1,y=2),3)
+
+    def test_write_timeout(self):
+        lock = SeqLock()
+        lock.acquire()
+        results = []
+        def target():
+            results.append(lock.acquire(timeout=0.01))
+            results.append(lock.acquire(blocking=False))
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        lock.release()
+        self.assertEquals(results,[False,False])
+
+    def test_release_by_other_thread(self):
+        lock = SeqLock()
+        lock.acquire()
+        errors = []
+        def target():
+            try:
+                lock.release()
+            except RuntimeError:
+                errors.append(True)
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        self.assertEquals(errors,[True])
+        #  The writer still holds the lock, and the sequence is unchanged.
+        self.assertEquals(lock.sequence,1)
+        self.assertFalse(lock.acquire(blocking=False))
+        lock.release()
+        self.assertEquals(lock.sequence,2)
+
+    def test_consistent_reads(self):
+        lock = SeqLock()
+        state = {"a":0,"b":0}
+        done = []
+        errors = []
+        def writer():
+            for i in xrange(1,2001):
+                with lock:
+                    state["a"] = i
+                    time.sleep(0)
+                    state["b"] = i
+            done.append(True)
+        def read_state():
+            a = state["a"]
+            time.sleep(0)
+            if a != state["b"]:
+                raise ValueError("inconsistent read")
+            return a
+        def reader():
+            last = 0
+            while not done:
+                (a,b) = lock.read(lambda: (state["a"],state["b"]))
+                if a != b or a < last:
+                    errors.append((a,b))
+                last = lock.read(read_state)
+        threads = [Thread(target=reader) for _ in xrange(4)]
+        threads.append(Thread(target=writer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors,[])
+        self.assertEquals(lock.sequence,4000)
+        self.assertRaises(ValueError,lock.read,int,"x")
+
+
+class TestRCU(unittest.TestCase):
+    """Testcases for RCUCell and RCUDict classes."""
+
+    def test_cell(self):
+        cell = RCUCell(ThreadGroup(),1)
+        self.assertEquals(cell.get(),1)
+        cell.set(2)
+        self.assertEquals(cell.get(),2)
+        self.assertEquals(cell.modify(lambda v: v * 10),20)
+        self.assertEquals(cell.get(),20)
+        self.assertTrue(cell.synchronize())
+
+    def test_dict(self):
+        reclaimed = []
+        d = RCUDict(ThreadGroup(),{"a":1},reclaim=reclaimed.append,b=2)
+        old = d.snapshot()
+        self.assertEquals(old,{"a":1,"b":2})
+        d["c"] = 3
+        del d["a"]
+        self.assertEquals(d.pop("b"),2)
+        self.assertEquals(d.pop("x",None),None)
+        self.assertRaises(KeyError,d.pop,"x")
+        d.update({"d":4},e=5)
+        self.assertEquals(sorted(d),["c","d","e"])
+        self.assertEquals(len(d),3)
+        self.assertTrue("c" in d)
+        self.assertEquals(d["c"],3)
+        self.assertEquals(d.get("a"),None)
+        self.assertEquals(old,{"a":1,"b":2})
+        d.clear()
+        self.assertEquals(d.snapshot(),{})
+        #  With no reader threads, old versions are reclaimed immediately.
+        self.assertEquals(reclaimed[0],old)
+        self.assertEquals(d.pending,0)
+
+    def test_grace_period(self):
+        group = ThreadGroup()
+        reclaimed = []
+        cell = RCUCell(group,"old",reclaim=reclaimed.append)
+        seen = []
+        (holding,release,passed,finish) = [Event() for _ in xrange(4)]
+        def reader():
+            rcu_quiescent()
+            seen.append(cell.get())
+            holding.set()
+            release.wait()
+            rcu_quiescent()
+            passed.set()
+            finish.wait()
+        t = Thread(target=reader,group=group)
+        t.start()
+        holding.wait()
+        cell.set("new")
+        self.assertEquals(cell.pending,1)
+        self.assertFalse(cell.synchronize(timeout=0.05))
+        self.assertEquals(reclaimed,[])
+        #  Once the reader has passed a quiescent point, the next write
+        #  reclaims the old value.
+        release.set()
+        passed.wait()
+        cell.set("newer")
+        self.assertEquals(reclaimed,["old"])
+        self.assertEquals(seen,["old"])
+        self.assertFalse(cell.synchronize(timeout=0.01))
+        #  A reader that finishes is no longer holding anything.
+        finish.set()
+        t.join()
+        self.assertTrue(cell.synchronize(timeout=5))
+        self.assertEquals(reclaimed,["old","new"])
+        self.assertEquals(cell.pending,0)
+
+    def test_concurrent(self):
+        #  Readers must never see a value that has been reclaimed.
+        group = ThreadGroup()
+        class Version(object):
+            def __init__(self,n):
+                self.n = n
+                self.reclaimed = False
+        def reclaim(version):
+            version.reclaimed = True
+        cell = RCUCell(group,Version(0),reclaim=reclaim)
+        stop = []
+        errors = []
+        def reader():
+            while not stop:
+                version = cell.get()
+                time.sleep(0)
+                if version.reclaimed:
+                    errors.append(version.n)
+                rcu_quiescent()
+        for _ in xrange(4):
+            Thread(target=reader,group=group).start()
+        for n in xrange(1,201):
+            cell.set(Version(n))
+            if n % 50 == 0:
+                self.assertTrue(cell.synchronize(timeout=5))
+                self.assertEquals(cell.pending,0)
+        stop.append(True)
+        group.join()
+        self.assertEquals(errors,[])
+
+
+class TestBarrier(unittest.TestCase):
+    """Testcases for Barrier and SpinBarrier classes."""
+
+    barrier_classes = (Barrier,SpinBarrier,
+                       lambda *args,**kwds: SpinBarrier(spin_time=0.001,
+                                                        *args,**kwds))
+
+    def run_threads(self,num_threads,func):
+        threads = [Thread(target=func) for _ in xrange(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_phases(self):
+        for cls in self.barrier_classes:
+            actions = []
+            barrier = cls(5,action=lambda: actions.append(len(results)))
+            self.assertEquals(barrier.parties,5)
+            results = []
+            indexes = []
+            def target():
+                for phase in xrange(20):
+                    results.append(phase)
+                    indexes.append(barrier.wait())
+                    #  Nobody can have started the next phase yet.
+                    self.assertTrue(len(results) <= (phase + 1) * 5)
+                    barrier.wait()
+            self.run_threads(5,target)
+            self.assertEquals(len(results),100)
+            self.assertEquals(sorted(indexes),sorted(range(5) * 20))
+            self.assertEquals(actions[::2],[5 * (i + 1) for i in xrange(20)])
+            self.assertFalse(barrier.broken)
+            self.assertEquals(barrier.n_waiting,0)
+        self.assertRaises(ValueError,Barrier,0)
+
+    def test_timeout(self):
+        for cls in self.barrier_classes:
+            barrier = cls(3,timeout=0.05)
+            errors = []
+            def target():
+                try:
+                    barrier.wait()
+                except BrokenBarrierError:
+                    errors.append(True)
+            self.run_threads(2,target)
+            self.assertEquals(errors,[True,True])
+            self.assertTrue(barrier.broken)
+            self.assertRaises(BrokenBarrierError,barrier.wait)
+            barrier.reset()
+            self.assertFalse(barrier.broken)
+            self.run_threads(3,barrier.wait)
+
+    def test_abort_and_reset(self):
+        for cls in self.barrier_classes:
+            barrier = cls(3)
+            errors = []
+            def target():
+                try:
+                    barrier.wait(timeout=5)
+                except BrokenBarrierError:
+                    errors.append(True)
+            for method in (barrier.abort,barrier.reset):
+                #  An aborted barrier stays broken until it's reset.
+                barrier.reset()
+                del errors[:]
+                threads = [Thread(target=target) for _ in xrange(2)]
+                for t in threads:
+                    t.start()
+                while barrier.n_waiting < 2:
+                    time.sleep(0.001)
+                method()
+                for t in threads:
+                    t.join()
+                self.assertEquals(errors,[True,True])
+            self.assertFalse(barrier.broken)
+            self.assertEquals(barrier.n_waiting,0)
+            barrier.abort()
+            self.assertTrue(barrier.broken)
+            self.assertEquals(barrier.n_waiting,0)
+
+    def test_spin_time(self):
+        #  By default threads only spin if each can have a CPU to itself.
+        num_cpus = effective_cpu_capacity()
+        self.assertEquals(SpinBarrier(num_cpus).spin_time,0.001)
+        self.assertEquals(SpinBarrier(num_cpus + 1).spin_time,0)
+        self.assertEquals(SpinBarrier(num_cpus + 1,spin_time=1).spin_time,1)
+
+    def test_action_error(self):
+        for cls in self.barrier_classes:
+            def action():
+                raise ValueError("action failed")
+            barrier = cls(3,action=action)
+            errors = []
+            def target():
+                try:
+                    barrier.wait(timeout=5)
+                except Exception, e:
+                    errors.append(type(e))
+            self.run_threads(3,target)
+            self.assertEquals(sorted(errors),
+                              sorted([ValueError,BrokenBarrierError,
+                                      BrokenBarrierError]))
+            self.assertTrue(barrier.broken)
+
+
+class TestCountDownLatch(unittest.TestCase):
+    """Testcases for CountDownLatch class."""
+
+    def test_latch(self):
+        latch = CountDownLatch(3)
+        self.assertEquals(latch.count,3)
+        self.assertFalse(latch.wait(timeout=0.01))
+        results = []
+        waiters = [Thread(target=lambda: results.append(latch.wait(5)))
+                   for _ in xrange(4)]
+        for t in waiters:
+            t.start()
+        counters = [Thread(target=latch.count_down) for _ in xrange(3)]
+        for t in counters:
+            t.start()
+        for t in counters + waiters:
+            t.join()
+        self.assertEquals(results,[True] * 4)
+        self.assertEquals(latch.count,0)
+        latch.count_down()
+        self.assertEquals(latch.count,0)
+        self.assertTrue(latch.wait(0))
+        self.assertTrue(CountDownLatch(0).wait(0))
+        self.assertRaises(ValueError,CountDownLatch,-1)
+
+
+class TestPhaser(unittest.TestCase):
+    """Testcases for Phaser class."""
+
+    def run_phases(self,phasers,num_phases):
+        #  Run threads through the phases, checking that no thread gets
+        #  into a phase before all threads have finished the previous one.
+        progress = []
+        errors = []
+        def target(phaser):
+            for phase in xrange(num_phases):
+                progress.append(phase)
+                if not phaser.arrive_and_await(timeout=10):
+                    errors.append("timeout")
+                if len([p for p in progress if p == phase]) != len(phasers):
+                    errors.append(phase)
+            phaser.arrive_and_deregister()
+        threads = [Thread(target=target,args=(p,)) for p in phasers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors,[])
+
+    def test_basic(self):
+        phaser = Phaser(4)
+        self.assertEquals(phaser.phase,0)
+        self.assertEquals(phaser.registered_parties,4)
+        self.run_phases([phaser] * 4,10)
+        self.assertEquals(phaser.phase,11)
+        self.assertEquals(phaser.registered_parties,0)
+        self.assertTrue(phaser.terminated)
+        self.assertRaises(RuntimeError,phaser.register)
+        self.assertTrue(phaser.await_advance(phaser.phase,timeout=0))
+        self.assertRaises(ValueError,Phaser,-1)
+
+    def test_registration(self):
+        phaser = Phaser()
+        self.assertEquals(phaser.register(2),0)
+        self.assertEquals(phaser.arrive(),0)
+        self.assertEquals(phaser.arrived_parties,1)
+        #  A late registration must also arrive before the phase advances.
+        self.assertEquals(phaser.register(),0)
+        self.assertEquals(phaser.unarrived_parties,2)
+        self.assertEquals(phaser.arrive(),0)
+        self.assertEquals(phaser.phase,0)
+        self.assertEquals(phaser.arrive_and_deregister(),0)
+        self.assertEquals(phaser.phase,1)
+        self.assertEquals(phaser.registered_parties,2)
+        self.assertEquals(phaser.unarrived_parties,2)
+        self.assertRaises(RuntimeError,Phaser().arrive)
+
+    def test_timeout(self):
+        phaser = Phaser(2)
+        self.assertFalse(phaser.arrive_and_await(timeout=0.01))
+        self.assertEquals(phaser.phase,0)
+        results = []
+        t = Thread(target=lambda: results.append(phaser.await_advance(0,5)))
+        t.start()
+        phaser.arrive()
+        t.join()
+        self.assertEquals(results,[True])
+        self.assertEquals(phaser.phase,1)
+
+    def test_termination(self):
+        class CountingPhaser(Phaser):
+            def on_advance(self,phase,registered_parties):
+                return phase >= 2
+        phaser = CountingPhaser(1)
+        for phase in xrange(3):
+            self.assertEquals(phaser.arrive(),phase)
+        self.assertTrue(phaser.terminated)
+        self.assertEquals(phaser.arrive(),3)
+        phaser = Phaser(2)
+        results = []
+        t = Thread(target=lambda: results.append(phaser.arrive_and_await()))
+        t.start()
+        while not phaser.arrived_parties:
+            time.sleep(0.001)
+        phaser.force_termination()
+        t.join()
+        self.assertEquals(results,[True])
+        self.assertTrue(phaser.terminated)
+
+    def test_tiered(self):
+        root = Phaser()
+        children = [Phaser(parent=root) for _ in xrange(4)]
+        grandchild = Phaser(parent=children[0])
+        self.assertTrue(grandchild.root is root)
+        self.assertTrue(grandchild.parent is children[0])
+        #  Children join their parent only while they have parties.
+        for child in children[1:]:
+            child.register(5)
+        grandchild.register(5)
+        self.assertEquals(root.registered_parties,4)
+        self.assertEquals(children[0].registered_parties,1)
+        phasers = [child for child in children[1:] for _ in xrange(5)]
+        phasers.extend([grandchild] * 5)
+        self.run_phases(phasers,10)
+        self.assertEquals(grandchild.phase,11)
+        self.assertEquals(root.registered_parties,0)
+        self.assertTrue(root.terminated)
+
+
+class TestAcquireAll(unittest.TestCase):
+    """Testcases for acquire_all() function."""
+
+    def test_basic(self):
+        locks = [Lock(),RLock(),SHLock(),Lock()]
+        with acquire_all(locks + locks[:2]) as held:
+            self.assertTrue(held)
+            self.assertFalse(locks[0].acquire(False))
+            self.assertTrue(locks[1]._is_owned())
+            self.assertTrue(locks[2].is_exclusive)
+        self.assertFalse(held)
+        self.assertRaises(RuntimeError,held.release)
+        for lock in locks:
+            self.assertTrue(lock.acquire(False))
+            lock.release()
+        self.assertTrue(acquire_all([]))
+
+    def test_failure(self):
+        locks = [Lock() for _ in xrange(4)]
+        locks[2].acquire()
+        results = []
+        def target():
+            results.append(acquire_all(locks,blocking=False))
+            start = time.time()
+            results.append(acquire_all(locks,timeout=0.1))
+            results.append(time.time() - start)
+            for lock in locks:
+                if lock is not locks[2]:
+                    results.append(lock.acquire(False))
+                    lock.release()
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        locks[2].release()
+        self.assertFalse(results[0])
+        self.assertFalse(results[1])
+        self.assertTrue(0.05 < results[2] < 1)
+        self.assertEquals(results[3:],[True] * 3)
+        def enter():
+            try:
+                with results[0]:
+                    pass
+            except RuntimeError:
+                return
+            self.fail("entered without holding the locks")
+        enter()
+
+    def test_shared(self):
+        locks = [SHLock(),SHLock(),Lock()]
+        locks[0].acquire(shared=True)
+        results = []
+        def target():
+            held = acquire_all(locks,timeout=1,shared=True)
+            results.append(bool(held))
+            held.release()
+            results.append(bool(acquire_all(locks,timeout=0.01)))
+        t = Thread(target=target)
+        t.start()
+        t.join()
+        locks[0].release()
+        self.assertEquals(results,[True,False])
+
+    def test_random_contention(self):
+        #  Many threads grabbing random subsets of the locks, in random
+        #  order, must all eventually complete.
+        locks = [Lock() for _ in xrange(6)]
+        locks.extend(RLock() for _ in xrange(3))
+        locks.extend(SHLock() for _ in xrange(3))
+        counts = [0] * len(locks)
+        expected = [0] * len(locks)
+        errors = []
+        def target(seed):
+            rng = random.Random(seed)
+            my_counts = [0] * len(locks)
+            try:
+                for _ in xrange(300):
+                    chosen = rng.sample(xrange(len(locks)),rng.randint(1,5))
+                    shared = rng.random() < 0.2
+                    timeout = rng.choice((None,None,0.001,0.01))
+                    held = acquire_all([locks[i] for i in chosen],
+                                       timeout=timeout,shared=shared)
+                    if not held:
+                        self.assertTrue(timeout is not None)
+                        continue
+                    with held:
+                        if not shared:
+                            for i in chosen:
+                                n = counts[i]
+                                time.sleep(0)
+                                counts[i] = n + 1
+                                my_counts[i] += 1
+                        if rng.random() < 0.1:
+                            time.sleep(0.0001)
+            except Exception, e:
+                errors.append(e)
+            with lock:
+                for i in xrange(len(locks)):
+                    expected[i] += my_counts[i]
+        lock = Lock()
+        threads = [Thread(target=target,args=(i,)) for i in xrange(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+            self.assertFalse(t.is_alive(),"deadlock in acquire_all")
+        self.assertEquals(errors,[])
+        self.assertEquals(counts,expected)
+        self.assertTrue(acquire_all(locks,blocking=False))
+
+
+class TestThreadCache(unittest.TestCase):
+    """Testcases for reusing OS threads via ThreadCache."""
+
+    def setUp(self):
+        self.cache = ThreadCache()
+        self.group = ThreadGroup(cache=self.cache)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def run_thread(self,target=None,**kwds):
+        """Run a thread in the cached group, returning its results."""
+        results = {}
+        def record():
+            me = current_thread()
+            results["thread"] = me
+            results["ident"] = (me.ident,me.native_id)
+            if target is not None:
+                target(results)
+        t = Thread(target=record,group=self.group,**kwds)
+        t.start()
+        self.assertTrue(t.join(10))
+        return results
+
+    def test_reuse(self):
+        r1 = self.run_thread(name="first")
+        self.assertEquals(self.cache.idle_threads,1)
+        r2 = self.run_thread(name="second")
+        self.assertEquals(self.cache.idle_threads,1)
+        self.assertEquals(r1["ident"],r2["ident"])
+        self.assertEquals(r1["thread"].name,"first")
+        self.assertEquals(r2["thread"].name,"second")
+        self.assertTrue(r2["thread"].group is self.group)
+        self.assertFalse(r1["thread"].is_alive())
+        self.assertFalse(r2["thread"].is_alive())
+        self.assertFalse(r2["thread"] in enumerate())
+        self.assertRaises(RuntimeError,r2["thread"].start)
+
+    def test_uncached(self):
+        r1 = self.run_thread()
+        r2 = self.run_thread(stack_size=256*1024)
+        self.assertEquals(self.cache.idle_threads,1)
+        self.cache.clear()
+        self.assertEquals(self.cache.idle_threads,0)
+        r3 = self.run_thread()
+        self.assertNotEquals(r1["ident"],r3["ident"])
+
+    def test_max_idle(self):
+        self.cache.max_idle = 2
+        ready = Semaphore(0)
+        done = Event()
+        threads = []
+        for _ in xrange(3):
+            t = Thread(target=lambda: (ready.release(),done.wait()),
+                       group=self.group)
+            t.start()
+            threads.append(t)
+        for _ in xrange(3):
+            ready.acquire()
+        done.set()
+        self.assertTrue(self.group.join(10))
+        self.assertEquals(self.cache.idle_threads,2)
+
+    def test_idle_timeout(self):
+        self.cache.idle_timeout = 0
+        self.run_thread()
+        time.sleep(0.01)
+        self.run_thread()
+        time.sleep(0.01)
+        self.run_thread()
+        self.assertEquals(self.cache.idle_threads,1)
+
+    def test_exception_in_target(self):
+        def fail(results):
+            raise ValueError("expected failure")
+        stderr = sys.stderr
+        sys.stderr = tempfile.TemporaryFile()
+        try:
+            self.run_thread(fail)
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(self.cache.idle_threads,1)
+        self.run_thread()
+
+    def test_clean_exit(self):
+        #  Exiting right after joining a cached thread must not produce
+        #  errors from the worker as the interpreter is torn down.
+        script = "\n".join(["import threading2",
+                            "group = threading2.ThreadGroup(",
+                            "    cache=threading2.ThreadCache())",
+                            "t = threading2.Thread(group=group)",
+                            "t.start()",
+                            "t.join()",""])
+        env = dict(os.environ)
+        pkgdir = os.path.dirname(os.path.abspath(threading2.__file__))
+        env["PYTHONPATH"] = os.path.dirname(pkgdir)
+        for _ in xrange(5):
+            p = subprocess.Popen([sys.executable,"-c",script],env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            (output,_) = p.communicate()
+            self.assertEquals((p.returncode,output),(0,""))
+
+    def check_state_reset(self):
+        """Check that cached threads never leak their OS-level state.
+
+        The OS thread must be reused if its state could be restored, which
+        requires being able to raise its priority again.
+        """
+        def read_state(results):
+            me = current_thread()
+            stat = read_task_stat(me.native_id)
+            results["nice"] = int(stat[19])
+            results["policy"] = int(stat[41])
+            if t2_posix._ioprio_get is not None:
+                results["io"] = t2_posix._do_get_io_priority(me.native_id)
+            if t2_posix._do_get_affinity is not None:
+                results["affinity"] = t2_posix._do_get_affinity(me.ident)
+        r1 = self.run_thread(read_state)
+        r2 = self.run_thread(read_state,priority=0,affinity=[0],
+                             io_priority=IOPRIO_CLASS_IDLE)
+        self.assertEquals(r2["nice"],19)
+        r3 = self.run_thread(read_state)
+        for key in ("nice","policy","io","affinity"):
+            self.assertEquals(r1.get(key),r3.get(key))
+        if can_raise_nice(r1["nice"]):
+            self.assertEquals(r1["ident"],r3["ident"])
+        else:
+            self.assertNotEquals(r1["ident"],r3["ident"])
+
+    def test_state_reset(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        self.check_state_reset()
+
+    def test_state_reset_unprivileged(self):
+        if t2_posix is None or t2_posix._gettid is None:
+            raise unittest.SkipTest("linux thread ids not available")
+        if os.geteuid() != 0:
+            self.check_state_reset()
+            return
+        #  Drop privileges in a child process, reporting any failure
+        #  back through a pipe.
+        (rfd,wfd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                try:
+                    os.setgid(65534)
+                    os.setuid(65534)
+                    self.setUp()
+                    try:
+                        self.check_state_reset()
+                    finally:
+                        self.tearDown()
+                except BaseException:
+                    os.write(wfd,traceback.format_exc())
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        try:
+            output = []
+            while select.select([rfd],[],[],30)[0]:
+                data = os.read(rfd,4096)
+                if not data:
+                    break
+                output.append(data)
+            else:
+                os.kill(pid,signal.SIGKILL)
+                output.append("timed out")
+        finally:
+            os.close(rfd)
+            os.waitpid(pid,0)
+        self.assertEquals("".join(output),"")
+
 
 class TestMisc(unittest.TestCase):
     """Miscellaneous test procedures."""
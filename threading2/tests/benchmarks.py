@@ -0,0 +1,488 @@
+"""
+
+  threading2.tests.benchmarks:  simple timing benchmarks for threading2
+
+This module contains some quick-and-dirty benchmarks for the performance
+sensitive parts of threading2.  Run them like so:
+
+    python -m threading2.tests.benchmarks [name ...]
+
+If no names are given then all benchmarks are run.
+
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+import random
+import timeit
+import thread
+import threading
+
+import threading2
+from threading2 import *
+
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """Decorator to register a benchmark function."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def time_per_call(func,number=10000,repeat=3):
+    """Get the best time for a single call to func, in microseconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat,number)) / number * 1e6
+
+
+def report(name,value,units="usec/call"):
+    print "    %-40s %12.2f %s" % (name,value,units)
+
+
+@benchmark
+def system_affinity_cost():
+    """Per-call cost of the cpu information functions."""
+    def uncached():
+        refresh_cpu_info()
+        system_affinity()
+    report("system_affinity() [uncached]",time_per_call(uncached,1000))
+    report("system_affinity() [cached]",time_per_call(system_affinity))
+    report("process_affinity()",time_per_call(process_affinity))
+    report("effective_cpu_capacity()",time_per_call(effective_cpu_capacity))
+
+
+def proc_status_kb(field):
+    """Get a memory field from /proc/self/status in kB, or None."""
+    try:
+        with open("/proc/self/status","r") as f:
+            for ln in f:
+                if ln.startswith(field + ":"):
+                    return int(ln.split()[1])
+    except EnvironmentError:
+        pass
+    return None
+
+
+@benchmark
+def stack_size_threads():
+    """Creation time and memory use of many idle threads."""
+    for num_threads in (1000,10000):
+        for size in (None,256*1024,64*1024):
+            label = "%d threads, %s stack" % (num_threads,
+                    "default" if size is None else "%dk" % (size // 1024,))
+            done = Event()
+            threads = []
+            rss = proc_status_kb("VmRSS")
+            vsz = proc_status_kb("VmSize")
+            start = timeit.default_timer()
+            try:
+                for _ in xrange(num_threads):
+                    t = Thread(target=done.wait,stack_size=size)
+                    t.start()
+                    threads.append(t)
+            except Exception, e:
+                report(label + " [failed: %s]" % (e,),len(threads),"threads")
+            else:
+                elapsed = timeit.default_timer() - start
+                report(label,elapsed / num_threads * 1e6,"usec/thread")
+                if rss is not None:
+                    rss = proc_status_kb("VmRSS") - rss
+                    vsz = proc_status_kb("VmSize") - vsz
+                    report("    RSS",rss / float(num_threads),"kB/thread")
+                    report("    virtual",vsz / float(num_threads),"kB/thread")
+            finally:
+                done.set()
+                for t in threads:
+                    t.join()
+
+
+@benchmark
+def thread_spawn_rate():
+    """Cost of starting and joining short-lived threads."""
+    def noop():
+        pass
+    cache = ThreadCache()
+    for (label,group) in (("uncached",ThreadGroup()),
+                          ("cached",ThreadGroup(cache=cache))):
+        def spawn_one():
+            t = Thread(target=noop,group=group)
+            t.start()
+            t.join()
+        report("start+join, %s" % (label,),time_per_call(spawn_one,2000))
+        def fan_out():
+            threads = [Thread(target=noop,group=group) for _ in xrange(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        report("fan-out of 16, %s" % (label,),
+               time_per_call(fan_out,200) / 16,"usec/thread")
+    cache.clear()
+
+
+@benchmark
+def thread_stats_cost():
+    """Cost of sampling resource usage of many threads."""
+    done = Event()
+    group = ThreadGroup()
+    threads = [Thread(target=done.wait,group=group) for _ in xrange(200)]
+    try:
+        for t in threads:
+            t.start()
+        report("Thread.stats()",time_per_call(threads[0].stats,1000))
+        report("ThreadGroup.stats() [200 threads]",
+               time_per_call(group.stats,10) / 1000,"msec/call")
+    finally:
+        done.set()
+        group.join()
+
+
+@benchmark
+def rebalancer_simulation():
+    """Simulated skewed load on 8 cpus, balanced by Rebalancer.plan()."""
+    rng = random.Random(42)
+    cpus = range(8)
+    #  32 threads with a skewed load distribution, initially pinned so that
+    #  the busiest threads share the first two cpus.
+    loads = dict((i,min(1.0,2.0 / (i + 1) + rng.random() * 0.05))
+                 for i in xrange(32))
+    assignments = dict((i,i % 2 if i < 8 else i % 8) for i in loads)
+    ideal = max(sum(loads.itervalues()) / len(cpus),max(loads.itervalues()))
+    def max_load():
+        totals = dict((cpu,0.0) for cpu in cpus)
+        for (thread,cpu) in assignments.iteritems():
+            totals[cpu] += loads[thread]
+        return max(totals.itervalues())
+    report("ideal max cpu load",ideal,"cpus")
+    report("max cpu load before",max_load(),"cpus")
+    for interval in xrange(1,21):
+        moves = Rebalancer.plan(loads,assignments,cpus,max_moves=2)
+        if not moves:
+            break
+        assignments.update(moves)
+    report("max cpu load after %d intervals" % (interval,),max_load(),"cpus")
+    report("Rebalancer.plan() [32 threads]",
+           time_per_call(lambda: Rebalancer.plan(loads,assignments,cpus),100))
+
+
+@benchmark
+def current_thread_cost():
+    """Cost of current_thread(), and of upgrading foreign threads."""
+    report("threading.current_thread()",
+           time_per_call(threading.current_thread,100000))
+    report("threading2.current_thread()",
+           time_per_call(threading2.current_thread,100000))
+    results = []
+    done = threading.Event()
+    def foreign():
+        try:
+            def upgrade():
+                Thread.from_thread(threading._DummyThread())
+            results.append(time_per_call(upgrade,1000))
+            results.append(time_per_call(threading2.current_thread,100000))
+        finally:
+            with threading._active_limbo_lock:
+                threading._active.pop(threading._get_ident(),None)
+            done.set()
+    thread.start_new_thread(foreign,())
+    done.wait()
+    report("Thread.from_thread() [foreign]",results[0])
+    report("threading2.current_thread() [foreign]",results[1])
+
+
+@benchmark
+def group_local_reads():
+    """Read throughput of group_local attributes."""
+    data = group_local()
+    data.value = 42
+    tlocal = threading.local()
+    tlocal.value = 42
+    report("group_local read",time_per_call(lambda: data.value,100000))
+    report("threading.local read",time_per_call(lambda: tlocal.value,100000))
+    num_threads = 32
+    num_reads = 20000
+    start = Event()
+    def reader():
+        start.wait()
+        for _ in xrange(num_reads):
+            data.value
+    group = ThreadGroup()
+    setter = Thread(target=setattr,args=(data,"value",42),group=group)
+    setter.start()
+    setter.join()
+    for _ in xrange(num_threads):
+        Thread(target=reader,group=group).start()
+    t0 = timeit.default_timer()
+    start.set()
+    group.join()
+    elapsed = timeit.default_timer() - t0
+    report("group_local reads [%d threads]" % (num_threads,),
+           num_threads * num_reads / elapsed / 1e6,"Mreads/sec")
+
+
+@benchmark
+def sharded_counter():
+    """Incrementing a counter shared by many threads."""
+    class LockedCounter(object):
+        def __init__(self):
+            self.lock = Lock()
+            self.value = 0
+        def increment(self,n=1):
+            with self.lock:
+                self.value += n
+    num_increments = 20000
+    for num_threads in (1,8):
+        for cls in (LockedCounter,ShardedCounter):
+            counter = cls()
+            group = ThreadGroup()
+            def target():
+                for _ in xrange(num_increments):
+                    counter.increment()
+            t0 = timeit.default_timer()
+            for _ in xrange(num_threads):
+                Thread(target=target,group=group).start()
+            group.join()
+            elapsed = timeit.default_timer() - t0
+            report("%s [%d threads]" % (cls.__name__,num_threads),
+                   elapsed / (num_threads * num_increments) * 1e6)
+    report("current_cpu()",time_per_call(current_cpu,100000))
+
+
+@benchmark
+def lock_table_contention():
+    """Locking random keys from many threads, with various stripe counts."""
+    num_threads = 8
+    num_ops = 2000
+    keys = range(100000)
+    for stripes in (1,16,256,4096):
+        table = LockTable(stripes)
+        def target(seed):
+            rng = random.Random(seed)
+            for _ in xrange(num_ops):
+                key = rng.choice(keys)
+                with table(key):
+                    #  Give up the GIL while holding the lock, as if doing
+                    #  some I/O, so that other threads can contend for it.
+                    time.sleep(0)
+        group = ThreadGroup()
+        t0 = timeit.default_timer()
+        for i in xrange(num_threads):
+            Thread(target=target,args=(i,),group=group).start()
+        group.join()
+        elapsed = timeit.default_timer() - t0
+        stats = table.stats()
+        acquired = sum(s["acquired"] for s in stats)
+        contended = sum(s["contended"] for s in stats)
+        report("%d stripes" % (stripes,),
+               elapsed / (num_threads * num_ops) * 1e6,"usec/op")
+        report("    contended",100.0 * contended / acquired,"%")
+    report("LockTable.acquire+release [uncontended]",
+           time_per_call(lambda: (table.acquire(1),table.release(1))))
+
+
+@benchmark
+def seqlock_reads():
+    """Reading small shared state under SeqLock and shared SHLock."""
+    num_reads = 2000
+    state = {"host":"localhost","port":8080}
+    seqlock = SeqLock()
+    shlock = SHLock()
+    def read_seqlock():
+        return seqlock.read(lambda: (state["host"],state["port"]))
+    def read_shlock():
+        shlock.acquire(shared=True)
+        try:
+            return (state["host"],state["port"])
+        finally:
+            shlock.release()
+    report("SeqLock.read() [uncontended]",time_per_call(read_seqlock))
+    report("SHLock shared [uncontended]",time_per_call(read_shlock))
+    for num_readers in (8,32,64):
+        for (label,read,lock) in (("SeqLock.read()",read_seqlock,seqlock),
+                                  ("SHLock shared",read_shlock,shlock)):
+            done = Event()
+            def writer():
+                #  An occasional writer, as for a config snapshot.
+                while not done.wait(0.001):
+                    with lock:
+                        state["port"] += 1
+            def reader():
+                for _ in xrange(num_reads):
+                    read()
+            readers = ThreadGroup()
+            w = Thread(target=writer)
+            w.start()
+            t0 = timeit.default_timer()
+            for _ in xrange(num_readers):
+                Thread(target=reader,group=readers).start()
+            readers.join()
+            elapsed = timeit.default_timer() - t0
+            done.set()
+            w.join()
+            report("%s [%d readers]" % (label,num_readers),
+                   elapsed / (num_readers * num_reads) * 1e6,"usec/read")
+
+
+@benchmark
+def rcu_lookups():
+    """Lookups in a shared table under RCUDict and shared SHLock."""
+    num_reads = 2000
+    readers = ThreadGroup()
+    table = RCUDict(readers,((i,str(i)) for i in xrange(1000)),
+                    reclaim=lambda old: None)
+    shlock = SHLock()
+    plain = dict(table.snapshot())
+    def lookup_rcu():
+        return table[42]
+    def lookup_shlock():
+        shlock.acquire(shared=True)
+        try:
+            return plain[42]
+        finally:
+            shlock.release()
+    report("RCUDict lookup [uncontended]",time_per_call(lookup_rcu,100000))
+    report("SHLock shared lookup [uncontended]",time_per_call(lookup_shlock))
+    report("rcu_quiescent()",time_per_call(rcu_quiescent,100000))
+    for num_readers in (8,32):
+        for (label,lookup) in (("RCUDict",lookup_rcu),
+                               ("SHLock shared",lookup_shlock)):
+            done = Event()
+            def writer():
+                #  An occasional writer, as for a routing table.
+                n = 0
+                while not done.wait(0.001):
+                    n += 1
+                    table[n % 1000] = str(n)
+                    with shlock:
+                        plain[n % 1000] = str(n)
+            def reader():
+                for i in xrange(num_reads):
+                    lookup()
+                    if i % 100 == 0:
+                        rcu_quiescent()
+            w = Thread(target=writer)
+            w.start()
+            t0 = timeit.default_timer()
+            for _ in xrange(num_readers):
+                Thread(target=reader,group=readers).start()
+            readers.join()
+            elapsed = timeit.default_timer() - t0
+            done.set()
+            w.join()
+            report("%s lookup [%d readers]" % (label,num_readers),
+                   elapsed / (num_readers * num_reads) * 1e6,"usec/read")
+    table.synchronize()
+
+
+@benchmark
+def barrier_latency():
+    """Round-trip latency of barriers for teams of threads."""
+    class ConditionBarrier(object):
+        #  The usual barrier built from a single Condition, for comparison.
+        def __init__(self,parties):
+            self.parties = parties
+            self.count = 0
+            self.generation = 0
+            self.cond = Condition(Lock())
+        def wait(self):
+            with self.cond:
+                generation = self.generation
+                self.count += 1
+                if self.count == self.parties:
+                    self.count = 0
+                    self.generation += 1
+                    self.cond.notify_all()
+                else:
+                    while generation == self.generation:
+                        self.cond.wait()
+    num_rounds = 100
+    for num_threads in (4,8,16,32,64):
+        for cls in (ConditionBarrier,Barrier,SpinBarrier):
+            barrier = cls(num_threads)
+            def target():
+                for _ in xrange(num_rounds):
+                    barrier.wait()
+            group = ThreadGroup()
+            threads = [Thread(target=target,group=group)
+                       for _ in xrange(num_threads)]
+            t0 = timeit.default_timer()
+            for t in threads:
+                t.start()
+            group.join()
+            elapsed = timeit.default_timer() - t0
+            report("%s [%d threads]" % (cls.__name__,num_threads),
+                   elapsed / num_rounds * 1e6,"usec/round")
+
+
+@benchmark
+def phaser_tiering():
+    """Phase latency of a flat Phaser, and of a tree of Phasers."""
+    num_phases = 20
+    for num_threads in (64,256):
+        for fanout in (None,16):
+            root = Phaser()
+            if fanout is None:
+                label = "flat"
+                phasers = [root] * num_threads
+            else:
+                label = "tiered, %d per child" % (fanout,)
+                children = [Phaser(parent=root)
+                            for _ in xrange(num_threads // fanout)]
+                phasers = [children[i // fanout] for i in xrange(num_threads)]
+            for phaser in phasers:
+                phaser.register()
+            def target(phaser):
+                for _ in xrange(num_phases):
+                    phaser.arrive_and_await()
+                phaser.arrive_and_deregister()
+            group = ThreadGroup()
+            t0 = timeit.default_timer()
+            for phaser in phasers:
+                Thread(target=target,args=(phaser,),group=group).start()
+            group.join()
+            elapsed = timeit.default_timer() - t0
+            report("%s [%d threads]" % (label,num_threads),
+                   elapsed / num_phases * 1e6,"usec/phase")
+
+
+@benchmark
+def primitive_memory():
+    """Memory use of large numbers of synchronisation primitives."""
+    num_objects = 100000
+    #  Everything is kept alive until the end, so that each measurement
+    #  isn't skewed by memory freed from the previous one.
+    keep_alive = []
+    for (label,factory) in (("thread.allocate_lock()",thread.allocate_lock),
+                            ("threading.RLock()",threading.RLock),
+                            ("threading.Event()",threading.Event),
+                            ("threading.Semaphore()",threading.Semaphore),
+                            ("Lock()",Lock),
+                            ("RLock()",RLock),
+                            ("Event()",Event),
+                            ("Semaphore()",Semaphore),
+                            ("SHLock()",SHLock),):
+        rss = proc_status_kb("VmRSS")
+        if rss is None:
+            report(label + " [shallow]",sys.getsizeof(factory()),"bytes")
+            continue
+        objects = [factory() for _ in xrange(num_objects)]
+        rss = proc_status_kb("VmRSS") - rss
+        report(label,rss * 1024.0 / num_objects,"bytes/object")
+        keep_alive.append(objects)
+
+
+def main(argv):
+    names = set(argv)
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        print "%s: %s" % (func.__name__,func.__doc__)
+        func()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+